@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Measure usbrip startup: wall-clock time of short commands and what their imports cost.
+
+Usage: python3 benchmarks/startup.py [-r REPEAT] [-t TOP] [COMMAND ...]
+
+Every COMMAND (default: a few commands that do almost no work) is run REPEAT times as
+"python3 -X importtime -m usbrip COMMAND", the best wall-clock time is reported along with
+the total import time and the TOP slowest modules (cumulative) of the best run. "{dump}" in
+a command stands for a small JSON event dump.
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Bytecode is cached (the warm-up run writes it), as it would be for an installed usbrip
+ENV = {key: val for key, val in os.environ.items() if key != 'PYTHONDONTWRITEBYTECODE'}
+ENV['PYTHONPATH'] = ROOT
+
+COMMANDS = (
+	'banner',
+	'-h',
+	'events history --help',
+	'ids search --help',
+	'events open {dump} -q',
+)
+
+EVENT = {
+	'conn':     '2020-01-01 00:00:00',
+	'host':     'host',
+	'vid':      '0781',
+	'pid':      '5567',
+	'prod':     'Cruzer Blade',
+	'manufact': 'SanDisk',
+	'serial':   '4C530001234567891234',
+	'port':     '1-1',
+	'disconn':  '2020-01-01 00:05:00'
+}
+
+
+def run(command, dump=''):
+	cmd = [sys.executable, '-X', 'importtime', '-m', 'usbrip'] + shlex.split(command.format(dump=dump))
+
+	start = time.perf_counter()
+	proc = subprocess.run(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=ENV)
+	elapsed = time.perf_counter() - start
+
+	return elapsed, parse_importtime(proc.stderr.decode('utf-8', 'replace'))
+
+
+def parse_importtime(stderr):
+	"""Turn "import time: self [us] | cumulative | imported package" lines into {module: cumulative}."""
+	modules = {}
+	for line in stderr.splitlines():
+		if not line.startswith('import time:'):
+			continue
+
+		try:
+			_, cumulative, name = line[len('import time:'):].split('|')
+			cumulative = int(cumulative)
+		except ValueError:  # the header line
+			continue
+
+		# Top-level imports are the ones without indentation, their cumulative times add up to the total
+		modules[name.strip()] = (cumulative, name.startswith(' ') and not name.startswith('  '))
+
+	return modules
+
+
+def report(command, dump, repeat, top):
+	run(command, dump)  # warm up the bytecode cache
+
+	elapsed, modules = min((run(command, dump) for _ in range(repeat)), key=lambda result: result[0])
+	total = sum(cumulative for cumulative, top_level in modules.values() if top_level)
+
+	print(f'usbrip {command}')
+	print(f'  {"wall-clock":<40}{elapsed * 1000:>8.1f} ms')
+	print(f'  {"imports":<40}{total / 1000:>8.1f} ms')
+
+	slowest = sorted(modules.items(), key=lambda item: item[1][0], reverse=True)[:top]
+	for name, (cumulative, _) in slowest:
+		print(f'    {name:<38}{cumulative / 1000:>8.1f} ms')
+
+	print()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark usbrip startup time')
+	parser.add_argument('commands', nargs='*', help=f'usbrip command lines to time (default: {", ".join(map(repr, COMMANDS))})')
+	parser.add_argument('-r', '--repeat', type=int, default=10, help='best of REPEAT runs (default: 10)')
+	parser.add_argument('-t', '--top', type=int, default=5, help='number of slowest imports to show (default: 5)')
+	args = parser.parse_args()
+
+	with tempfile.NamedTemporaryFile('w', prefix='usbrip-bench-', suffix='.json') as dump:
+		json.dump([EVENT], dump)
+		dump.flush()
+
+		for command in args.commands or COMMANDS:
+			report(command, dump.name, args.repeat, args.top)
+
+
+if __name__ == '__main__':
+	main()
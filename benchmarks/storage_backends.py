@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compare usbrip storage backends: time to pack (put) and unpack (get) one segment.
+
+Usage: python3 benchmarks/storage_backends.py [-n EVENTS] [-r REPEAT] [--lvl LEVEL] [DUMP.json]
+
+Without a dump, EVENTS synthetic events are generated. The 7-Zip backend is skipped
+if 7z is not installed.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import usbrip.lib.core.config as cfg
+from usbrip.lib.core.storagebackend import BACKENDS
+
+
+def synthetic_events(n, seed=1337):
+	rnd = Random(seed)
+	start = time.mktime((2020, 1, 1, 0, 0, 0, 0, 0, -1))
+
+	events = []
+	for i in range(n):
+		conn = start + i * 600 + rnd.randint(0, 599)
+		events.append({
+			'conn':     time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(conn)),
+			'host':     f'host{rnd.randint(1, 5)}',
+			'vid':      f'{rnd.randint(0, 0xffff):04x}',
+			'pid':      f'{rnd.randint(0, 0xffff):04x}',
+			'prod':     f'Prod{rnd.randint(1, 50)}',
+			'manufact': f'Manu{rnd.randint(1, 10)}',
+			'serial':   f'SN{i}' if rnd.random() > 0.1 else None,
+			'port':     f'{rnd.randint(1, 4)}-{rnd.randint(1, 4)}',
+			'disconn':  time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(conn + 300))
+		})
+
+	return events
+
+
+def best_of(repeat, func):
+	timings = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		func()
+		timings.append(time.perf_counter() - start)
+
+	return min(timings)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark usbrip storage backends')
+	parser.add_argument('dump', nargs='?', help='JSON event dump to use instead of synthetic events')
+	parser.add_argument('-n', '--events', type=int, default=100000, help='number of synthetic events (default: 100000)')
+	parser.add_argument('-r', '--repeat', type=int, default=3, help='best of REPEAT runs (default: 3)')
+	parser.add_argument('--lvl', default='5', help='compression level (default: 5)')
+	args = parser.parse_args()
+
+	if args.dump:
+		with open(args.dump, 'r', encoding='utf-8') as f:
+			events = json.load(f)
+	else:
+		events = synthetic_events(args.events)
+
+	data = json.dumps(events, indent=4).encode('utf-8')
+	cfg.QUIET = True
+
+	print(f'{len(events)} events, {len(data)} bytes of JSON, compression level {args.lvl}\n')
+	print(f'{"Backend":<10}{"Put, s":>10}{"Get, s":>10}{"Size":>12}{"Ratio":>8}')
+	print('-' * 50)
+
+	tmp_dir = tempfile.mkdtemp(prefix='usbrip-bench-')
+	try:
+		for name, backend_class in BACKENDS.items():
+			if name == '7z' and not shutil.which('7z'):
+				print(f'{name:<10}{"7z not found, skipped":>40}')
+				continue
+
+			backend = backend_class('benchmark', args.lvl)
+			path = os.path.join(tmp_dir, 'segment' + backend.extension)
+
+			put = best_of(args.repeat, lambda: backend.put(path, 'segment.json', data))
+			get = best_of(args.repeat, lambda: backend.get(path))
+			size = backend.stat(path).st_size
+
+			print(f'{name:<10}{put:>10.3f}{get:>10.3f}{size:>12}{len(data) / size:>8.1f}')
+	finally:
+		shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Reading log files with the rg/grep pre-filter (cfg.PREFILTER) must give exactly the same
+events as the pure-Python path, for plain and rotated (compressed) logs alike.
+"""
+
+import bz2
+import gzip
+import lzma
+import shutil
+from random import Random
+
+import pytest
+
+import usbrip.lib.core.config as cfg
+import usbrip.lib.core.logsource as logsource
+from usbrip.lib.core.usbevents import _read_log_files
+
+WHICH = shutil.which
+
+COMPRESSORS = {
+	'':     lambda data: data,
+	'.gz':  gzip.compress,
+	'.xz':  lzma.compress,
+	'.bz2': bz2.compress
+}
+
+TOOLS = [
+	pytest.param('rg', marks=pytest.mark.skipif(not shutil.which('rg'), reason='rg is not installed')),
+	pytest.param('grep', marks=pytest.mark.skipif(not shutil.which('grep'), reason='grep is not installed'))
+]
+
+
+def synthetic_log(n, seed=1337):
+	"""Kernel USB messages mixed with noise: lines that merely mention "usb", broken UTF-8, no final newline."""
+	rnd = Random(seed)
+	lines = []
+
+	for i in range(n):
+		stamp = f'2020-01-{i % 28 + 1:02d}T{i % 24:02d}:{i % 60:02d}:00.000000+0000'
+		host = f'host{rnd.randint(1, 3)}'
+		port = f'{rnd.randint(1, 4)}-{rnd.randint(1, 4)}'
+		prefix = f'{stamp} {host} kernel: [{i:>5}.000000] usb {port}:'
+
+		lines += [
+			f'{prefix} new high-speed USB device number {i % 127 + 1} using ehci-pci',
+			f'{prefix} New USB device found, idVendor={rnd.randint(0, 0xffff):04x}, idProduct={rnd.randint(0, 0xffff):04x}',
+			f'{prefix} Product: Prod{rnd.randint(1, 50)}',
+			f'{prefix} Manufacturer: Manu{rnd.randint(1, 10)}',
+			f'{stamp} {host} systemd[1]: Started Session {i} of user root.',
+			f'{stamp} {host} udisksd[42]: mounted usb stick at /media/usb {i}',
+		]
+
+		if rnd.random() > 0.2:
+			lines.append(f'{prefix} SerialNumber: SN{i}')
+		if rnd.random() > 0.3:
+			lines.append(f'{prefix} USB disconnect, device number {i % 127 + 1}')
+
+	data = '\n'.join(lines).encode('utf-8')
+	data = data.replace(b'Session 7 ', b'Session \xff\xfe ', 1)
+	return data.replace(b'Manufacturer: Manu1\n', b'Manufacturer: Manu\xff1\n', 1)
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+	monkeypatch.setattr(cfg, 'QUIET', True)
+
+
+@pytest.fixture(scope='module')
+def log_data():
+	return synthetic_log(6000)  # more than one block per file
+
+
+def write_log(directory, name, ext, data):
+	path = directory / (name + ext)
+	path.write_bytes(COMPRESSORS[ext](data))
+	return str(path)
+
+
+def read_events(monkeypatch, filenames, prefilter, tool=None):
+	monkeypatch.setattr(cfg, 'PREFILTER', prefilter)
+	if tool is not None:
+		monkeypatch.setattr(logsource.shutil, 'which', lambda name: WHICH(name) if name == tool else None)
+		assert (logsource.find_prefilter_tool() or ('none',))[0] == tool
+
+	return _read_log_files(filenames)
+
+
+@pytest.mark.parametrize('tool', TOOLS)
+@pytest.mark.parametrize('ext', list(COMPRESSORS), ids=lambda ext: ext or 'plain')
+def test_prefilter_matches_python(tmp_path, monkeypatch, log_data, ext, tool):
+	filename = write_log(tmp_path, 'syslog', ext, log_data)
+
+	expected = read_events(monkeypatch, [filename], prefilter=False)
+	assert expected
+
+	assert read_events(monkeypatch, [filename], prefilter=True, tool=tool) == expected
+
+
+@pytest.mark.parametrize('tool', TOOLS)
+def test_prefilter_matches_python_rotated(tmp_path, monkeypatch, log_data, tool):
+	chunks = log_data.split(b'\n')
+	third = len(chunks) // 3
+	filenames = [
+		write_log(tmp_path, 'syslog', '', b'\n'.join(chunks[:third]) + b'\n'),
+		write_log(tmp_path, 'syslog.1', '.gz', b'\n'.join(chunks[third:2 * third]) + b'\n'),
+		write_log(tmp_path, 'syslog.2', '.xz', b'\n'.join(chunks[2 * third:]))
+	]
+
+	expected = read_events(monkeypatch, filenames, prefilter=False)
+	assert read_events(monkeypatch, filenames, prefilter=True, tool=tool) == expected
+
+
+@pytest.mark.parametrize('tool', TOOLS)
+@pytest.mark.parametrize('ext', [ext for ext in COMPRESSORS if ext], ids=lambda ext: ext)
+def test_prefilter_without_decompressors(tmp_path, monkeypatch, log_data, ext, tool):
+	filename = write_log(tmp_path, 'syslog', ext, log_data)
+	expected = read_events(monkeypatch, [filename], prefilter=False)
+
+	# Only the tool itself on PATH: no gzip, xz or bzip2 binaries to decompress with
+	bin_dir = tmp_path / 'bin'
+	bin_dir.mkdir()
+	(bin_dir / tool).symlink_to(WHICH(tool))
+	monkeypatch.setenv('PATH', str(bin_dir))
+
+	assert read_events(monkeypatch, [filename], prefilter=True, tool=tool) == expected
+
+
+@pytest.mark.parametrize('ext', list(COMPRESSORS), ids=lambda ext: ext or 'plain')
+def test_prefilter_without_tool_falls_back(tmp_path, monkeypatch, log_data, ext):
+	filename = write_log(tmp_path, 'syslog', ext, log_data)
+
+	expected = read_events(monkeypatch, [filename], prefilter=False)
+	assert read_events(monkeypatch, [filename], prefilter=True, tool='none') == expected
+
+
+def test_find_prefilter_tool_missing(monkeypatch):
+	monkeypatch.setattr(logsource.shutil, 'which', lambda name: None)
+	assert logsource.find_prefilter_tool() is None
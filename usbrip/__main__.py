@@ -30,19 +30,22 @@ __site__   = 'https://github.com/snovvcrash/usbrip'
 __brief__  = 'usbrip project\'s driver program'
 
 import os
+import stat
 import sys
+from datetime import datetime
 
 import usbrip.lib.core.config as cfg; cfg.DEBUG = '--debug' in sys.argv
 import usbrip.lib.utils.timing as timing
-from usbrip.lib.core.usbevents import USBEvents
-from usbrip.lib.core.usbstorage import USBStorage
-from usbrip.lib.core.usbids import USBIDs
-from usbrip.lib.core.common import BANNER
+from usbrip.lib.core.common import get_banner
 from usbrip.lib.core.common import COLUMN_NAMES
+from usbrip.lib.core.common import ENRICHED_COLUMN_NAMES
+from usbrip.lib.core.common import FORMAT_EXTENSIONS
 from usbrip.lib.core.common import print_critical
 from usbrip.lib.core.common import USBRipError
 from usbrip.lib.parse.argparser import get_arg_parser
-from usbrip.lib.parse.configparser import get_config_parser
+
+# The modules behind the subcommands (and the third-party packages they pull in) are imported
+# in the branch that needs them, so that a command pays only for what it uses at startup
 
 
 # ----------------------------------------------------------
@@ -52,47 +55,59 @@ from usbrip.lib.parse.configparser import get_config_parser
 
 def main():
 	if not len(sys.argv) > 1:
-		print(BANNER + '\n')
+		print(get_banner() + '\n')
 		usbrip_arg_error()
 
 	arg_parser = get_arg_parser()
 	args = arg_parser.parse_args()
 
-	if hasattr(args, 'quiet') and not args.quiet:
+	_validate_format_args(args)
+	_validate_tui_args(args)
+
+	if hasattr(args, 'quiet') and not args.quiet and not _is_streaming_to_stdout(args):
 		if cfg.ISATTY:
-			print(BANNER + '\n')
+			print(get_banner() + '\n')
 		else:
 			print(f'# Done as: usbrip {" ".join(sys.argv[1:])}')
 	else:
 		cfg.QUIET = True
 
+	if hasattr(args, 'prefilter') and args.prefilter:
+		cfg.PREFILTER = True
+
 	# ----------------------------------------------------------
 	# ------------------------- Banner -------------------------
 	# ----------------------------------------------------------
 
 	if args.subparser == 'banner':
-		print(BANNER)
+		print(get_banner())
 
 	# ----------------------------------------------------------
 	# ----------------------- USB Events -----------------------
 	# ----------------------------------------------------------
 
 	elif args.subparser == 'events' and args.ue_subparser:
-		if (args.ue_subparser == 'genauth' or args.ue_subparser == 'violations') and os.geteuid() != 0:
+		if args.ue_subparser in ('genauth', 'violations', 'watch') and os.geteuid() != 0:
 			sys.exit('Permission denied. Retry with sudo')
 
+		from usbrip.lib.core.usbevents import USBEvents
+
 		sieve, repres = validate_ue_args(args)
 
 		# ------------------- USB Events History -------------------
 
 		if args.ue_subparser == 'history':
 			timing.begin()
-			ue = USBEvents(args.file)
+			ue = USBEvents(args.file, kmsg=args.kmsg, boot_time=args.boot_time, db=args.db, db_only=args.db_only)
 			if ue:
 				ue.event_history(
 					args.column,
 					sieve=sieve,
-					repres=repres
+					repres=repres,
+					fmt=args.format,
+					output=args.out_file,
+					tui=args.tui,
+					enrich=args.enrich
 				)
 
 		# -------------------- USB Events Open ---------------------
@@ -103,14 +118,18 @@ def main():
 				args.input,
 				args.column,
 				sieve=sieve,
-				repres=repres
+				repres=repres,
+				fmt=args.format,
+				output=args.out_file,
+				tui=args.tui,
+				enrich=args.enrich
 			)
 
 		# ------------------ USB Events GenAuth -------------------
 
 		elif args.ue_subparser == 'genauth':
 			timing.begin()
-			ue = USBEvents(args.file)
+			ue = USBEvents(args.file, kmsg=args.kmsg, boot_time=args.boot_time)
 			if ue:
 				if ue.generate_auth_json(
 					args.output,
@@ -125,16 +144,29 @@ def main():
 
 		elif args.ue_subparser == 'violations':
 			timing.begin()
-			ue = USBEvents(args.file)
+			ue = USBEvents(args.file, kmsg=args.kmsg, boot_time=args.boot_time, db=args.db, db_only=args.db_only)
 			if ue:
 				ue.search_violations(
 					args.input,
 					args.attribute,
 					args.column,
 					sieve=sieve,
-					repres=repres
+					repres=repres,
+					fmt=args.format,
+					output=args.out_file,
+					enrich=args.enrich
 				)
 
+		# -------------------- USB Events Watch --------------------
+
+		elif args.ue_subparser == 'watch':
+			USBEvents.watch_violations(
+				args.input,
+				args.attribute,
+				source=args.source,
+				json_output=args.json
+			)
+
 	# ----------------------------------------------------------
 	# ---------------------- USB Storage -----------------------
 	# ----------------------------------------------------------
@@ -146,17 +178,26 @@ def main():
 		if any (not os.path.exists(p) for p in ('/opt/usbrip/', '/var/opt/usbrip', '/usr/local/bin/usbrip')):
 			sys.exit('The "storage" module can only be used when usbrip is installed via "install.sh" - https://git.io/JJfJq')
 
+		from usbrip.lib.core.usbstorage import USBStorage
+		from usbrip.lib.core.storagebackend import BACKENDS
+		from usbrip.lib.parse.configparser import get_config_parser
+
 		sieve, repres = validate_us_args(args)
 		timing.begin()
 		config_parser = get_config_parser()
 		us = USBStorage()
 
+		backend = config_parser.get('storage', 'backend', fallback='7z')
+		if backend not in BACKENDS:
+			sys.exit(f'Unknown storage backend "{backend}" in the configuration file (options: {", ".join(BACKENDS)})')
+
 		# -------------------- USB Storage List --------------------
 
 		if args.us_subparser == 'list':
 			us.list_storage(
 				args.storage_type,
-				config_parser[args.storage_type]['password']
+				config_parser[args.storage_type]['password'],
+				backend=backend
 			)
 
 		# -------------------- USB Storage Open --------------------
@@ -167,11 +208,23 @@ def main():
 				config_parser[args.storage_type]['password'],
 				args.column,
 				sieve=sieve,
-				repres=repres
+				repres=repres,
+				backend=backend
 			)
 
 		# ------------------- USB Storage Update -------------------
 
+		elif args.us_subparser == 'update' and args.storage_type == 'all':
+			if us.update_all_storages(
+				{storage_type: config_parser[storage_type]['password'] for storage_type in ('history', 'violations')},
+				input_auth=args.input,
+				attributes=args.attribute,
+				compression_level=args.lvl,
+				sieve=sieve,
+				backend=backend
+			):
+				usbrip_internal_error()
+
 		elif args.us_subparser == 'update':
 			if us.update_storage(
 				args.storage_type,
@@ -179,7 +232,8 @@ def main():
 				input_auth=args.input,
 				attributes=args.attribute,
 				compression_level=args.lvl,
-				sieve=sieve
+				sieve=sieve,
+				backend=backend
 			):
 				usbrip_internal_error()
 
@@ -192,41 +246,91 @@ def main():
 				input_auth=args.input,
 				attributes=args.attribute,
 				compression_level=args.lvl,
-				sieve=sieve
+				sieve=sieve,
+				backend=backend
 			):
 				usbrip_internal_error()
 
+		# ------------------- USB Storage Compact ------------------
+
+		elif args.us_subparser == 'compact':
+			if args.retention is None:
+				args.retention = config_parser.getint('storage', 'retention_days', fallback=0)
+			if args.segment_size is None:
+				args.segment_size = config_parser.getint('storage', 'segment_size', fallback=10000)
+
+			storage_types = ('history', 'violations') if args.storage_type == 'all' else (args.storage_type,)
+			for storage_type in storage_types:
+				if us.compact_storage(
+					storage_type,
+					config_parser[storage_type]['password'],
+					compression_level=args.lvl,
+					segment_size=args.segment_size,
+					retention_days=args.retention,
+					backend=backend
+				):
+					usbrip_internal_error()
+
 		# ------------------- USB Storage Passwd -------------------
 
 		elif args.us_subparser == 'passwd':
 			us.change_password(
 				args.storage_type,
-				compression_level=args.lvl
+				compression_level=args.lvl,
+				backend=backend
 			)
 
+	# ----------------------------------------------------------
+	# ----------------------- USB Daemon -----------------------
+	# ----------------------------------------------------------
+
+	elif args.subparser == 'serve':
+		if os.geteuid() != 0:
+			sys.exit('Permission denied. Retry with sudo')
+
+		from usbrip.lib.core.usbdaemon import USBDaemon
+
+		_validate_daemon_args(args)
+
+		if USBDaemon.serve(args.socket, source=args.source, max_events=args.max_events):
+			usbrip_internal_error()
+
 	# ----------------------------------------------------------
 	# ------------------------ USB IDs -------------------------
 	# ----------------------------------------------------------
 
 	elif args.subparser == 'ids' and args.ui_subparser:
+		from usbrip.lib.core.usbids import USBIDs
+
 		validate_ui_args(args)
 		timing.begin()
 		ui = USBIDs()
 
 		# --------------------- USB IDs Search ---------------------
 
-		if args.ui_subparser == 'search':
+		if args.ui_subparser == 'search' and args.batch:
+			if ui.search_ids_batch(args.batch):
+				usbrip_internal_error()
+
+		elif args.ui_subparser == 'search':
 			ui.search_ids(
 				args.vid,
 				args.pid,
-				offline=args.offline
+				offline=args.offline,
+				mirror=args.mirror
 			)
 
+		# ---------------------- USB IDs Find ----------------------
+
+		elif args.ui_subparser == 'find':
+			if ui.find_ids(' '.join(args.text), limit=args.number):
+				usbrip_internal_error()
+
 		# -------------------- USB IDs Download --------------------
 
 		elif args.ui_subparser == 'download':
 			try:
-				usb_ids = ui.prepare_database(offline=False)
+				usb_ids = ui.prepare_database(offline=False, mirror=args.mirror)
 			except USBRipError as e:
 				print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
 			else:
@@ -246,9 +350,12 @@ def main():
 
 def validate_ue_args(args):
 	_validate_column_args(args)
+	_validate_enrich_args(args)
 	_validate_attribute_args(args)
 	_validate_io_args(args)
 	_validate_file_args(args)
+	_validate_kmsg_args(args)
+	_validate_db_args(args)
 
 	return (_validate_sieve_args(args), _validate_repres_args(args))
 
@@ -259,6 +366,7 @@ def validate_ue_args(args):
 def validate_us_args(args):
 	_validate_storage_type_args(args)
 	_validate_compression_level_args(args)
+	_validate_compaction_args(args)
 	_validate_io_args(args)
 	_validate_attribute_args(args)
 
@@ -270,6 +378,7 @@ def validate_us_args(args):
 
 def validate_ui_args(args):
 	_validate_vid_pid_args(args)
+	_validate_find_args(args)
 
 
 # ----------------------------------------------------------
@@ -300,10 +409,18 @@ def usbrip_internal_error():
 def _validate_column_args(args):
 	if hasattr(args, 'column') and args.column:
 		for column in args.column:
-			if column not in COLUMN_NAMES.keys():
+			if column in ENRICHED_COLUMN_NAMES.keys():
+				if not getattr(args, 'enrich', False):
+					usbrip_arg_error(f'Column "{column}" can only be used with "--enrich"')
+			elif column not in COLUMN_NAMES.keys():
 				usbrip_arg_error(column + ': Invalid column name')
 
 
+def _validate_enrich_args(args):
+	if getattr(args, 'enrich', False) and getattr(args, 'format', None) == 'columnar':
+		usbrip_arg_error('Cannot use "--enrich" switch with columnar output, it only holds the standard fields')
+
+
 def _validate_sieve_args(args):
 	if 'external' in args:
 		sieve = dict(
@@ -366,7 +483,10 @@ def _validate_attribute_args(args):
 
 
 def _validate_storage_type_args(args):
-	if args.storage_type not in ('history', 'violations'):
+	if args.storage_type == 'all':
+		if args.us_subparser not in ('update', 'compact'):
+			usbrip_arg_error('Storage type "all" can only be used with "storage update" and "storage compact"')
+	elif args.storage_type not in ('history', 'violations'):
 		usbrip_arg_error(args.storage_type + ': Invalid storage type')
 
 	if args.storage_type == 'history':
@@ -379,6 +499,18 @@ def _validate_storage_type_args(args):
 			usbrip_arg_error('Please specify input path for the list of authorized devices (-i)')
 
 
+def _validate_compaction_args(args):
+	if hasattr(args, 'retention') and args.retention is not None and args.retention < 0:
+		usbrip_arg_error(f'{args.retention}: Invalid retention period')
+	if hasattr(args, 'segment_size') and args.segment_size is not None and args.segment_size < 1:
+		usbrip_arg_error(f'{args.segment_size}: Invalid segment size')
+
+
+def _validate_daemon_args(args):
+	if args.max_events is not None and args.max_events < 1:
+		usbrip_arg_error(f'{args.max_events}: Invalid number of events')
+
+
 def _validate_compression_level_args(args):
 	if hasattr(args, 'lvl') and args.lvl and (len(args.lvl) > 1 or args.lvl not in '0123456789'):
 		usbrip_arg_error(args.lvl + ': Invalid compression level')
@@ -393,8 +525,73 @@ def _validate_file_args(args):
 				usbrip_arg_error(file + ': Not a regular file')
 
 
+def _validate_kmsg_args(args):
+	if hasattr(args, 'kmsg') and args.kmsg:
+		if args.file:
+			usbrip_arg_error('Cannot use "--kmsg" and "--file" switches simultaneously')
+		if not os.path.exists(args.kmsg):
+			usbrip_arg_error(args.kmsg + ': Path does not exist')
+
+	if hasattr(args, 'boot_time') and args.boot_time:
+		if not args.kmsg or stat.S_ISCHR(os.stat(args.kmsg).st_mode):
+			usbrip_arg_error('"--boot-time" switch requires "--kmsg" with a file')
+		try:
+			args.boot_time = datetime.strptime(args.boot_time, '%Y-%m-%d %H:%M:%S').timestamp()
+		except ValueError:
+			usbrip_arg_error(args.boot_time + ': Invalid boot time, use "YYYY-MM-DD hh:mm:ss"')
+
+
+def _validate_format_args(args):
+	if hasattr(args, 'out_file') and args.out_file and not args.format:
+		args.format = FORMAT_EXTENSIONS.get(os.path.splitext(args.out_file)[-1].lower())
+		if not args.format:
+			usbrip_arg_error(args.out_file + ': Cannot guess output format from extension, use --format')
+
+	if hasattr(args, 'format') and args.format == 'columnar' and not args.out_file:
+		usbrip_arg_error('Columnar format can only be written to a file (use --output)')
+
+
+def _validate_tui_args(args):
+	if hasattr(args, 'tui') and args.tui:
+		if args.format:
+			usbrip_arg_error('Cannot use "--tui" together with "--format" or "--output"')
+		if not cfg.ISATTY:
+			usbrip_arg_error('"--tui" needs a terminal')
+
+
+def _is_streaming_to_stdout(args):
+	# Banner and info messages would end up mixed with the records
+	if hasattr(args, 'batch') and args.batch:
+		return True
+	if hasattr(args, 'json') and args.json:  # events watch --json
+		return True
+	return hasattr(args, 'format') and args.format and not args.out_file
+
+
+def _validate_db_args(args):
+	if hasattr(args, 'db_only') and args.db_only:
+		if not args.db:
+			usbrip_arg_error('"--db-only" switch requires "--db"')
+		if not os.path.isfile(args.db):
+			usbrip_arg_error(args.db + ': Path does not exist')
+		if args.file or args.kmsg:
+			usbrip_arg_error('Cannot use "--db-only" with "--file" or "--kmsg" switches')
+
+
+def _validate_find_args(args):
+	if hasattr(args, 'text') and not ' '.join(args.text).strip():
+		usbrip_arg_error('Please specify a vendor or product name to look for')
+	if hasattr(args, 'number') and hasattr(args, 'text') and args.number < 1:
+		usbrip_arg_error(f'{args.number}: Invalid number of matches')
+
+
 def _validate_vid_pid_args(args):
-	if hasattr(args, 'vid') and hasattr(args, 'pid') and not args.vid and not args.pid:
+	if hasattr(args, 'batch') and args.batch:
+		if args.vid or args.pid:
+			usbrip_arg_error('Cannot use "--vid"/"--pid" together with "--batch"')
+		if args.batch != '-' and not os.path.isfile(args.batch):
+			usbrip_arg_error(args.batch + ': Path does not exist')
+	elif hasattr(args, 'vid') and hasattr(args, 'pid') and not args.vid and not args.pid:
 		usbrip_arg_error('At least one of --vid/--pid or --download option should be specified')
 
 
@@ -30,7 +30,6 @@ import os
 import sys
 import json
 import time
-import random
 from collections import OrderedDict
 
 from termcolor import colored, cprint
@@ -47,6 +46,47 @@ from usbrip import __version__
 CONFIG_FILE = '/var/opt/usbrip/usbrip.ini'
 
 
+# ----------------------------------------------------------
+# ------------------- Daemon socket path -------------------
+# ----------------------------------------------------------
+
+
+DAEMON_SOCKET = '/var/run/usbrip.sock'
+
+
+# ----------------------------------------------------------
+# ------------------- Event database path ------------------
+# ----------------------------------------------------------
+
+
+EVENT_DATABASE = '/var/opt/usbrip/events.db'
+
+
+# ----------------------------------------------------------
+# -------------------- USB Storage path --------------------
+# ----------------------------------------------------------
+
+
+STORAGE_BASE = '/var/opt/usbrip/storage'
+
+
+# ----------------------------------------------------------
+# -------------------- USB IDs database --------------------
+# ----------------------------------------------------------
+
+
+USB_IDS_URL = 'http://www.linux-usb.org/usb.ids'
+
+
+# ----------------------------------------------------------
+# ------------------- Event dump formats -------------------
+# ----------------------------------------------------------
+
+
+FORMATS = ('json', 'ndjson', 'csv', 'columnar')
+FORMAT_EXTENSIONS = {'.json': 'json', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.csv': 'csv', '.ucd': 'columnar'}
+
+
 # ----------------------------------------------------------
 # ------------------- Unicode constants --------------------
 # ----------------------------------------------------------
@@ -68,7 +108,7 @@ SITE = __site__
 VERSION_FORMATTED = '\033[0m\033[1;37m{\033[1;34mv%s\033[1;37m}\033[0m' % VERSION
 SITE_FORMATTED = '\033[0m\033[4;37m%s\033[0m' % SITE
 
-BANNER = '''\033[1;33m\
+_BANNER = '''\033[1;33m\
                        
          _     {{4}}    %s\033[1;33m
  _ _ ___| |_ ___[+]___ 
@@ -78,18 +118,24 @@ BANNER = '''\033[1;33m\
                        \
 ''' % (VERSION_FORMATTED, SITE_FORMATTED)
 
-E = ('E', 'e', '3')
-N = ('N', 'n')
-S = ('S', 's', '5')
-I = ('I', 'i', '1', '!')
 
-E,N,S,I = list(map(lambda x: random.choice(x), (E,N,S,I)))
-E,N,S,I = list(map(lambda x: colored(x, 'green', 'on_blue') + '\033[1;33m', (E,N,S,I)))
+def get_banner():
+	import random  # only the banner needs it, keep it off the startup path
+
+	E = ('E', 'e', '3')
+	N = ('N', 'n')
+	S = ('S', 's', '5')
+	I = ('I', 'i', '1', '!')
+
+	E,N,S,I = list(map(lambda x: random.choice(x), (E,N,S,I)))
+	E,N,S,I = list(map(lambda x: colored(x, 'green', 'on_blue') + '\033[1;33m', (E,N,S,I)))
+
+	banner = _BANNER.replace('+', E, 1)
+	banner = banner.replace('*', N, 1)
+	banner = banner.replace('?', S, 1)
+	banner = banner.replace('^', I, 1)
 
-BANNER = BANNER.replace('+', E, 1)
-BANNER = BANNER.replace('*', N, 1)
-BANNER = BANNER.replace('?', S, 1)
-BANNER = BANNER.replace('^', I, 1)
+	return banner
 
 
 # ----------------------------------------------------------
@@ -135,6 +181,16 @@ else:
 	COLUMN_NAMES['port']     = 'Port'
 	COLUMN_NAMES['disconn']  = 'Disconnected'
 
+# Names from usb.ids, added to the events with --enrich
+ENRICHED_COLUMN_NAMES = OrderedDict()
+
+if cfg.ISATTY:
+	ENRICHED_COLUMN_NAMES['vendor']  = colored('Vendor',       'magenta', attrs=['bold'])
+	ENRICHED_COLUMN_NAMES['product'] = colored('Product Name', 'magenta', attrs=['bold'])
+else:
+	ENRICHED_COLUMN_NAMES['vendor']  = 'Vendor'
+	ENRICHED_COLUMN_NAMES['product'] = 'Product Name'
+
 
 # ----------------------------------------------------------
 # ----------------------- Event Sets -----------------------
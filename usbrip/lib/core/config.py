@@ -30,6 +30,7 @@ import sys
 
 DEBUG = False
 QUIET = False
+PREFILTER = False  # pre-select USB lines with ripgrep/grep (if available) before parsing them in Python
 
 ISATTY = True if sys.stdout.isatty() else False  # enable colored text when terminal output (True), else (| or > for example) no color (False)
 ISUTF8 = True if sys.stdout.encoding.upper() == 'UTF-8' else False
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""LICENSE
+
+Copyright (C) 2020 Sam Freeside
+
+This file is part of usbrip.
+
+usbrip is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+usbrip is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with usbrip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Sam Freeside (@snovvcrash)'
+__email__  = 'snovvcrash@protonmail[.]ch'
+__site__   = 'https://github.com/snovvcrash/usbrip'
+__brief__  = 'Event dump formats'
+
+import csv
+import json
+import mmap
+import os
+import re
+import stat
+import struct
+import sys
+from array import array
+
+from usbrip.lib.core.common import USBRipError
+from usbrip.lib.core.common import print_warning
+
+
+# ----------------------------------------------------------
+# ------------------------- Format -------------------------
+# ----------------------------------------------------------
+
+# All numbers are little-endian, every section starts at a multiple of 8 bytes:
+#
+#   header        magic, version, number of events, min and max connection time
+#   time columns  int64[n] conn, int64[n] disconn (-1 is None)
+#   code columns  uint32[n] per string column (0 is None, k is the k-th dictionary entry)
+#   dictionaries  per string column: uint32 size, uint32[size+1] offsets, UTF-8 blob
+#
+# Times are "YYYY-MM-DD hh:mm:ss" packed into YYYYMMDDhhmmss integers, unknown years ("????") are stored as 0.
+# Integer order is the same as string order, so date sieves turn into integer ranges.
+
+MAGIC = b'USBRIPCD'
+VERSION = 1
+EXTENSION = '.ucd'
+
+_HEADER = struct.Struct('<8sIIqq')
+_TIME_COLUMNS = ('conn', 'disconn')
+_STRING_COLUMNS = ('host', 'vid', 'pid', 'prod', 'manufact', 'serial', 'port')
+_FIELDS = ('conn', 'host', 'vid', 'pid', 'prod', 'manufact', 'serial', 'port', 'disconn')
+
+_RE_TIME = re.compile(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d$')
+_TIME_LOWEST = '0000-00-00 00:00:00'
+_TIME_HIGHEST = '9999-99-99 99:99:99'
+
+_NATIVE = sys.byteorder == 'little'
+
+
+def detect_dump_format(filename):
+	with open(filename, 'rb') as f:
+		head = f.read(4096)
+
+	if head.startswith(MAGIC):
+		return 'columnar'
+
+	if head.lstrip()[:1] == b'{':
+		return 'ndjson'
+
+	return 'json'
+
+
+def is_columnar_dump(filename):
+	return detect_dump_format(filename) == 'columnar'
+
+
+# ----------------------------------------------------------
+# -------------------- Streaming formats -------------------
+# ----------------------------------------------------------
+
+
+def export_events(events, fmt, filename=None, *, indent=4, fields=_FIELDS):
+	"""
+	Write events (any iterable) record by record to a file or to stdout; return the number of events written.
+	Text formats write the given fields, columnar dumps always hold the standard ones.
+	"""
+	if fmt == 'columnar':
+		if filename is None:
+			raise USBRipError('Columnar dumps can only be written to a file')
+		events = list(events)
+		try:
+			write_columnar_dump(events, filename)
+		except PermissionError as e:
+			raise USBRipError(f'Permission denied: "{filename}". Retry with sudo', errors={'initial_error': str(e)})
+		os.chmod(filename, stat.S_IRUSR | stat.S_IWUSR)  # 600
+		return len(events)
+
+	if filename is None:
+		try:
+			count = _write_events(events, fmt, sys.stdout, indent, fields)
+			sys.stdout.flush()
+		except BrokenPipeError:
+			# The reader has gone away (e.g. "| head"), do not let the interpreter complain on exit
+			os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+			count = 0
+		return count
+
+	try:
+		with open(filename, 'w', encoding='utf-8', newline='' if fmt == 'csv' else None) as out:
+			count = _write_events(events, fmt, out, indent, fields)
+	except PermissionError as e:
+		raise USBRipError(f'Permission denied: "{filename}". Retry with sudo', errors={'initial_error': str(e)})
+
+	os.chmod(filename, stat.S_IRUSR | stat.S_IWUSR)  # 600
+	return count
+
+
+def iter_ndjson(filename):
+	"""Read an NDJSON dump one event at a time."""
+	with open(filename, 'r', encoding='utf-8') as f:
+		for line in f:
+			if line.strip():
+				yield json.loads(line)
+
+
+def _write_events(events, fmt, out, indent, fields):
+	count = 0
+
+	if fmt == 'ndjson':
+		for count, event in enumerate(events, 1):
+			out.write(json.dumps({key: event[key] for key in fields}) + '\n')
+
+	elif fmt == 'csv':
+		writer = csv.writer(out)
+		writer.writerow(fields)
+		for count, event in enumerate(events, 1):
+			writer.writerow(['' if event[key] is None else event[key] for key in fields])
+
+	elif fmt == 'json':
+		# Byte-for-byte what json.dump(list_of_events, indent=indent) gives, one event at a time
+		padding = ' ' * indent
+		for count, event in enumerate(events, 1):
+			item = json.dumps({key: event[key] for key in fields}, indent=indent)
+			out.write(('[\n' if count == 1 else ',\n') + padding + item.replace('\n', '\n' + padding))
+		out.write('\n]' if count else '[]')
+
+	else:
+		raise USBRipError(f'Unknown output format: {fmt}')
+
+	return count
+
+
+# ----------------------------------------------------------
+# ------------------------- Writer -------------------------
+# ----------------------------------------------------------
+
+
+def write_columnar_dump(events, filename):
+	n = len(events)
+
+	times = {key: array('q', (_encode_time(event[key]) for event in events)) for key in _TIME_COLUMNS}
+	conns = times['conn']
+
+	codes, dictionaries = {}, {}
+	for key in _STRING_COLUMNS:
+		lookup = {}
+		codes[key] = array('I', (
+			0 if event[key] is None else lookup.setdefault(event[key], len(lookup) + 1)
+			for event in events
+		))
+		dictionaries[key] = list(lookup)  # dicts keep insertion order, i.e. the order of the codes
+
+	with open(filename, 'wb') as f:
+		f.write(_HEADER.pack(MAGIC, VERSION, n, min(conns, default=0), max(conns, default=0)))
+
+		for key in _TIME_COLUMNS:
+			_write_array(f, times[key])
+
+		for key in _STRING_COLUMNS:
+			_write_array(f, codes[key])
+		_pad(f)
+
+		for key in _STRING_COLUMNS:
+			blobs = [s.encode('utf-8') for s in dictionaries[key]]
+
+			offsets = array('I', [0])
+			for blob in blobs:
+				offsets.append(offsets[-1] + len(blob))
+
+			_write_array(f, array('I', [len(blobs)]))
+			_write_array(f, offsets)
+			f.write(b''.join(blobs))
+			_pad(f)
+
+
+def _write_array(f, arr):
+	if not _NATIVE:
+		arr = array(arr.typecode, arr)
+		arr.byteswap()
+	arr.tofile(f)
+
+
+def _pad(f):
+	f.write(b'\x00' * (-f.tell() % 8))
+
+
+# ----------------------------------------------------------
+# ------------------------- Reader -------------------------
+# ----------------------------------------------------------
+
+
+class ColumnarDump:
+	"""
+	Memory-mapped columnar event dump. Sieves are evaluated over the columns and
+	only the events that make it to the output are turned into dicts.
+	"""
+
+	def __init__(self, filename):
+		self._file = open(filename, 'rb')
+		self._views = []
+
+		try:
+			self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:  # empty file
+			self._file.close()
+			raise USBRipError(f'Not a columnar event dump: "{filename}"')
+
+		try:
+			self._load()
+		except (struct.error, ValueError, IndexError, UnicodeDecodeError) as e:
+			self.close()
+			raise USBRipError(f'Corrupted columnar event dump: "{filename}"', errors={'initial_error': str(e)})
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, i):
+		return self.event(i)
+
+	def close(self):
+		for view in self._views:
+			view.release()
+		self._views = []
+		self._mm.close()
+		self._file.close()
+
+	def _load(self):
+		magic, version, self.count, self.min_time, self.max_time = _HEADER.unpack_from(self._mm, 0)
+		if magic != MAGIC:
+			raise ValueError('bad magic')
+		if version != VERSION:
+			raise ValueError(f'unsupported version: {version}')
+
+		n, pos = self.count, _HEADER.size
+
+		self._times = {}
+		for key in _TIME_COLUMNS:
+			self._times[key], pos = self._column('q', pos, n)
+
+		self._codes = {}
+		for key in _STRING_COLUMNS:
+			self._codes[key], pos = self._column('I', pos, n)
+		pos += -pos % 8
+
+		# Dictionaries only hold distinct values, so decoding them up front is cheap
+		self._dictionaries = {}
+		for key in _STRING_COLUMNS:
+			(size,), pos = self._column('I', pos, 1)
+			offsets, pos = self._column('I', pos, size + 1)
+			blob = self._mm[pos:pos+offsets[-1]]
+			self._dictionaries[key] = [None] + [blob[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(size)]
+			pos += offsets[-1]
+			pos += -pos % 8
+
+	def _column(self, typecode, pos, n):
+		end = pos + n * array(typecode).itemsize
+		if end > len(self._mm):
+			raise ValueError('truncated column')
+
+		if _NATIVE:
+			view = memoryview(self._mm)[pos:end].cast(typecode)
+			self._views.append(view)
+		else:
+			view = array(typecode, self._mm[pos:end])
+			view.byteswap()
+
+		return (view, end)
+
+	def event(self, i):
+		event = {}
+		for key in _FIELDS:
+			if key in self._times:
+				event[key] = _decode_time(self._times[key][i])
+			else:
+				event[key] = self._dictionaries[key][self._codes[key][i]]
+		return event
+
+	def __iter__(self):
+		return (self.event(i) for i in range(self.count))
+
+	def conn_times(self):
+		"""The connection times as stored (see _encode_time, -1 for none), in event order."""
+		return self._times['conn']
+
+	def conn_bounds(self, prefix):
+		"""Lowest and highest conn_times() value that a date prefix matches (None if none can)."""
+		return _date_range(prefix)
+
+	def find(self, query, start, step):
+		"""
+		Index of the first event from start on (walking by step) with a value containing query
+		(case-insensitive), None if there is none. Strings are matched once per dictionary
+		entry and times are decoded only if query can occur in a date, no event is decoded.
+		"""
+		query = query.lower()
+
+		columns = []
+		for key in _STRING_COLUMNS:
+			dictionary = self._dictionaries[key]
+			codes = {code for code in range(1, len(dictionary)) if query in dictionary[code].lower()}
+			if codes:
+				columns.append((self._codes[key], codes))
+
+		times = []
+		if not query.strip('0123456789-:? '):
+			times = [self._times[key] for key in _TIME_COLUMNS]
+
+		i = start
+		while 0 <= i < self.count:
+			if any(col[i] in codes for col, codes in columns) or any(query in (_decode_time(col[i]) or '') for col in times):
+				return i
+			i += step
+
+		return None
+
+	def select(self, sieve):
+		"""Same semantics as usbevents._filter_events, evaluated over the columns."""
+		if sieve is None or sieve == {'external': False, 'dates': [], 'fields': {}, 'number': -1}:
+			return self  # nothing to filter, events are decoded when accessed
+
+		conn, disconn = self._times['conn'], self._times['disconn']
+		rows = range(self.count)
+
+		if sieve['external']:
+			rows = [i for i in rows if disconn[i] != -1]
+
+		if sieve['dates']:
+			ranges = [
+				r for r in map(_date_range, sieve['dates'])
+				if r is not None and r[0] <= self.max_time and r[1] >= self.min_time
+			]
+			rows = [i for i in rows if any(lo <= conn[i] <= hi for lo, hi in ranges)]
+
+		if sieve['fields']:
+			wanted = []
+			for key, vals in sieve['fields'].items():
+				dictionary = self._dictionaries[key]
+				wanted_codes = {code for code in range(1, len(dictionary)) if dictionary[code] in vals}
+				if wanted_codes:
+					wanted.append((self._codes[key], wanted_codes))
+
+			rows = [i for i in rows if any(codes[i] in wanted_codes for codes, wanted_codes in wanted)]
+
+		rows = sorted(rows, key=conn.__getitem__)
+
+		# Identical events are shown once, like the JSON dump set operations do
+		number = sieve['number']
+		if number == 0:
+			return []
+
+		selected = {}
+		for i in (reversed(rows) if number > -1 else rows):
+			selected.setdefault(tuple(self.event(i).items()), None)
+			if len(selected) == number:
+				break
+
+		events_to_show = [dict(items) for items in selected]
+		if number > -1:
+			events_to_show.reverse()
+			if len(events_to_show) < number and events_to_show:
+				print_warning(
+					f'USB history has only {len(events_to_show)} entries instead of requested {number}, '
+					f'displaying all of them...'
+				)
+
+		elif number < -1 and events_to_show:
+			print_warning(
+				f'usbrip can\'t handle dark matter \"--number={number}\", so it will show '
+				f'all {len(events_to_show)} USB history entries available'
+			)
+
+		return events_to_show
+
+
+# ----------------------------------------------------------
+# ----------------------- Utilities ------------------------
+# ----------------------------------------------------------
+
+
+def _encode_time(date):
+	if date is None:
+		return -1
+
+	if date.startswith('????'):
+		date = '0000' + date[4:]
+
+	if not _RE_TIME.match(date):
+		raise USBRipError(f'Unsupported event date format: "{date}"')
+
+	return int(date[0:4] + date[5:7] + date[8:10] + date[11:13] + date[14:16] + date[17:19])
+
+
+def _decode_time(t):
+	if t == -1:
+		return None
+
+	s = f'{t:014d}'
+	year = '????' if s[0:4] == '0000' else s[0:4]
+	return f'{year}-{s[4:6]}-{s[6:8]} {s[8:10]}:{s[10:12]}:{s[12:14]}'
+
+
+def _date_range(prefix):
+	"""Integer range of the times whose string form starts with the prefix (None if nothing can match)."""
+	if len(prefix) > len(_TIME_LOWEST):
+		return None
+
+	if prefix.startswith('?'):
+		if prefix[:4].strip('?'):
+			return None
+		prefix = '0000' + prefix[4:]
+
+	lo = prefix + _TIME_LOWEST[len(prefix):]
+	hi = prefix + _TIME_HIGHEST[len(prefix):]
+	if not _RE_TIME.match(lo):
+		return None
+
+	return (_encode_time(lo), _encode_time(hi))
@@ -0,0 +1,683 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""LICENSE
+
+Copyright (C) 2020 Sam Freeside
+
+This file is part of usbrip.
+
+usbrip is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+usbrip is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with usbrip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Sam Freeside (@snovvcrash)'
+__email__  = 'snovvcrash@protonmail[.]ch'
+__site__   = 'https://github.com/snovvcrash/usbrip'
+__brief__  = 'System log sources'
+
+import bz2
+import itertools
+import lzma
+import os
+import queue
+import re
+import select
+import shutil
+import stat
+import subprocess
+import threading
+import time
+import zlib
+
+from usbrip.lib.utils.debug import StageStats
+
+
+# ----------------------------------------------------------
+# --------------------- Log Block Reader -------------------
+# ----------------------------------------------------------
+
+
+# Rotated log extensions and the standard library decompressors for them
+DECOMPRESSORS = {
+	'.gz':  lambda: zlib.decompressobj(zlib.MAX_WBITS | 16),  # gzip header and trailer
+	'.xz':  lzma.LZMADecompressor,
+	'.bz2': bz2.BZ2Decompressor
+}
+
+BLOCK_SIZE     = 1 << 20  # 1 MiB of raw (compressed) input per read
+QUEUE_SIZE     = 8        # max inflated blocks buffered ahead of the parser (per source)
+PREFETCH_DEPTH = 2        # max sources being read ahead of the one being parsed
+
+
+def is_compressed(filename):
+	return os.path.splitext(filename)[1] in DECOMPRESSORS
+
+
+class LogBlockReader:
+	"""
+	Read a (possibly compressed) log file in large blocks on a background thread.
+
+	Iterating over the reader yields (nbytes, lines) pairs, where nbytes is the
+	amount of raw file input consumed (see iter_raw_blocks) and lines is a list of complete lines (bytes,
+	without line terminators). Decompression (zlib, lzma and bz2 release the GIL)
+	overlaps with whatever the consumer does with the lines. Errors that occur on
+	the background thread (including failure to open the file) are re-raised in
+	the consumer's thread when they are reached. If end is given, no raw input past
+	that offset is read.
+	"""
+
+	_EOF = None
+
+	def __init__(self, filename, *, block_size=BLOCK_SIZE, queue_size=QUEUE_SIZE, stats=None, end=None):
+		self.filename = filename
+
+		try:
+			self.size = os.path.getsize(filename) if end is None else end
+		except OSError:
+			self.size = None
+
+		self._end = end
+
+		self._file = None
+		self._block_size = block_size
+		self._queue = queue.Queue(maxsize=queue_size)
+		self.stats = stats if stats is not None else StageStats()
+		self._error = None
+		self._closed = False
+
+		ext = os.path.splitext(filename)[1]
+		self._new_decompressor = DECOMPRESSORS.get(ext)
+
+		self._thread = threading.Thread(target=self._produce, daemon=True)
+		self._thread.start()
+
+	def __iter__(self):
+		stats = self.stats
+		tail = b''
+
+		while True:
+			start = time.perf_counter()
+			item = self._queue.get()
+			stats.add('parser starved', time.perf_counter() - start)
+
+			if item is LogBlockReader._EOF:
+				break
+
+			nbytes, data = item
+			lines = (tail + data).split(b'\n')
+			tail = lines.pop()
+
+			yield (nbytes, lines)
+
+		self._thread.join()
+
+		if self._error is not None:
+			raise self._error
+
+		if tail:
+			yield (0, [tail])
+
+	def close(self):
+		self._closed = True
+
+		# Unblock the producer if it is waiting on a full queue
+		while self._thread.is_alive():
+			try:
+				self._queue.get_nowait()
+			except queue.Empty:
+				self._thread.join(0.01)
+
+	def _put(self, item):
+		start = time.perf_counter()
+		self._queue.put(item)
+		self.stats.add('reader blocked', time.perf_counter() - start)
+
+	def _produce(self):
+		try:
+			self._file = open(self.filename, 'rb')
+
+			for block in iter_raw_blocks(self._file, self._new_decompressor, self._block_size, self.stats, end=self._end):
+				if self._closed:
+					break
+				self._put(block)
+
+		except Exception as e:
+			self._error = e
+
+		finally:
+			if self._file is not None:
+				self._file.close()
+			self._queue.put(LogBlockReader._EOF)
+
+
+def iter_raw_blocks(file, new_decompressor, block_size, stats, *, end=None):
+	"""
+	Yield (nbytes, data) pairs of raw input consumed and (decompressed) data produced. Data
+	is never longer than block_size: a raw chunk that inflates to more is yielded in several
+	pieces, its nbytes goes with the first one. Raw input stops at offset end, if given.
+	"""
+	decompressor = new_decompressor() if new_decompressor else None
+	fresh = True
+	remaining = end
+
+	while True:
+		start = time.perf_counter()
+		chunk = file.read(block_size if remaining is None else min(block_size, remaining))
+		stats.add('read', time.perf_counter() - start)
+
+		if not chunk:
+			break
+
+		nbytes = len(chunk)
+		if remaining is not None:
+			remaining -= nbytes
+
+		if decompressor is None:
+			yield (nbytes, chunk)
+			continue
+
+		start = time.perf_counter()
+
+		data, size = [], 0
+		while True:
+			if fresh:
+				chunk = chunk.lstrip(b'\x00')  # zero padding between/after streams
+				if not chunk:
+					break
+				fresh = False
+
+			max_length = block_size - size
+			piece = decompressor.decompress(chunk, max_length)
+			data.append(piece)
+			size += len(piece)
+
+			# Concatenated streams (e.g. multi-member gzip) start over with a fresh decompressor
+			if decompressor.eof:
+				chunk = decompressor.unused_data
+				decompressor = new_decompressor()
+				fresh = True
+			else:
+				# zlib hands back the input it has not consumed, lzma and bz2 keep it (fed with b'')
+				chunk = getattr(decompressor, 'unconsumed_tail', b'')
+				if len(piece) < max_length and not chunk:
+					break  # all of the input is consumed
+
+			if size >= block_size:
+				stats.add('decompress', time.perf_counter() - start)
+				yield (nbytes, b''.join(data))
+
+				start = time.perf_counter()
+				nbytes, data, size = 0, [], 0
+
+		stats.add('decompress', time.perf_counter() - start)
+		yield (nbytes, b''.join(data))
+
+
+# ----------------------------------------------------------
+# -------------------- Grep Line Reader --------------------
+# ----------------------------------------------------------
+
+
+# Every line usbrip cares about contains this fixed string (see usbevents._classify_log_line)
+PREFILTER_PATTERN = ' usb '
+
+
+def find_prefilter_tool():
+	"""Return (name, path) of the external pre-filter to use, or None if there is none on the host."""
+	for name in ('rg', 'grep'):
+		path = shutil.which(name)
+		if path:
+			return (name, path)
+
+	return None
+
+
+class GrepLineReader:
+	"""
+	Pre-select candidate lines of a (possibly compressed) log file with ripgrep or grep.
+
+	Iterates exactly like LogBlockReader, but only the lines containing PREFILTER_PATTERN
+	ever reach Python. Rotated logs are decompressed with the same decompressors as
+	LogBlockReader uses and fed to the tool's stdin from a background thread (rg -z would
+	rely on external gzip/xz/bzip2 binaries and match nothing if one of them were missing).
+	So is a file that may only be read up to end.
+	"""
+
+	def __init__(self, filename, tool, *, block_size=BLOCK_SIZE, stats=None, end=None):
+		self.filename = filename
+
+		try:
+			self.size = os.path.getsize(filename) if end is None else end
+		except OSError:
+			self.size = None
+
+		self.stats = stats if stats is not None else StageStats()
+		self._end = end
+		self._tool = tool
+		self._block_size = block_size
+		self._proc = None
+		self._feeder = None
+		self._error = None
+
+		# Start right away so that prefetched sources are being filtered in the background
+		try:
+			self._spawn()
+		except OSError as e:
+			self._error = e
+
+	def __iter__(self):
+		if self._proc is None:
+			raise self._error
+
+		stats = self.stats
+		stdout = self._proc.stdout
+		tail = b''
+
+		while True:
+			start = time.perf_counter()
+			data = stdout.read1(self._block_size)
+			stats.add('parser starved', time.perf_counter() - start)
+
+			if not data:
+				break
+
+			lines = (tail + data).split(b'\n')
+			tail = lines.pop()
+
+			yield (0, lines)
+
+		errmsg = self._proc.stderr.read().decode('utf-8', errors='ignore').strip()
+		returncode = self._proc.wait()
+
+		if self._feeder is not None:
+			self._feeder.join()
+			if self._error is not None:
+				raise self._error
+
+		if returncode > 1:  # 0 -- matches found, 1 -- no matches
+			if 'Permission denied' in errmsg:
+				raise PermissionError(errmsg)
+			if 'No such file' in errmsg:
+				raise FileNotFoundError(errmsg)
+			raise OSError(f'{self._tool[0]} exited with code {returncode}: {errmsg}')
+
+		yield (self.size or 0, [tail] if tail else [])
+
+	def close(self):
+		if self._proc is None:
+			return
+
+		if self._proc.poll() is None:
+			self._proc.kill()
+			self._proc.wait()
+
+		self._proc.stdout.close()
+		self._proc.stderr.close()
+
+		if self._feeder is not None:
+			self._feeder.join()
+
+	def _spawn(self):
+		name, path = self._tool
+		env = dict(os.environ, LC_ALL='C')  # byte-oriented matching, no multibyte locale overhead
+
+		if name == 'rg':
+			cmd = [path, '--no-config', '-a', '-F', '--no-line-number', '--no-filename', '--color', 'never', '--', PREFILTER_PATTERN]
+		else:
+			cmd = [path, '-a', '-F', '-e', PREFILTER_PATTERN]
+
+		if is_compressed(self.filename) or self._end is not None:
+			file = open(self.filename, 'rb')
+
+			self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+
+			self._feeder = threading.Thread(target=self._feed, args=(file,), daemon=True)
+			self._feeder.start()
+
+		else:
+			self._proc = subprocess.Popen(cmd + [self.filename], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+
+	def _feed(self, file):
+		new_decompressor = DECOMPRESSORS.get(os.path.splitext(self.filename)[1])
+
+		try:
+			for _, data in iter_raw_blocks(file, new_decompressor, self._block_size, self.stats, end=self._end):
+				self._proc.stdin.write(data)
+
+		except BrokenPipeError:
+			pass
+
+		except Exception as e:
+			self._error = e
+
+		finally:
+			file.close()
+
+			try:
+				self._proc.stdin.close()
+			except BrokenPipeError:
+				pass
+
+
+# ----------------------------------------------------------
+# -------------------- Log Source Pipeline -----------------
+# ----------------------------------------------------------
+
+
+class LogSourcePipeline:
+	"""
+	Iterate over LogBlockReaders for several log files in order, keeping up to
+	`depth` of the following sources prefetching and decompressing in the
+	background while the current one is being parsed. `ends` maps filenames that
+	must not be read to the end to the offset to stop at.
+
+	Every reader has a bounded queue of blocks holding at most block_size bytes of
+	decompressed data each, so memory stays capped at roughly depth * queue_size *
+	block_size bytes (plus the lines being parsed) no matter how large the sources are.
+	"""
+
+	def __init__(self, filenames, *, depth=PREFETCH_DEPTH, stats=None, prefilter_tool=None, ends=None):
+		self._filenames = list(filenames)
+		self._ends = ends or {}
+		self._depth = max(depth, 1)
+		self._readers = []
+		self._prefilter_tool = prefilter_tool
+		self.stats = stats if stats is not None else StageStats()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def __iter__(self):
+		pending = iter(self._filenames)
+
+		for filename in itertools.islice(pending, self._depth):
+			self._readers.append(self._open(filename))
+
+		while self._readers:
+			reader = self._readers[0]
+			yield reader
+
+			reader.close()
+			self._readers.pop(0)
+
+			for filename in itertools.islice(pending, 1):
+				self._readers.append(self._open(filename))
+
+	def _open(self, filename):
+		end = self._ends.get(filename)
+
+		if self._prefilter_tool:
+			return GrepLineReader(filename, self._prefilter_tool, stats=self.stats, end=end)
+
+		return LogBlockReader(filename, stats=self.stats, end=end)
+
+	def close(self):
+		for reader in self._readers:
+			reader.close()
+
+		self._readers = []
+
+
+# ----------------------------------------------------------
+# ---------------------- Kernel Ring Buffer ----------------
+# ----------------------------------------------------------
+
+
+KMSG_PATH = '/dev/kmsg'
+KMSG_RECORD_SIZE = 8192  # one read() of /dev/kmsg returns exactly one record (max 1 KiB text + dictionary)
+
+_RE_KMSG_ESCAPE = re.compile(rb'\\x([0-9a-fA-F]{2})')
+
+
+def get_boot_time():
+	"""Wall-clock time of the moment CLOCK_MONOTONIC (the kmsg timestamp base) was zero."""
+	return time.time() - time.clock_gettime(time.CLOCK_MONOTONIC)
+
+
+def iter_kmsg_records(path=KMSG_PATH, *, follow=False):
+	"""
+	Yield (timestamp_usec, message) pairs from /dev/kmsg or from a file in the same format
+	("<priority>,<sequence>,<timestamp_usec>,<flags>[,...];<message>" followed by optional
+	dictionary lines that start with a space).
+
+	When reading the device without follow, iteration stops once the ring buffer has been
+	drained; with follow, records already in the buffer are skipped and iteration blocks
+	waiting for new ones.
+	"""
+	if stat.S_ISCHR(os.stat(path).st_mode):
+		records = _iter_kmsg_device(path, follow)
+	elif follow:
+		records = (line.rstrip(b'\n') for line in follow_file(path) if not line.startswith(b' '))
+	else:
+		records = _iter_kmsg_file(path)
+
+	for record in records:
+		header, sep, message = record.partition(b';')
+		if not sep:
+			continue
+
+		fields = header.split(b',')
+		if len(fields) < 4:
+			continue
+
+		try:
+			timestamp_usec = int(fields[2])
+		except ValueError:
+			continue
+
+		message = message.split(b'\n', 1)[0]  # drop dictionary lines
+		message = _RE_KMSG_ESCAPE.sub(lambda m: bytes((int(m.group(1), 16),)), message)
+
+		yield (timestamp_usec, message.decode('utf-8', errors='ignore'))
+
+
+def _iter_kmsg_device(path, follow):
+	flags = os.O_RDONLY if follow else os.O_RDONLY | os.O_NONBLOCK
+	fd = os.open(path, flags)
+
+	if follow:
+		os.lseek(fd, 0, os.SEEK_END)
+
+	try:
+		while True:
+			try:
+				record = os.read(fd, KMSG_RECORD_SIZE)
+			except BlockingIOError:  # EAGAIN: ring buffer drained
+				break
+			except BrokenPipeError:  # EPIPE: records were overwritten before we could read them
+				continue
+
+			if not record:
+				break
+
+			yield record
+
+	finally:
+		os.close(fd)
+
+
+def _iter_kmsg_file(path):
+	with open(path, 'rb') as f:
+		for line in f:
+			if line.startswith(b' '):  # dictionary line of the previous record
+				continue
+
+			yield line.rstrip(b'\n')
+
+
+# ----------------------------------------------------------
+# ------------------------ Follow Mode ---------------------
+# ----------------------------------------------------------
+
+
+FOLLOW_POLL_INTERVAL = 1.0  # seconds between checks for log rotation (and between reads without inotify)
+
+
+class _Inotify:
+	"""Minimal ctypes binding to Linux inotify (there is none in the standard library)."""
+
+	IN_MODIFY      = 0x00000002
+	IN_ATTRIB      = 0x00000004
+	IN_DELETE_SELF = 0x00000400
+	IN_MOVE_SELF   = 0x00000800
+
+	def __init__(self):
+		import ctypes.util  # only follow mode needs it, keep it off the startup path
+
+		self._ctypes = ctypes
+		self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+		self.fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+		if self.fd < 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno))
+
+	def add_watch(self, path, mask):
+		wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+		if wd < 0:
+			errno = self._ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno), path)
+
+		return wd
+
+	def rm_watch(self, wd):
+		self._libc.inotify_rm_watch(self.fd, wd)  # fails only if the watch is gone already (file deleted)
+
+	def wait(self, timeout):
+		ready, _, _ = select.select([self.fd], [], [], timeout)
+		if ready:
+			try:
+				while os.read(self.fd, 4096):  # drain, the events themselves are not needed
+					pass
+			except BlockingIOError:
+				pass
+
+		return bool(ready)
+
+	def close(self):
+		os.close(self.fd)
+
+
+def complete_lines_size(path, *, block_size=BLOCK_SIZE):
+	"""Size of a (growing) log file up to and including its last line terminator."""
+	with open(path, 'rb') as f:
+		end = f.seek(0, os.SEEK_END)
+
+		while end > 0:
+			start = max(end - block_size, 0)
+			f.seek(start)
+			pos = f.read(end - start).rfind(b'\n')
+			if pos != -1:
+				return start + pos + 1
+			end = start
+
+	return 0
+
+
+def follow_file(path, *, offset=None, poll_interval=FOLLOW_POLL_INTERVAL):
+	"""
+	Yield lines (bytes, with line terminators) appended to a log file from now on (or from
+	offset, if given), like "tail -F": the file is reopened from the beginning when it gets
+	rotated, and read from the beginning again when it is truncated in place (copytruncate). Waits are driven by inotify when it is available, otherwise the file is polled.
+	"""
+	try:
+		notifier = _Inotify()
+	except (OSError, AttributeError):
+		notifier = None
+
+	f = open(path, 'rb')
+	if offset is None:
+		f.seek(0, os.SEEK_END)
+	else:
+		f.seek(offset)
+
+	wd = None
+
+	def watch(f):
+		nonlocal wd
+		if notifier is not None:
+			if wd is not None:
+				notifier.rm_watch(wd)  # the rotated file (e.g. syslog.1) is of no interest anymore
+				wd = None
+			try:
+				wd = notifier.add_watch(path, _Inotify.IN_MODIFY | _Inotify.IN_ATTRIB | _Inotify.IN_MOVE_SELF | _Inotify.IN_DELETE_SELF)
+			except OSError:
+				pass
+
+		return os.fstat(f.fileno()).st_ino
+
+	inode = watch(f)
+	tail = b''
+
+	try:
+		while True:
+			data = f.read()
+			if data:
+				lines = (tail + data).split(b'\n')
+				tail = lines.pop()
+				for line in lines:
+					yield line + b'\n'
+				continue
+
+			try:
+				rotated = os.stat(path).st_ino != inode
+			except FileNotFoundError:
+				rotated = False  # rotated away, the new file has not been created yet
+
+			if rotated:
+				f.close()
+				f = open(path, 'rb')
+				inode = watch(f)
+				tail = b''  # an unterminated last line of the old file must not be glued to the new one
+				continue
+
+			if os.fstat(f.fileno()).st_size < f.tell():  # truncated in place (logrotate's copytruncate)
+				f.seek(0)
+				tail = b''
+				continue
+
+			if notifier is not None:
+				notifier.wait(poll_interval)
+			else:
+				time.sleep(poll_interval)
+
+	finally:
+		f.close()
+		if notifier is not None:
+			notifier.close()
+
+
+class CommandFollower:
+	"""
+	Lines (str) printed by a long-running command such as "journalctl -f". The command is
+	started right away; close() terminates it (from any thread), which ends the iteration.
+	"""
+
+	def __init__(self, cmd):
+		self._proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+	def __iter__(self):
+		try:
+			for line in self._proc.stdout:
+				yield line.decode('utf-8', errors='ignore')
+		finally:
+			self.close()
+			self._proc.stdout.close()
+
+	def close(self):
+		if self._proc.poll() is None:
+			self._proc.terminate()
+		self._proc.wait()
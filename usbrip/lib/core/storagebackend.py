@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""LICENSE
+
+Copyright (C) 2020 Sam Freeside
+
+This file is part of usbrip.
+
+usbrip is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+usbrip is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with usbrip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Sam Freeside (@snovvcrash)'
+__email__  = 'snovvcrash@protonmail[.]ch'
+__site__   = 'https://github.com/snovvcrash/usbrip'
+__brief__  = 'USB Storage backends'
+
+import lzma
+import os
+import stat
+import subprocess
+from abc import ABC, abstractmethod
+
+from usbrip.lib.core.common import USBRipError
+from usbrip.lib.core.common import print_info
+
+
+# ----------------------------------------------------------
+# ----------------------- Error codes ----------------------
+# ----------------------------------------------------------
+
+
+WRONG_PASSWORD_ERROR = -1
+PERMISSION_ERROR     = -2
+UNKNOWN_ERROR        = -3
+
+
+# ----------------------------------------------------------
+# -------------------- Storage Backends --------------------
+# ----------------------------------------------------------
+
+
+class StorageBackend(ABC):
+	"""
+	Where the objects of a storage (segments, manifest, index) are kept and how they are
+	packed. An object is a named blob in the storage directory; put() must replace it
+	atomically, so that readers only ever see a complete object.
+	"""
+
+	name = None
+	extension = None
+	encrypted = False
+
+	def __init__(self, password=None, compression_level='5'):
+		self.password = password
+		self.compression_level = compression_level
+
+	@abstractmethod
+	def put(self, path, member_name, data):
+		...
+
+	@abstractmethod
+	def get(self, path):
+		...
+
+	def list(self, directory):
+		return sorted(
+			filename for filename in os.listdir(directory)
+			if filename.endswith(self.extension) and os.path.isfile(os.path.join(directory, filename))
+		)
+
+	def stat(self, path):
+		return os.stat(path)
+
+	def delete(self, path):
+		if os.path.exists(path):
+			os.remove(path)
+
+	def _replace(self, path, write):
+		"""Have write() produce the object next to its final path and atomically move it in."""
+		tmp_path = path + '.new'
+		if os.path.exists(tmp_path):  # leftover of an interrupted writer
+			os.remove(tmp_path)
+
+		try:
+			write(tmp_path)
+		except PermissionError as e:
+			raise USBRipError('Permission denied. Retry with sudo', errors={'errcode': PERMISSION_ERROR, 'initial_error': str(e)})
+
+		os.chmod(tmp_path, stat.S_IRUSR | stat.S_IWUSR)  # 600
+
+		# The data must be on disk before the rename is, or a crash can leave an empty object behind
+		fsync(tmp_path)
+		os.replace(tmp_path, path)
+		fsync(os.path.dirname(path) or '.')
+
+
+class SevenZipBackend(StorageBackend):
+	"""Password-protected 7-Zip archives (AES-256, encrypted headers), plaintext is piped through 7z."""
+
+	name = '7z'
+	extension = '.7z'
+	encrypted = True
+
+	def put(self, path, member_name, data):
+		print_info(f'Creating storage (7-Zip): "{path}"')
+
+		def write(tmp_path):
+			cmd = [
+				'7z',
+				'a',
+				'-t7z',  # the type can not be inferred from the ".new" extension
+				tmp_path,
+				'-si' + member_name,
+				'-mhe=on',
+				'-p' + self.password,
+				'-mx=' + self.compression_level
+			]
+
+			out = _7zip_subprocess_handler(cmd, data).decode('utf-8')
+			if 'Everything is Ok' not in out:
+				raise USBRipError(
+					'Undefined behaviour while creating storage',
+					errors={'errcode': UNKNOWN_ERROR, 'initial_error': out}
+				)
+
+		self._replace(path, write)
+
+	def get(self, path):
+		print_info(f'Unpacking archive: "{path}"')
+
+		cmd = [
+			'7z',
+			'e',
+			path,
+			'-p' + self.password,
+			'-so'
+		]
+
+		return _7zip_subprocess_handler(cmd)
+
+
+class LZMABackend(StorageBackend):
+	"""
+	In-process xz compression, no encryption: for storages that sit on an already encrypted
+	volume. There is no subprocess per object and the password is ignored.
+	"""
+
+	name = 'lzma'
+	extension = '.xz'
+
+	def put(self, path, member_name, data):
+		print_info(f'Creating storage (xz): "{path}"')
+
+		def write(tmp_path):
+			with open(tmp_path, 'wb') as f:
+				f.write(lzma.compress(data, preset=int(self.compression_level)))
+
+		self._replace(path, write)
+
+	def get(self, path):
+		print_info(f'Unpacking archive: "{path}"')
+
+		try:
+			with open(path, 'rb') as f:
+				return lzma.decompress(f.read())
+		except PermissionError as e:
+			raise USBRipError('Permission denied. Retry with sudo', errors={'errcode': PERMISSION_ERROR, 'initial_error': str(e)})
+		except (OSError, lzma.LZMAError) as e:
+			raise USBRipError(
+				f'Failed to read xz archive: "{path}"',
+				errors={'errcode': UNKNOWN_ERROR, 'initial_error': str(e)}
+			)
+
+
+BACKENDS = {backend.name: backend for backend in (SevenZipBackend, LZMABackend)}
+
+
+def fsync(path):
+	"""Flush a file (or a directory, i.e. the renames in it) to disk."""
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+def get_backend(name, password=None, compression_level='5'):
+	try:
+		return BACKENDS[name](password, compression_level)
+	except KeyError:
+		raise USBRipError(
+			f'Unknown storage backend: "{name}" (options: {", ".join(BACKENDS)})',
+			errors={'errcode': UNKNOWN_ERROR}
+		)
+
+
+# ----------------------------------------------------------
+# ------------------------- 7-Zip --------------------------
+# ----------------------------------------------------------
+
+
+def _7zip_subprocess_handler(cmd, data=None):
+	try:
+		proc = subprocess.run(cmd, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+	except subprocess.CalledProcessError as e:
+		# With -so/-si the messages go to stderr, otherwise to stdout
+		initial_error = (e.stderr or b'').decode('utf-8', 'replace')
+		if not initial_error.strip():
+			initial_error = (e.stdout or b'').decode('utf-8', 'replace')
+
+		if 'Wrong password?' in initial_error:
+			errmsg = 'Can not open encrypted archive. Wrong password?'
+			errcode = WRONG_PASSWORD_ERROR
+		elif 'can not open output file' in initial_error:
+			errmsg = 'Permission denied. Retry with sudo'
+			errcode = PERMISSION_ERROR
+		else:
+			errmsg = 'Something went wrong while working with 7-Zip archive'
+			errcode = UNKNOWN_ERROR
+
+		raise USBRipError(errmsg, errors={'errcode': errcode, 'initial_error': initial_error})
+
+	except FileNotFoundError as e:
+		raise USBRipError(
+			'7-Zip is not installed (p7zip-full)',
+			errors={'errcode': UNKNOWN_ERROR, 'initial_error': str(e)}
+		)
+
+	return proc.stdout
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""LICENSE
+
+Copyright (C) 2020 Sam Freeside
+
+This file is part of usbrip.
+
+usbrip is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+usbrip is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with usbrip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Sam Freeside (@snovvcrash)'
+__email__  = 'snovvcrash@protonmail[.]ch'
+__site__   = 'https://github.com/snovvcrash/usbrip'
+__brief__  = 'USB events daemon'
+
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import threading
+from collections import defaultdict
+from io import StringIO
+from subprocess import check_output
+
+from usbrip.lib.core.usbevents import SessionTracker
+from usbrip.lib.core.usbevents import SYSLOG_PATHS
+from usbrip.lib.core.usbevents import _filter_events
+from usbrip.lib.core.usbevents import _is_violation
+from usbrip.lib.core.usbevents import _resolve_log_source
+from usbrip.lib.core.usbevents import _get_filtered_history
+from usbrip.lib.core.usbevents import _read_log_file
+from usbrip.lib.core.usbevents import _read_kmsg
+from usbrip.lib.core.usbevents import _follow_journal
+from usbrip.lib.core.usbevents import _follow_syslog
+from usbrip.lib.core.usbevents import _follow_kmsg
+from usbrip.lib.core.logsource import KMSG_PATH
+from usbrip.lib.core.logsource import complete_lines_size
+from usbrip.lib.core.common import DAEMON_SOCKET
+from usbrip.lib.core.common import USBRipError
+from usbrip.lib.core.common import print_info
+from usbrip.lib.core.common import print_warning
+from usbrip.lib.core.common import print_critical
+
+
+# ----------------------------------------------------------
+# ----------------------- USB Daemon -----------------------
+# ----------------------------------------------------------
+
+
+class USBDaemon:
+
+	_CLIENT_TIMEOUT = 30  # seconds
+
+	# -------------------- USB Daemon Serve --------------------
+
+	@staticmethod
+	def serve(socket_path=DAEMON_SOCKET, *, source='auto', max_events=None):
+		try:
+			source = _resolve_log_source(source)
+			filtered_history, follow, stop = _ingest(source)
+		except USBRipError as e:
+			print_critical(str(e), initial_error=e.errors['initial_error'])
+			return 1
+
+		index = EventIndex(keep=max_events)
+		for entry in filtered_history:
+			index.feed(*entry)
+
+		print_info(f'Ingested {len(index)} USB events')
+
+		try:
+			server = _bind(socket_path, index)
+		except USBRipError as e:
+			if stop is not None:
+				stop()
+			print_critical(str(e), initial_error=e.errors['initial_error'])
+			return 1
+
+		def update():
+			try:
+				for entry in follow:
+					index.feed(*entry)
+			except Exception as e:
+				print_critical(f'Failed to follow log source: {source}', initial_error=str(e))
+			else:
+				print_warning(f'Log source has been closed: {source}')
+
+		threading.Thread(target=update, daemon=True).start()
+
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # clean up the socket on "kill" too
+
+		print_info(f'Serving USB events from {source} on "{socket_path}" (press Ctrl-C to stop)')
+
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			print_info('Stopped serving')
+		finally:
+			if stop is not None:
+				stop()
+			server.server_close()
+			os.remove(socket_path)
+
+
+# ----------------------------------------------------------
+# ----------------------- Event Index ----------------------
+# ----------------------------------------------------------
+
+
+class EventIndex:
+	"""
+	In-memory event list kept up to date from log entries, with per-field inverted
+	indexes (value -> event positions) so that field sieves only touch matching events.
+	With keep, only about the latest keep events are held (see SessionTracker).
+	"""
+
+	_INDEXED_FIELDS = ('host', 'vid', 'pid', 'prod', 'manufact', 'serial', 'port')
+
+	def __init__(self, *, keep=None):
+		self._lock = threading.Lock()
+		self._tracker = SessionTracker(keep=keep)
+		self._index = {key: defaultdict(list) for key in EventIndex._INDEXED_FIELDS}
+		self._indexed = 0  # events before this position are indexed
+		self._dropped = 0  # tracker.dropped the positions are relative to
+
+	def __len__(self):
+		return len(self._tracker.all_events)
+
+	def feed(self, date, action, logline):
+		with self._lock:
+			self._tracker.feed(date, action, logline)
+
+	def handle(self, request):
+		"""Answer a request; the response is serialized under the lock as events keep changing."""
+		cmd = request['cmd']
+
+		with self._lock:
+			if cmd == 'ping':
+				response = {'ok': True, 'events': len(self)}
+
+			elif cmd == 'events':
+				response = {'ok': True, 'events': self._tracker.all_events}
+
+			elif cmd == 'history':
+				sieve = request.get('sieve')
+				response = {'ok': True, 'events': _filter_events(self._candidates(sieve), sieve)}
+
+			elif cmd == 'violations':
+				auth, sieve = request['auth'], request.get('sieve')
+				attributes = request.get('attributes') or list(auth.keys())
+				auth_sets = [set(auth[attr]) for attr in attributes]
+
+				violations = [
+					event
+					for event in self._tracker.all_events
+					if _is_violation(event, attributes, auth_sets)
+				]
+
+				response = {'ok': True, 'events': _filter_events(violations, sieve)}
+
+			else:
+				raise ValueError(f'Unknown command: {cmd}')
+
+			return json.dumps(response)
+
+	def _catch_up(self):
+		events = self._tracker.all_events
+
+		# Old events have been dropped and the positions shifted, index the remaining ones anew
+		if self._tracker.dropped != self._dropped:
+			self._index = {key: defaultdict(list) for key in EventIndex._INDEXED_FIELDS}
+			self._indexed = 0
+			self._dropped = self._tracker.dropped
+
+		# The latest connection may still be getting its product/manufacturer/serial lines
+		end = len(events) - (1 if self._tracker.pending else 0)
+
+		for pos in range(self._indexed, end):
+			for key in EventIndex._INDEXED_FIELDS:
+				val = events[pos][key]
+				if val is not None:
+					self._index[key][val].append(pos)
+
+		self._indexed = max(self._indexed, end)  # a connection that got late lines is pending again, but indexed already
+
+	def _candidates(self, sieve):
+		self._catch_up()
+
+		events = self._tracker.all_events
+		if not sieve or not sieve['fields']:
+			return events
+
+		positions = set(range(self._indexed, len(events)))  # not indexed yet
+		for key, vals in sieve['fields'].items():
+			for val in vals:
+				positions.update(self._index[key].get(val, ()))
+
+		return [events[pos] for pos in sorted(positions)]
+
+
+# ----------------------------------------------------------
+# ------------------------- Client -------------------------
+# ----------------------------------------------------------
+
+
+def query_daemon(request, socket_path=DAEMON_SOCKET):
+	"""Send a request to the running daemon; return None if there is no daemon to talk to."""
+	if not os.path.exists(socket_path):
+		return None
+
+	try:
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+			sock.settimeout(USBDaemon._CLIENT_TIMEOUT)
+			sock.connect(socket_path)
+			sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+			with sock.makefile('rb') as f:
+				response = f.readline()
+
+	except (ConnectionRefusedError, FileNotFoundError, PermissionError):
+		return None
+
+	except OSError as e:
+		raise USBRipError('Failed to communicate with usbrip daemon', errors={'initial_error': str(e)})
+
+	try:
+		response = json.loads(response)
+	except ValueError as e:
+		raise USBRipError('Invalid response from usbrip daemon', errors={'initial_error': str(e)})
+
+	if not response.get('ok'):
+		raise USBRipError('usbrip daemon failed to handle request', errors={'initial_error': response.get('error', '')})
+
+	return response
+
+
+# ----------------------------------------------------------
+# ----------------------- Utilities ------------------------
+# ----------------------------------------------------------
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+	def handle(self):
+		for line in self.rfile:  # one JSON request per line
+			try:
+				response = self.server.index.handle(json.loads(line))
+			except (ValueError, KeyError, TypeError) as e:
+				response = json.dumps({'ok': False, 'error': str(e)})
+
+			self.wfile.write(response.encode('utf-8') + b'\n')
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+def _bind(socket_path, index):
+	if os.path.exists(socket_path):
+		try:
+			alive = query_daemon({'cmd': 'ping'}, socket_path) is not None
+		except USBRipError:
+			alive = True  # something is listening there, but it is not talking our protocol
+
+		if alive:
+			raise USBRipError(f'usbrip daemon is already running: "{socket_path}"')
+
+		os.remove(socket_path)  # stale socket of a daemon that is gone
+
+	old_umask = os.umask(0o177)  # the socket must never be accessible by anyone but the owner
+	try:
+		server = _Server(socket_path, _RequestHandler)
+	except OSError as e:
+		raise USBRipError(f'Failed to bind to "{socket_path}"', errors={'initial_error': str(e)})
+	finally:
+		os.umask(old_umask)
+
+	os.chmod(socket_path, stat.S_IRUSR | stat.S_IWUSR)  # 600
+
+	server.index = index
+	return server
+
+
+def _ingest(source):
+	"""
+	Read the whole history of a log source; return it with a follower that continues right
+	after it and a function that stops the follower (None if there is nothing to stop).
+	"""
+	if source == 'journal':
+		print_info('Trying to run journalctl...')
+
+		try:
+			journalctl_out = check_output([
+				'journalctl',
+				'-o',
+				'short-iso-precise',
+				'--show-cursor'
+			]).decode('utf-8')
+		except Exception as e:
+			print_warning(f'Failed to run journalctl: {str(e)}')
+			return _ingest('syslog')
+
+		if '-- Logs begin at' not in journalctl_out:
+			print_warning(f'An error occurred when running journalctl: {journalctl_out}')
+			return _ingest('syslog')
+
+		print_info('Successfully ran journalctl')
+
+		cursor = None
+		last_line = journalctl_out.rstrip('\n').rsplit('\n', 1)[-1]
+		if last_line.startswith('-- cursor: '):
+			cursor = last_line[len('-- cursor: '):]
+
+		filtered_history = _read_log_file(None, log=StringIO(journalctl_out), total=journalctl_out.count('\n'))
+		return (filtered_history,) + _follow_journal(cursor)
+
+	elif source == 'syslog':
+		for path in SYSLOG_PATHS:
+			if os.path.isfile(path):
+				# The live file is read only up to here and the follower starts exactly at this offset,
+				# so that the lines appended while ingesting are parsed once, by the follower
+				offset = complete_lines_size(path)
+				return (_get_filtered_history(ends={os.path.abspath(path): offset}), _follow_syslog(path, offset), None)
+
+		raise USBRipError('None of log file types was found!')
+
+	elif source == 'kmsg':
+		return (_read_kmsg(KMSG_PATH), _follow_kmsg(KMSG_PATH), None)
+
+	raise USBRipError(f'Unknown log source: {source}')
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""LICENSE
+
+Copyright (C) 2020 Sam Freeside
+
+This file is part of usbrip.
+
+usbrip is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+usbrip is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with usbrip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Sam Freeside (@snovvcrash)'
+__email__  = 'snovvcrash@protonmail[.]ch'
+__site__   = 'https://github.com/snovvcrash/usbrip'
+__brief__  = 'USB event database'
+
+import json
+import os
+import sqlite3
+import stat
+
+from usbrip.lib.core.common import USBRipError
+from usbrip.lib.core.common import os_makedirs
+from usbrip.lib.core.common import print_info
+
+
+# ----------------------------------------------------------
+# -------------------- USB Event Database ------------------
+# ----------------------------------------------------------
+
+
+class USBEventDB:
+	"""
+	Persistent SQLite store of USB events.
+
+	Events are identified by everything but their disconnection date, so syncing the same
+	log window twice does not duplicate anything and a disconnection that shows up later
+	just fills in the stored event. Sieves (see usbevents._filter_events) compile to SQL
+	that is served by the indexes on conn, host, vid/pid, serial and port.
+	"""
+
+	_FIELDS = ('conn', 'host', 'vid', 'pid', 'prod', 'manufact', 'serial', 'port', 'disconn')
+	_IDENTITY_FIELDS = ('conn', 'host', 'vid', 'pid', 'prod', 'manufact', 'serial', 'port')
+
+	_SCHEMA = '''
+		CREATE TABLE IF NOT EXISTS events (
+			id       INTEGER PRIMARY KEY,
+			identity TEXT NOT NULL UNIQUE,
+			conn     TEXT NOT NULL,
+			host     TEXT,
+			vid      TEXT,
+			pid      TEXT,
+			prod     TEXT,
+			manufact TEXT,
+			serial   TEXT,
+			port     TEXT,
+			disconn  TEXT
+		);
+
+		CREATE INDEX IF NOT EXISTS events_conn    ON events (conn);
+		CREATE INDEX IF NOT EXISTS events_host    ON events (host);
+		CREATE INDEX IF NOT EXISTS events_vid_pid ON events (vid, pid);
+		CREATE INDEX IF NOT EXISTS events_pid     ON events (pid);
+		CREATE INDEX IF NOT EXISTS events_serial  ON events (serial);
+		CREATE INDEX IF NOT EXISTS events_port    ON events (port);
+	'''
+
+	def __init__(self, path):
+		self.path = os.path.abspath(path)
+		exists = os.path.isfile(self.path)
+
+		if not exists:
+			os_makedirs(os.path.dirname(self.path))
+
+		try:
+			self._conn = sqlite3.connect(self.path)
+			self._conn.executescript(USBEventDB._SCHEMA)
+		except sqlite3.Error as e:
+			raise USBRipError(f'Failed to open event database: "{self.path}"', errors={'initial_error': str(e)})
+
+		if not exists:
+			os.chmod(self.path, stat.S_IRUSR | stat.S_IWUSR)  # 600
+			print_info(f'New event database: "{self.path}"')
+
+	def close(self):
+		self._conn.close()
+
+	# ------------------------- Sync ---------------------------
+
+	def sync(self, events):
+		"""Add new events and fill in disconnection dates of stored ones; return the number of new events."""
+		rows = [
+			(_identity(event),) + tuple(event[key] for key in USBEventDB._FIELDS)
+			for event in events
+		]
+
+		try:
+			with self._conn:
+				before = self._conn.total_changes
+
+				self._conn.executemany(
+					'INSERT OR IGNORE INTO events (identity, conn, host, vid, pid, prod, manufact, serial, port, disconn) '
+					'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+					rows
+				)
+				inserted = self._conn.total_changes - before
+
+				self._conn.executemany(
+					'UPDATE events SET disconn = ? WHERE identity = ? AND disconn IS NULL',
+					[(row[-1], row[0]) for row in rows if row[-1] is not None]
+				)
+
+		except sqlite3.Error as e:
+			raise USBRipError(f'Failed to update event database: "{self.path}"', errors={'initial_error': str(e)})
+
+		return inserted
+
+	# ------------------------ Queries -------------------------
+
+	def history(self, sieve):
+		return self._select(*_compile_sieve(sieve), sieve)
+
+	def violations(self, auth, attributes, sieve):
+		if not attributes:
+			attributes = list(auth.keys())
+
+		for attr in attributes:
+			if attr not in auth:
+				raise USBRipError('No such attribute in authorized device list', errors={'initial_error': repr(attr)})
+			if attr not in USBEventDB._IDENTITY_FIELDS:
+				raise USBRipError(f'Invalid attribute name: {attr}')
+
+		# Authorized values go to a temporary table, so lists of any length fit in one query
+		with self._conn:
+			self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS auth (attr TEXT, val TEXT)')
+			self._conn.execute('DELETE FROM auth')
+			self._conn.executemany(
+				'INSERT INTO auth (attr, val) VALUES (?, ?)',
+				[(attr, val) for attr in attributes for val in auth[attr]]
+			)
+
+		where, params = _compile_sieve(sieve)
+		where.append('(' + ' OR '.join(
+			f'({attr} IS NOT NULL AND {attr} NOT IN (SELECT val FROM auth WHERE attr = ?))'
+			for attr in attributes
+		) + ')')
+		params.extend(attributes)
+
+		return self._select(where, params, sieve)
+
+	def _select(self, where, params, sieve):
+		columns = ', '.join(USBEventDB._FIELDS)
+		query = f'SELECT {columns}, id FROM events'
+		if where:
+			query += ' WHERE ' + ' AND '.join(where)
+
+		number = sieve['number'] if sieve else -1
+		if number is not None and number > -1:
+			query = f'SELECT * FROM ({query} ORDER BY conn DESC, id DESC LIMIT ?) ORDER BY conn, id'
+			params = params + [number]
+		else:
+			query += ' ORDER BY conn, id'
+
+		try:
+			rows = self._conn.execute(query, params).fetchall()
+		except sqlite3.Error as e:
+			raise USBRipError(f'Failed to query event database: "{self.path}"', errors={'initial_error': str(e)})
+
+		return [dict(zip(USBEventDB._FIELDS, row)) for row in rows]
+
+
+# ----------------------------------------------------------
+# ----------------------- Utilities ------------------------
+# ----------------------------------------------------------
+
+
+def _identity(event):
+	return json.dumps([event[key] for key in USBEventDB._IDENTITY_FIELDS])
+
+
+def _compile_sieve(sieve):
+	where, params = [], []
+	if not sieve:
+		return (where, params)
+
+	if sieve['external']:
+		where.append('disconn IS NOT NULL')
+
+	# "Starts with" as a range over the conn index: prefix <= conn < prefix + U+10FFFF
+	if sieve['dates']:
+		where.append('(' + ' OR '.join('(conn >= ? AND conn < ?)' for _ in sieve['dates']) + ')')
+		for date in sieve['dates']:
+			params.extend((date, date + '\U0010ffff'))
+
+	# Field sieves are a union: an event matches if any of its fields has any of the values
+	if sieve['fields']:
+		clauses = []
+		for key, vals in sieve['fields'].items():
+			if key not in USBEventDB._IDENTITY_FIELDS:
+				raise USBRipError(f'Invalid field name: {key}')
+			clauses.append(f'{key} IN ({", ".join("?" for _ in vals)})')
+			params.extend(vals)
+
+		where.append('(' + ' OR '.join(clauses) + ')')
+
+	return (where, params)
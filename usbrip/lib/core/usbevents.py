@@ -36,29 +36,37 @@ __site__   = 'https://github.com/snovvcrash/usbrip'
 __brief__  = 'USB events handler'
 
 import re
-import codecs
-import gzip
 import json
 import itertools
+import lzma
 import operator
 import os
+import queue
+import shutil
+import socket
 import stat
+import sys
+import threading
+import time
+import zlib
 from datetime import datetime
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, deque
 from string import printable
 from subprocess import check_output
 from io import StringIO
-from random import randint
 
 from terminaltables import AsciiTable, SingleTable
+from terminaltables.terminal_io import terminal_size
+from terminaltables.width_and_alignment import table_width, visible_width
 from termcolor import colored, cprint
-from tqdm import tqdm
 
 import usbrip.lib.core.config as cfg
 from usbrip.lib.core.common import BULLET
 from usbrip.lib.core.common import ABSENCE
 from usbrip.lib.core.common import SEPARATOR
 from usbrip.lib.core.common import COLUMN_NAMES
+from usbrip.lib.core.common import ENRICHED_COLUMN_NAMES
+from usbrip.lib.core.common import DAEMON_SOCKET
 from usbrip.lib.core.common import intersect_event_sets
 from usbrip.lib.core.common import os_makedirs
 from usbrip.lib.core.common import list_files
@@ -66,10 +74,25 @@ from usbrip.lib.core.common import print_info
 from usbrip.lib.core.common import print_warning
 from usbrip.lib.core.common import print_critical
 from usbrip.lib.core.common import USBRipError
+from usbrip.lib.core.logsource import LogSourcePipeline
+from usbrip.lib.core.logsource import is_compressed
+from usbrip.lib.core.logsource import find_prefilter_tool
+from usbrip.lib.core.logsource import iter_kmsg_records
+from usbrip.lib.core.logsource import CommandFollower
+from usbrip.lib.core.logsource import follow_file
+from usbrip.lib.core.logsource import KMSG_PATH
 from usbrip.lib.utils.debug import time_it
 from usbrip.lib.utils.debug import time_it_if_debug
 
 
+SYSLOG_PATHS = ('/var/log/syslog', '/var/log/messages')
+
+WATCH_FLUSH_TIMEOUT = 0.5  # seconds of log silence after which a pending connection is considered complete
+_WATCH_SESSIONS = 1000     # connections "events watch" keeps around to match disconnects against
+
+_CHOICE_FORMATS = {'2': 'json', '3': 'columnar'}  # _output_choice answers
+
+
 # ----------------------------------------------------------
 # ----------------------- USB Events -----------------------
 # ----------------------------------------------------------
@@ -81,97 +104,187 @@ class USBEvents:
 	TableClass = SingleTable if cfg.ISATTY and cfg.ISUTF8 else AsciiTable
 
 	@time_it_if_debug(cfg.DEBUG, time_it)
-	def __new__(cls, files=None):
+	def __new__(cls, files=None, *, kmsg=None, boot_time=None, db=None, db_only=False):
 		try:
-			if files:
-				filtered_history = []
-				for file in files:
-					filtered_history.extend(_read_log_file(file))
+			if db:
+				from usbrip.lib.core.usbdb import USBEventDB  # the modules behind --db, --tui, --enrich and
+				db = USBEventDB(db)                           # dump files are only imported when used (startup time)
+		except USBRipError as e:
+			print_critical(str(e), initial_error=e.errors['initial_error'])
+			return None
 
+		daemon = False
+
+		if db_only:
+			all_events = []
+		elif files or kmsg:
+			all_events = _read_events(files, kmsg, boot_time)
+		elif db:
+			# The database is synced with the full event list, take it from a running daemon if there is one
+			all_events = _get_daemon_events()
+			if all_events is None:
+				all_events = _read_events()
 			else:
-				print_info('Trying to run journalctl...')
+				print_info(f'Using events from usbrip daemon: "{DAEMON_SOCKET}"')
+		elif _ping_daemon():
+			# A running usbrip daemon already keeps the events from the system log in memory and
+			# answers sieve queries itself, the full list is only fetched if a command needs it
+			all_events, daemon = None, True
+		else:
+			all_events = _read_events()
 
-				# child_env = os.environ.copy()
-				# child_env['LANG'] = 'en_US.utf-8'
-				# journalctl_out = check_output(['journalctl'], env=child_env).decode('utf-8')
+		if all_events is None and not daemon:
+			return None
 
-				try:
-					journalctl_out = check_output([
-						'journalctl',
-						'-o',
-						'short-iso-precise'
-					]).decode('utf-8')
-
-				except Exception as e:
-					print_warning(f'Failed to run journalctl: {str(e)}')
-					filtered_history = _get_filtered_history()
+		if db and not db_only:
+			try:
+				print_info(f'Added {db.sync(all_events)} new USB events to the database')
+			except USBRipError as e:
+				print_critical(str(e), initial_error=e.errors['initial_error'])
+				return None
 
-				else:
-					if '-- Logs begin at' in journalctl_out:
-						print_info('Successfully ran journalctl')
+		instance = super().__new__(cls)
+		instance._events = all_events      # self._all_events
+		instance._daemon = daemon          # self._daemon
+		instance._db = db                  # self._db
+		instance._violations = []          # self._violations
+		instance._events_to_show = None    # self._events_to_show
+		return instance
 
-						filtered_history = _read_log_file(
-							None,
-							log=StringIO(journalctl_out),
-							total=journalctl_out.count('\n')
-						)
+	@property
+	def _all_events(self):
+		if self._events is None:
+			events = _get_daemon_events() if self._daemon else None
+			self._events = events if events is not None else (_read_events() or [])
+			self._daemon = False
 
-					else:
-						print_warning(f'An error occurred when running journalctl: {journalctl_out}')
-						filtered_history = _get_filtered_history()
+		return self._events
 
-		except USBRipError as e:
-			print_critical(str(e), initial_error=e.errors['initial_error'])
+	def _ask_daemon(self, request):
+		"""Have the daemon answer a history/violations query; None if it is not available anymore."""
+		if not self._daemon:
 			return None
 
-		all_events = _parse_history(filtered_history)
+		response = _query_daemon(request)
+		if response is None:
+			self._daemon = False
+			return None
 
-		instance = super().__new__(cls)
-		instance._all_events = all_events  # self._all_events
-		instance._violations = []          # self._violations
-		instance._events_to_show = None    # self._events_to_show
-		return instance
+		return response['events']
 
 	# ------------------- USB Events History -------------------
 
 	@time_it_if_debug(cfg.DEBUG, time_it)
-	def event_history(self, columns, *, indent=4, sieve=None, repres=None):
-		self._events_to_show = _filter_events(self._all_events, sieve)
+	def event_history(self, columns, *, indent=4, sieve=None, repres=None, fmt=None, output=None, tui=False, enrich=False):
+		try:
+			if self._db:
+				self._events_to_show = self._db.history(sieve)
+			else:
+				self._events_to_show = self._ask_daemon({'cmd': 'history', 'sieve': sieve})
+				if self._events_to_show is None:
+					self._events_to_show = _filter_events(self._all_events, sieve)
+		except USBRipError as e:
+			print_critical(str(e), initial_error=e.errors['initial_error'])
+			return
+
+		if enrich:
+			from usbrip.lib.core.usbids import enrich_events
+			self._events_to_show = enrich_events(self._events_to_show)
+
+		columns, table_data = _columns_to_show(columns, enrich)
+
+		if fmt:
+			if not _export_events(self._events_to_show, 'event history', fmt, output, indent, enrich):
+				print_info('No USB events found!')
+			return
+
 		if not self._events_to_show:
 			print_info('No USB events found!')
 			return
 
+		if tui:
+			from usbrip.lib.core.viewer import EventViewer
+			EventViewer(self._events_to_show, columns, 'USB-History-Events').run()
+			return
+
 		if not cfg.QUIET and cfg.ISATTY:
 			choice, abs_filename = _output_choice('event history', 'history.json')
-			if choice == '2':
+			if choice in ('2', '3'):
 				try:
-					_dump_events(self._events_to_show, 'event history', abs_filename, indent)
+					_dump_events(self._events_to_show, 'event history', abs_filename, indent, fmt=_CHOICE_FORMATS[choice], enrich=enrich)
 				except USBRipError as e:
 					print_critical(str(e), initial_error=e.errors['initial_error'])
 				return
 
 		# elif choice == '1' or choice == '':
 
-		if columns:
-			table_data = [[COLUMN_NAMES[name] for name in columns]]
-		else:
-			columns = [key for key in COLUMN_NAMES.keys()]
-			table_data = [[val for val in COLUMN_NAMES.values()]]
-
 		_represent_events(self._events_to_show, columns, table_data, 'USB-History-Events', repres)
 
 	# -------------------- USB Events Open ---------------------
 
 	@staticmethod
 	@time_it_if_debug(cfg.DEBUG, time_it)
-	def open_dump(input_dump, columns, *, sieve=None, repres=None):
+	def open_dump(input_dump, columns, *, indent=4, sieve=None, repres=None, fmt=None, output=None, tui=False, enrich=False):
 		abs_input_dump = os.path.abspath(input_dump)
 
+		from usbrip.lib.core.eventdump import ColumnarDump
+		from usbrip.lib.core.eventdump import detect_dump_format
+		from usbrip.lib.core.eventdump import iter_ndjson
+
 		print_info(f'Opening USB event dump: "{abs_input_dump}"')
 
+		columnar_dump = None  # stays open while its events are being shown, they are decoded on demand
+
 		try:
-			with open(abs_input_dump, 'r', encoding='utf-8') as dump:
-				events_dumped = json.load(dump)
+			dump_format = detect_dump_format(abs_input_dump)
+
+			if dump_format == 'columnar':
+				columnar_dump = ColumnarDump(abs_input_dump)
+				if not len(columnar_dump):
+					print_critical('This dump is empty!')
+					return
+
+				events_to_show = columnar_dump.select(sieve)
+
+			elif dump_format == 'ndjson':
+				# Read lazily, so that streaming it out (--format) needs constant memory
+				events_to_show = _stream_filter_events(iter_ndjson(abs_input_dump), sieve)
+
+			else:
+				with open(abs_input_dump, 'r', encoding='utf-8') as dump:
+					events_dumped = json.load(dump)
+
+				if not events_dumped:
+					print_critical('This dump is empty!')
+					return
+
+				events_to_show = _filter_events(events_dumped, sieve)
+
+			if enrich:
+				from usbrip.lib.core.usbids import enrich_events
+				events_to_show = enrich_events(events_to_show)
+
+			columns, table_data = _columns_to_show(columns, enrich)
+
+			if fmt:
+				if not _export_events(events_to_show, 'event dump', fmt, output, indent, enrich):
+					print_info('No USB events found!')
+				return
+
+			if not tui or dump_format == 'ndjson':
+				events_to_show = list(events_to_show)
+
+			if not len(events_to_show):
+				print_info('No USB events found!')
+				return
+
+			if tui:
+				from usbrip.lib.core.viewer import EventViewer
+				EventViewer(events_to_show, columns, 'USB-Event-Dump').run()
+				return
+
+			_represent_events(events_to_show, columns, table_data, 'USB-Event-Dump', repres)
+
 		except json.decoder.JSONDecodeError as e:
 			print_critical('Failed to decode event dump (JSON)', initial_error=str(e))
 			return
@@ -181,23 +294,13 @@ class USBEvents:
 				initial_error=str(e)
 			)
 			return
-
-		if not events_dumped:
-			print_critical('This dump is empty!')
-			return
-
-		events_to_show = _filter_events(events_dumped, sieve)
-		if not events_to_show:
-			print_info('No USB events found!')
+		except USBRipError as e:
+			print_critical(str(e), initial_error=e.errors['initial_error'])
 			return
 
-		if columns:
-			table_data = [[COLUMN_NAMES[name] for name in columns]]
-		else:
-			columns = [key for key in COLUMN_NAMES.keys()]
-			table_data = [[val for val in COLUMN_NAMES.values()]]
-
-		_represent_events(events_to_show, columns, table_data, 'USB-Event-Dump', repres)
+		finally:
+			if columnar_dump is not None:  # an empty dump is falsy (len() == 0), it still has to be closed
+				columnar_dump.close()
 
 	# ------------------ USB Events GenAuth -------------------
 
@@ -207,6 +310,8 @@ class USBEvents:
 		if not self._events_to_show:
 			print_info('No USB devices found!')
 
+		from random import randint  # genauth only
+
 		rand_id = f'usbrip-{randint(1000, 9999)}'
 		self._events_to_show += [{
 			'conn':     rand_id,
@@ -243,7 +348,7 @@ class USBEvents:
 			attributes = ('vid', 'pid', 'prod', 'manufact', 'serial')
 
 		auth = defaultdict(set)
-		for event in tqdm(self._events_to_show, ncols=80, unit='dev'):
+		for event in _tqdm(self._events_to_show, ncols=80, unit='dev'):
 			for key, val in event.items():
 				if key in attributes and val is not None:
 					auth[key].add(val)
@@ -263,7 +368,7 @@ class USBEvents:
 	# ----------------- USB Events Violations ------------------
 
 	@time_it_if_debug(cfg.DEBUG, time_it)
-	def search_violations(self, input_auth, attributes, columns, *, indent=4, sieve=None, repres=None):
+	def search_violations(self, input_auth, attributes, columns, *, indent=4, sieve=None, repres=None, fmt=None, output=None, enrich=False):
 		abs_input_auth = os.path.abspath(input_auth)
 
 		print_info(f'Opening authorized device list: "{abs_input_auth}"')
@@ -276,56 +381,219 @@ class USBEvents:
 
 		print_info('Searching for violations')
 
-		if not attributes:
-			attributes = auth.keys()
+		if self._db:
+			try:
+				self._events_to_show = self._violations = self._db.violations(auth, attributes, sieve)
+			except USBRipError as e:
+				print_critical(str(e), initial_error=e.errors['initial_error'])
+				return
 
-		auth_sets = [set(auth[attr]) for attr in attributes]
+		else:
+			if not attributes:
+				attributes = auth.keys()
 
-		for event in tqdm(self._all_events, ncols=80, unit='dev'):
 			try:
-				if any(
-					event[key] is not None and
-					event[key] not in vals
-					for key, vals in zip(attributes, auth_sets)
-				):
-					self._violations.append(event)
+				auth_sets = [set(auth[attr]) for attr in attributes]
 			except KeyError as e:
 				print_critical('No such attribute in authorized device list', initial_error=str(e))
 				return
 
-		self._events_to_show = _filter_events(self._violations, sieve)
+			self._violations = self._ask_daemon({'cmd': 'violations', 'auth': auth, 'attributes': list(attributes), 'sieve': sieve})
+			if self._violations is not None:
+				self._events_to_show = self._violations
+			else:
+				self._violations = []
+				for event in _tqdm(self._all_events, ncols=80, unit='dev'):
+					if _is_violation(event, attributes, auth_sets):
+						self._violations.append(event)
+
+				self._events_to_show = _filter_events(self._violations, sieve)
+
+		if enrich:
+			from usbrip.lib.core.usbids import enrich_events
+			self._events_to_show = enrich_events(self._events_to_show)
+
+		columns, table_data = _columns_to_show(columns, enrich)
+
+		if fmt:
+			if not _export_events(self._events_to_show, 'violations', fmt, output, indent, enrich):
+				print_info('No USB violation events found!')
+			return
+
 		if not self._events_to_show:
 			print_info('No USB violation events found!')
 			return
 
 		if not cfg.QUIET and cfg.ISATTY:
 			choice, abs_filename = _output_choice('violation', 'viol.json')
-			if choice == '2':
+			if choice in ('2', '3'):
 				try:
-					_dump_events(self._events_to_show, 'violations', abs_filename, indent)
+					_dump_events(self._events_to_show, 'violations', abs_filename, indent, fmt=_CHOICE_FORMATS[choice], enrich=enrich)
 				except USBRipError as e:
 					print_critical(str(e), initial_error=e.errors['initial_error'])
 				return
 
 		# elif choice == '1' or choice == '':
 
-		if columns:
-			table_data = [[COLUMN_NAMES[name] for name in columns]]
-		else:
-			columns = [key for key in COLUMN_NAMES.keys()]
-			table_data = [[val for val in COLUMN_NAMES.values()]]
-
 		_represent_events(self._events_to_show, columns, table_data, 'USB-Violation-Events', repres)
 
 
+	# ------------------- USB Events Watch ---------------------
+
+	@staticmethod
+	def watch_violations(input_auth, attributes, *, source='auto', json_output=False, indent=4):
+		abs_input_auth = os.path.abspath(input_auth)
+
+		print_info(f'Opening authorized device list: "{abs_input_auth}"')
+
+		try:
+			auth = _process_auth_list(abs_input_auth, indent)
+		except json.decoder.JSONDecodeError as e:
+			print_critical('Failed to decode authorized device list (JSON)', initial_error=str(e))
+			return
+
+		if not attributes:
+			attributes = list(auth.keys())
+
+		try:
+			auth_sets = [set(auth[attr]) for attr in attributes]
+		except KeyError as e:
+			print_critical('No such attribute in authorized device list', initial_error=str(e))
+			return
+
+		try:
+			source, entries, stop = _follow_source(source)
+		except USBRipError as e:
+			print_critical(str(e), initial_error=e.errors['initial_error'])
+			return
+
+		print_info(f'Watching {source} for USB violation events (press Ctrl-C to stop)')
+
+		def on_complete(event):
+			if _is_violation(event, attributes, auth_sets):
+				_print_violation(event, json_output)
+
+		# Violations are reported as connections complete, older sessions are only kept for their disconnects
+		tracker = SessionTracker(on_complete=on_complete, keep=_WATCH_SESSIONS)
+		pending = queue.Queue(maxsize=1024)
+
+		def produce():
+			try:
+				for entry in entries:
+					pending.put(entry)
+			except Exception as e:
+				pending.put(e)
+			else:
+				pending.put(None)
+
+		threading.Thread(target=produce, daemon=True).start()
+
+		try:
+			while True:
+				try:
+					entry = pending.get(timeout=WATCH_FLUSH_TIMEOUT)
+				except queue.Empty:
+					tracker.flush()  # enumeration is over, do not wait for the next device to show up
+					continue
+
+				if entry is None:
+					tracker.flush()
+					print_warning(f'Log source has been closed: {source}')
+					break
+
+				if isinstance(entry, Exception):
+					print_critical(f'Failed to read log source: {source}', initial_error=str(entry))
+					break
+
+				tracker.feed(*entry)
+
+		except KeyboardInterrupt:
+			tracker.flush()
+			print_info('Stopped watching')
+
+		finally:
+			if stop is not None:
+				stop()  # do not leave "journalctl -f" running behind
+
+
 # ----------------------------------------------------------
 # ----------------------- Utilities ------------------------
 # ----------------------------------------------------------
 
 
-def _get_filtered_history():
-	filtered_history = []
+def _read_events(files=None, kmsg=None, boot_time=None):
+	"""Parse USB events from kmsg, the given log files or the system log; None on error."""
+	try:
+		if kmsg:
+			filtered_history = _read_kmsg(kmsg, boot_time=boot_time)
+
+		elif files:
+			filtered_history = _read_log_files(files)
+
+		else:
+			print_info('Trying to run journalctl...')
+
+			# child_env = os.environ.copy()
+			# child_env['LANG'] = 'en_US.utf-8'
+			# journalctl_out = check_output(['journalctl'], env=child_env).decode('utf-8')
+
+			try:
+				journalctl_out = check_output([
+					'journalctl',
+					'-o',
+					'short-iso-precise'
+				]).decode('utf-8')
+
+			except Exception as e:
+				print_warning(f'Failed to run journalctl: {str(e)}')
+				filtered_history = _get_filtered_history()
 
+			else:
+				if '-- Logs begin at' in journalctl_out:
+					print_info('Successfully ran journalctl')
+
+					filtered_history = _read_log_file(
+						None,
+						log=StringIO(journalctl_out),
+						total=journalctl_out.count('\n')
+					)
+
+				else:
+					print_warning(f'An error occurred when running journalctl: {journalctl_out}')
+					filtered_history = _get_filtered_history()
+
+	except USBRipError as e:
+		print_critical(str(e), initial_error=e.errors['initial_error'])
+		return None
+
+	return _parse_history(filtered_history)
+
+
+def _ping_daemon():
+	response = _query_daemon({'cmd': 'ping'})
+	if response is None:
+		return False
+
+	print_info(f'Using events from usbrip daemon: "{DAEMON_SOCKET}"')
+	return True
+
+
+def _get_daemon_events():
+	response = _query_daemon({'cmd': 'events'})
+	return response['events'] if response is not None else None
+
+
+def _query_daemon(request):
+	from usbrip.lib.core.usbdaemon import query_daemon  # usbdaemon depends on this module
+
+	try:
+		return query_daemon(request)
+	except USBRipError as e:
+		print_warning('Failed to query usbrip daemon, parsing system log instead', initial_error=str(e))
+		return None
+
+
+def _get_filtered_history(*, ends=None):
 	print_info('Searching for log files: "/var/log/syslog*" or "/var/log/messages*"')
 
 	syslog_files = sorted([
@@ -335,8 +603,7 @@ def _get_filtered_history():
 	])
 
 	if syslog_files:
-		for syslog in syslog_files:
-			filtered_history.extend(_read_log_file(syslog))
+		filtered_history = _read_log_files(syslog_files, ends=ends)
 	else:
 		messages_files = sorted([
 			filename
@@ -345,124 +612,238 @@ def _get_filtered_history():
 		])
 
 		if messages_files:
-			for messages in messages_files:
-				filtered_history.extend(_read_log_file(messages))
+			filtered_history = _read_log_files(messages_files, ends=ends)
 		else:
 			raise USBRipError('None of log file types was found!')
 
 	return filtered_history
 
 
-def _read_log_file(filename, log=None, total=None):
+def _read_log_files(filenames, *, ends=None):
+	filtered_history = []
+
+	prefilter_tool = None
+	if cfg.PREFILTER:
+		prefilter_tool = find_prefilter_tool()
+		if prefilter_tool:
+			print_info(f'Using {prefilter_tool[0]} to pre-filter log files: "{prefilter_tool[1]}"')
+		else:
+			print_warning('Neither rg nor grep was found, falling back to reading log files with Python')
+
+	# Sources following the current one are read and decompressed in the background
+	with LogSourcePipeline(
+		[os.path.abspath(filename) for filename in filenames],
+		prefilter_tool=prefilter_tool,
+		ends=ends
+	) as pipeline:
+		for reader in pipeline:
+			filtered_history.extend(_read_log_file(reader.filename, reader=reader))
+
+	if cfg.DEBUG:
+		pipeline.stats.report('_read_log_files pipeline')
+
+	return filtered_history
+
+
+def _read_log_file(filename, log=None, total=None, *, reader=None):
 	filtered = []
 
 	if log is None:
 		abs_filename = os.path.abspath(filename)
 
-		if abs_filename.endswith('.gz'):
+		if is_compressed(abs_filename):
 			print_info(f'Unpacking "{abs_filename}"')
 
-			try:
-				log = gzip.open(abs_filename, 'rb')
-			except PermissionError as e:
-				print_warning(
-					f'Permission denied: "{abs_filename}". Retry with sudo',
-					initial_error=str(e)
-				)
-				return filtered
-			else:
-				end_of_file = b''
-				abs_filename = os.path.splitext(abs_filename)
+		print_info(f'Reading "{abs_filename}"')
 
-		else:
-			try:
-				log = codecs.open(abs_filename, 'r', encoding='utf-8', errors='ignore')
-			except PermissionError as e:
-				print_warning(
-					f'Permission denied: "{abs_filename}". Retry with sudo',
-					initial_error=str(e)
-				)
-				return filtered
-			else:
-				end_of_file = ''
+		# Progress is measured in raw bytes read, so no extra pass is needed to count lines
+		try:
+			with _tqdm(ncols=80, unit='B', unit_scale=True, total=reader.size) as pbar:
+				for nbytes, lines in reader:
+					start = time.perf_counter()
 
-		total = sum(1 for line in log)
-		log.seek(0)
+					pbar.update(nbytes)
+					for line in lines:
+						if b' usb ' in line:  # cheap bytes-level pre-check before decoding
+							entry = _classify_log_line(line.decode('utf-8', errors='ignore'), abs_filename)
+							if entry:
+								filtered.append(entry)
 
-		print_info(f'Reading "{abs_filename}"')
+					reader.stats.add('parse', time.perf_counter() - start)
+
+		except PermissionError as e:
+			print_warning(
+				f'Permission denied: "{abs_filename}". Retry with sudo',
+				initial_error=str(e)
+			)
+
+		except FileNotFoundError as e:
+			# Rotated away (deleted) since the log files were listed, it is not a decompression failure
+			print_warning(f'Log file not found: "{abs_filename}"', initial_error=str(e))
+
+		except (OSError, EOFError, zlib.error, lzma.LZMAError) as e:
+			raise USBRipError(f'Failed to decompress "{abs_filename}"', errors={'initial_error': str(e)})
+
+		finally:
+			reader.close()
 
 	else:
-		abs_filename = 'journalctl output'
-		end_of_file = ''
 		print_info(f'Reading journalctl output')
 
-	regex = re.compile(r'(?:]|:) usb (.*?): ')
-	for line in tqdm(iter(log.readline, end_of_file), ncols=80, unit='line', total=total):
-		if isinstance(line, bytes):
-			line = line.decode('utf-8', errors='ignore')
+		for line in _tqdm(iter(log.readline, ''), ncols=80, unit='line', total=total):
+			if ' usb ' in line:
+				entry = _classify_log_line(line, 'journalctl output')
+				if entry:
+					filtered.append(entry)
 
-		if regex.search(line):
-			# Case 1 -- Modified Timestamp ("%Y-%m-%dT%H:%M:%S.%f%z")
+		log.close()
 
-			date = line[:32].strip()
-			if date.count(':') == 3:
-				date = ''.join(line[:32].rsplit(':', 1))  # rreplace(':', '', 1) to remove the last ':' from "1970-01-01T00:00:00.000000-00:00" timestamp if there is one
+	return filtered
 
-			try:
-				date = datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%f%z')  # ex. "1970-01-01T00:00:00.000000-0000"
 
-			except ValueError:
-				# Case 2 -- Non-Modified Timestamp ("%b %d %H:%M:%S")
+_RE_USB_LOG_LINE = re.compile(r'(?:]|:) usb (.*?): ')
 
-				date = line[:15].strip()
-				if '  ' in date:
-					date = date.replace('  ', ' 0', 1)  # pad day of the week with zero
 
-				try:
-					date = datetime.strptime(date, '%b %d %H:%M:%S')  # ex. "Mar 18 13:56:07"
-				except ValueError as e:
-					raise USBRipError(f'Wrong timestamp format found in "{abs_filename}"', errors={'initial_error': str(e)})
-				else:
-					date = date.strftime('????-%m-%d %H:%M:%S')
-					logline = line[15:].strip()
+def _classify_log_line(line, abs_filename):
+	if not _RE_USB_LOG_LINE.search(line):
+		return None
 
-			else:
-				date = date.strftime('%Y-%m-%d %H:%M:%S')
-				logline = line[32:].strip()
+	# Case 1 -- Modified Timestamp ("%Y-%m-%dT%H:%M:%S.%f%z")
 
-			if any(pat in line for pat in ('New USB device found, ', 'Product: ', 'Manufacturer: ', 'SerialNumber: ')):
-				filtered.append((date, 'c', logline))
-			elif 'disconnect' in line:
-				filtered.append((date, 'd', logline))
+	date = line[:32].strip()
+	if date.count(':') == 3:
+		date = ''.join(line[:32].rsplit(':', 1))  # rreplace(':', '', 1) to remove the last ':' from "1970-01-01T00:00:00.000000-00:00" timestamp if there is one
 
-	log.close()
-	return filtered
+	try:
+		date = datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%f%z')  # ex. "1970-01-01T00:00:00.000000-0000"
+
+	except ValueError:
+		# Case 2 -- Non-Modified Timestamp ("%b %d %H:%M:%S")
+
+		date = line[:15].strip()
+		if '  ' in date:
+			date = date.replace('  ', ' 0', 1)  # pad day of the week with zero
+
+		try:
+			date = datetime.strptime(date, '%b %d %H:%M:%S')  # ex. "Mar 18 13:56:07"
+		except ValueError as e:
+			raise USBRipError(f'Wrong timestamp format found in "{abs_filename}"', errors={'initial_error': str(e)})
+		else:
+			date = date.strftime('????-%m-%d %H:%M:%S')
+			logline = line[15:].strip()
+
+	else:
+		date = date.strftime('%Y-%m-%d %H:%M:%S')
+		logline = line[32:].strip()
+
+	action = _classify_action(line)
+	if action:
+		return (date, action, logline)
+
+	return None
+
+
+def _classify_action(line):
+	if any(pat in line for pat in ('New USB device found, ', 'Product: ', 'Manufacturer: ', 'SerialNumber: ')):
+		return 'c'
+	elif 'disconnect' in line:
+		return 'd'
+
+	return None
+
+
+def _read_kmsg(path, *, boot_time=None):
+	print_info(f'Reading kernel ring buffer records: "{path}"')
+
+	try:
+		if boot_time is None and not stat.S_ISCHR(os.stat(path).st_mode):
+			print_warning(
+				'Record times are counted from the boot of this host, they are only right if the file '
+				'was captured since then (give the boot time of the captured host with "--boot-time")'
+			)
+
+		return list(_kmsg_entries(_tqdm(iter_kmsg_records(path), ncols=80, unit='rec'), boot_time=boot_time))
+	except PermissionError as e:
+		raise USBRipError(f'Permission denied: "{path}". Retry with sudo', errors={'initial_error': str(e)})
+	except OSError as e:
+		raise USBRipError(f'Failed to read kernel ring buffer: "{path}"', errors={'initial_error': str(e)})
+
+
+def _kmsg_entries(records, *, boot_time=None):
+	from usbrip.lib.core.logsource import get_boot_time
+
+	if boot_time is None:
+		boot_time = get_boot_time()
+	host = socket.gethostname()
+
+	for timestamp_usec, message in records:
+		logline = f'{host} kernel: {message}'  # same shape as a syslog line past its timestamp
+		if not _RE_USB_LOG_LINE.search(logline):
+			continue
+
+		action = _classify_action(logline)
+		if action:
+			date = datetime.fromtimestamp(boot_time + timestamp_usec / 1e6).strftime('%Y-%m-%d %H:%M:%S')
+			yield (date, action, logline)
 
 
 def _parse_history(filtered_history):
-	re_vid      = re.compile(r'idVendor=(\w+)')
-	re_pid      = re.compile(r'idProduct=(\w+)')
-	re_prod     = re.compile(r'Product: (.*?$)')
-	re_manufact = re.compile(r'Manufacturer: (.*?$)')
-	re_serial   = re.compile(r'SerialNumber: (.*?$)')
-	re_port     = re.compile(r'usb (.*[0-9]):')
-
-	all_events, curr, link, interrupted = [], -1, 1, False
+	tracker = SessionTracker()
 	for date, action, logline in filtered_history:
+		tracker.feed(date, action, logline)
+
+	return tracker.all_events
+
+
+class SessionTracker:
+	"""
+	Reconstruct USB connection sessions from (date, action, logline) entries one at a time.
+
+	A connection is complete once its enumeration lines (Product, Manufacturer, SerialNumber)
+	are over, i.e. when the serial number arrives, the sequence is interrupted by some other
+	line, the next device shows up or flush() is called. Completed connections are passed to
+	the on_complete callback (if any) right away, which is what follow mode relies on. A
+	connection flushed before its enumeration was over (follow mode does so after a while of
+	log silence) is passed to it again once the lines that came late are over.
+
+	With keep, only about the latest keep connections are held (older ones are dropped in
+	batches, dropped counts them), so that a tracker fed forever does not grow without bound.
+	"""
+
+	_re_vid      = re.compile(r'idVendor=(\w+)')
+	_re_pid      = re.compile(r'idProduct=(\w+)')
+	_re_prod     = re.compile(r'Product: (.*?$)')
+	_re_manufact = re.compile(r'Manufacturer: (.*?$)')
+	_re_serial   = re.compile(r'SerialNumber: (.*?$)')
+	_re_port     = re.compile(r'usb (.*[0-9]):')
+
+	def __init__(self, all_events=None, *, on_complete=None, keep=None):
+		self.all_events = all_events if all_events is not None else []
+		self.dropped = 0
+		self._on_complete = on_complete
+		self._keep = keep
+		self._curr = len(self.all_events) - 1
+		self._link = 1
+		self._interrupted = True
+		self._pending = False  # whether the current connection has not been reported as complete yet
+
+	def feed(self, date, action, logline):
 		if action == 'c':
 			if 'New USB device found, ' in logline:
+				self.flush()
+
 				host = logline.split(' ', 1)[0]  # logline -> '<HOST> <REST>'
 
 				try:
-					vid = re_vid.search(logline).group(1)
+					vid = self._re_vid.search(logline).group(1)
 				except AttributeError:
 					vid = None
 				try:
-					pid = re_pid.search(logline).group(1)
+					pid = self._re_pid.search(logline).group(1)
 				except AttributeError:
 					pid = None
 				try:
-					port = re_port.search(logline).group(1)
+					port = self._re_port.search(logline).group(1)
 				except AttributeError:
 					port = None
 
@@ -478,53 +859,77 @@ def _parse_history(filtered_history):
 					'disconn':  None
 				}
 
-				all_events.append(event)
-				curr += 1
-				link = 2
-				interrupted = False
+				self.all_events.append(event)
+				self._curr += 1
+
+				if self._keep and len(self.all_events) >= 2 * self._keep:
+					self._drop(len(self.all_events) - self._keep)
+				self._link = 2
+				self._interrupted = False
+				self._pending = True
 
-			elif not interrupted:
-				if link == 2:
+			elif not self._interrupted:
+				event = self.all_events[self._curr]
+
+				if self._link == 2:
 					try:  # if 'Product: ' in logline
-						prod = re_prod.search(logline).group(1)
+						prod = self._re_prod.search(logline).group(1)
 					except AttributeError:
-						interrupted = True
+						self._interrupted = True
 					else:
-						all_events[curr]['prod'] = prod
-						link = 3
-				elif link == 3:
+						event['prod'] = prod
+						self._link = 3
+						self._pending = True
+				elif self._link == 3:
 					try:  # if 'Manufacturer: ' in logline
-						manufact = re_manufact.search(logline).group(1)
+						manufact = self._re_manufact.search(logline).group(1)
 					except AttributeError:
-						interrupted = True
+						self._interrupted = True
 					else:
-						all_events[curr]['manufact'] = manufact
-						link = 4
-				elif link == 4:
+						event['manufact'] = manufact
+						self._link = 4
+						self._pending = True
+				elif self._link == 4:
 					try:  # if 'SerialNumber: ' in logline
-						serial = re_serial.search(logline).group(1)
+						serial = self._re_serial.search(logline).group(1)
 					except AttributeError:
 						pass
 					else:
-						all_events[curr]['serial'] = serial
+						event['serial'] = serial
+						self._pending = True
 					finally:
-						interrupted = True
+						self._interrupted = True
 
-			else:
-				continue
+				if self._interrupted:
+					self.flush()
 
 		elif action == 'd':
 			try:
-				port = re_port.search(logline).group(1)
+				port = self._re_port.search(logline).group(1)
 			except AttributeError:
 				pass
 			else:
-				for i in range(len(all_events)-1, -1, -1):
-					if all_events[i]['port'] == port:
-						all_events[i]['disconn'] = date
+				for i in range(len(self.all_events)-1, -1, -1):
+					if self.all_events[i]['port'] == port:
+						if i == self._curr:
+							self.flush()
+						self.all_events[i]['disconn'] = date
 						break
 
-	return all_events
+	def flush(self):
+		if self._pending:
+			self._pending = False
+			if self._on_complete is not None:
+				self._on_complete(self.all_events[self._curr])
+
+	@property
+	def pending(self):
+		return self._pending
+
+	def _drop(self, n):
+		del self.all_events[:n]
+		self._curr -= n
+		self.dropped += n
 
 
 '''
@@ -535,6 +940,93 @@ def _sort_by_date(unsorted_log):
 '''
 
 
+def _is_violation(event, attributes, auth_sets):
+	return any(
+		event[key] is not None and
+		event[key] not in vals
+		for key, vals in zip(attributes, auth_sets)
+	)
+
+
+def _print_violation(event, json_output):
+	if json_output:
+		print(json.dumps(OrderedDict((key, event[key]) for key in COLUMN_NAMES.keys())), flush=True)
+		return
+
+	message = ' '.join(str(event[key]) if event[key] is not None else ABSENCE for key in COLUMN_NAMES.keys() if key != 'disconn')
+
+	if cfg.ISATTY:
+		cprint(f'[VIOLATION] {message}', 'red', attrs=['bold'], flush=True)
+	else:
+		print(f'[VIOLATION] {message}', flush=True)
+
+
+def _resolve_log_source(source):
+	if source == 'auto':
+		if shutil.which('journalctl'):
+			source = 'journal'
+		elif any(os.path.isfile(path) for path in SYSLOG_PATHS):
+			source = 'syslog'
+		elif os.path.exists(KMSG_PATH):
+			source = 'kmsg'
+		else:
+			raise USBRipError('None of log sources to follow was found!')
+
+	return source
+
+
+def _follow_source(source):
+	"""Return the name of the log source, its entries and a function that stops following it (None if there is nothing to stop)."""
+	source = _resolve_log_source(source)
+
+	if source == 'journal':
+		return ('journalctl',) + _follow_journal()
+
+	elif source == 'syslog':
+		for path in SYSLOG_PATHS:
+			if os.path.isfile(path):
+				return (path, _follow_syslog(path), None)
+
+		raise USBRipError('None of log file types was found!')
+
+	elif source == 'kmsg':
+		return (KMSG_PATH, _follow_kmsg(KMSG_PATH), None)
+
+	raise USBRipError(f'Unknown log source: {source}')
+
+
+def _follow_journal(cursor=None):
+	"""Start "journalctl -f"; return its entries and the function that terminates it (from any thread)."""
+	cmd = ['journalctl', '-f', '-k', '-o', 'short-iso-precise']
+	if cursor:
+		cmd.append(f'--after-cursor={cursor}')
+	else:
+		cmd.extend(['-n', '0'])
+
+	follower = CommandFollower(cmd)
+	return (_journal_entries(follower), follower.close)
+
+
+def _journal_entries(lines):
+	for line in lines:
+		if ' usb ' in line:
+			entry = _classify_log_line(line, 'journalctl output')
+			if entry:
+				yield entry
+
+
+def _follow_syslog(path, offset=None):
+	for line in follow_file(path, offset=offset):
+		if b' usb ' in line:
+			entry = _classify_log_line(line.decode('utf-8', errors='ignore'), path)
+			if entry:
+				yield entry
+
+
+def _follow_kmsg(path):
+	return _kmsg_entries(iter_kmsg_records(path, follow=True))
+
+
 def _process_auth_list(input_auth, indent):
 	with open(input_auth, 'r+', encoding='utf-8') as auth_json:
 		#auth = json.load(auth_json, object_pairs_hook=OrderedDict)
@@ -614,23 +1106,96 @@ def _filter_events(all_events, sieve):
 		if not events_to_show:
 			return []
 
+		# The sieve is left untouched, callers reuse it for several event sources
 		SIZE = len(events_to_show)
-		if sieve['number'] <= -1 or sieve['number'] > SIZE:
-			if sieve['number'] < -1:
-				print_warning(
-					f'usbrip can\'t handle dark matter \"--number={sieve["number"]}\", so it will show '
-					f'all {SIZE} USB history entries available'
-				)
+		number = _clamp_number(sieve['number'], SIZE)
+
+		return [events_to_show[SIZE-i] for i in range(number, 0, -1)]
+
+
+def _clamp_number(number, size):
+	"""The number of latest events to show out of size (all of them for -1), with _filter_events' warnings."""
+	if number <= -1 or number > size:
+		if number < -1:
+			print_warning(
+				f'usbrip can\'t handle dark matter \"--number={number}\", so it will show '
+				f'all {size} USB history entries available'
+			)
+
+		elif number > size:
+			print_warning(
+				f'USB history has only {size} entries instead of requested {number}, '
+				f'displaying all of them...'
+			)
+
+		number = size
+
+	return number
 
-			elif sieve['number'] > SIZE:
-				print_warning(
-					f'USB history has only {SIZE} entries instead of requested {sieve["number"]}, '
-					f'displaying all of them...'
-				)
 
-			sieve['number'] = SIZE
+def _filter_sorted_events(events, sieve):
+	"""
+	_filter_events for a stream of events in connection order, with the same results and
+	warnings: identical events are shown once and -n keeps the latest N. Only those N events
+	(and the ones of the current connection second, to spot duplicates) are held in memory.
+	"""
+	if sieve is None or sieve == {'external': False, 'dates': [], 'fields': {}, 'number': -1}:
+		return list(events)
+
+	print_info('Filtering events')
+
+	number = sieve['number']
+	window = deque(maxlen=number if number > -1 else None)
+	size = 0
+
+	conn, seen = None, set()
+	for event in events:
+		if event['conn'] != conn:
+			conn, seen = event['conn'], set()
+
+		dumped = json.dumps(event)
+		if dumped in seen or not _event_matches(event, sieve):
+			continue
+
+		seen.add(dumped)
+		window.append(event)
+		size += 1
 
-		return [events_to_show[SIZE-i] for i in range(sieve['number'], 0, -1)]
+	if not size:
+		return []
+
+	number = _clamp_number(number, size)
+	return list(window)[len(window)-number:]
+
+
+def _stream_filter_events(events, sieve):
+	"""
+	_filter_events for event streams (constant memory): events keep the order of the
+	stream and are not deduplicated, -n only keeps a window of the last N matches.
+	"""
+	if sieve is None or sieve == {'external': False, 'dates': [], 'fields': {}, 'number': -1}:
+		yield from events
+		return
+
+	matching = (event for event in events if _event_matches(event, sieve))
+
+	if sieve['number'] > -1:
+		yield from deque(matching, maxlen=sieve['number'])
+	else:
+		yield from matching
+
+
+def _event_matches(event, sieve):
+	if sieve['external'] and event['disconn'] is None:
+		return False
+
+	if sieve['dates'] and not any(event['conn'].startswith(date) for date in sieve['dates']):
+		return False
+
+	if sieve['fields'] and not any(event[key] in vals for key, vals in sieve['fields'].items()):
+		return False
+
+	return True
 
 
 def _represent_events(events_to_show, columns, table_data, title, repres):
@@ -643,33 +1208,117 @@ def _represent_events(events_to_show, columns, table_data, title, repres):
 			'smart':  True
 		}
 
-	max_len = {
-		'conn':     19,
-		'host':     max(max(len(event['host']) for event in events_to_show), len('Host')),
-		'vid':       4,
-		'pid':       4,
-		'prod':     max(max(len(str(event['prod'])) for event in events_to_show), len('Product')),
-		'manufact': max(max(len(str(event['manufact'])) for event in events_to_show), len('Manufacturer')),
-		'serial':   max(max(len(str(event['serial'])) for event in events_to_show), len('Serial Number')),
-		'port':     max(max(len(event['port']) for event in events_to_show), len('Port')),
-		'disconn':  19
-	}
+	# Column widths and the longest value for the list view, both in a single pass
+	widths, list_width = _measure_events(events_to_show, columns, table_data[0])
+
+	event_table = _build_single_table(USBEvents.TableClass, table_data, colored(title, 'white', attrs=['bold']))
+	outer_widths = [width + event_table.padding_left + event_table.padding_right for width in widths]
+	table_ok = table_width(outer_widths, 2, 1) <= terminal_size()[0]  # what event_table.ok would say, without rendering the table
+
+	# Display as table
+	if cfg.ISATTY and (repres['smart'] and table_ok or repres['table']):
+		print_info('Representation: table')
+		_write_lines(itertools.chain(
+			('',),
+			_gen_table_lines(event_table, events_to_show, columns, widths, outer_widths)
+		))
+
+	# Display as list
+	elif not cfg.ISATTY or (repres['smart'] and not table_ok or repres['list']):
+		if not table_ok:
+			print_warning('Terminal window is too small to display table properly')
+			print_warning('Representation: list')
+		else:
+			print_info('Representation: list')
+
+		max_len = list_width + len('Serial Number:  ')  # max length string
+		if not max_len // 2:
+			max_len += 1
+
+		if cfg.ISATTY:
+			cprint('\n' + title, 'white', attrs=['bold'])
+		else:
+			print('\n' + title)
+
+		print(SEPARATOR * max_len)
+
+		labels = _LIST_LABELS + tuple(label for label in _ENRICHED_LIST_LABELS if label[0] in columns)
+		_write_lines(_gen_list_lines(events_to_show, SEPARATOR * max_len, labels))
+
+
+_LIST_LABELS = (
+	('conn',     'Connected:      '),
+	('host',     'Host:           '),
+	('vid',      'VID:            '),
+	('pid',      'PID:            '),
+	('prod',     'Product:        '),
+	('manufact', 'Manufacturer:   '),
+	('serial',   'Serial Number:  '),
+	('port',     'Bus-Port:       '),
+	('disconn',  'Disconnected:   ')
+)
+
+_ENRICHED_LIST_LABELS = (
+	('vendor',   'Vendor:         '),
+	('product',  'Product Name:   ')
+)
+
+_WRITE_CHUNK = 1024  # lines
+
+
+def _measure_events(events_to_show, columns, header):
+	widths = [_visible_width(name) for name in header]
+	list_width = 0
+
+	# Day separator rows fill host/prod/... columns with as many SEPARATORs as the longest
+	# str() of the values (which is "None" for absent ones), conn/disconn are always 19 wide
+	separated = 'conn' in columns
+	if separated:
+		for i, name in enumerate(columns):
+			if name in ('conn', 'disconn'):
+				widths[i] = max(widths[i], 19)
+
+	for event in events_to_show:
+		for i, name in enumerate(columns):
+			val = event[name]
+			width = _visible_width(ABSENCE if val is None else val)
+			if separated and val is None:
+				width = max(width, len(str(val)))
+			if width > widths[i]:
+				widths[i] = width
+
+		for val in event.values():
+			width = len(ABSENCE if val is None else val)
+			if width > list_width:
+				list_width = width
+
+	return (widths, list_width)
+
+
+def _gen_table_rows(events_to_show, columns, widths):
+	"""Table cells (and their visible widths) of every event, with a day separator row in front of each new day."""
+	conn_shown = 'conn' in columns
 
 	prev_cday = ''
 	for event in events_to_show:
-		if 'conn' in columns:
+		if conn_shown:
 			curr_cday = event['conn'][:10]
 			if prev_cday != curr_cday:
-				cday = [f'{curr_cday} {BULLET * (len(event["conn"])-len(curr_cday)-1)}']
-				table_data.append(cday + [SEPARATOR*max_len[name] for name in columns if name != 'conn'])
+				cells = [
+					f'{curr_cday} {BULLET * (len(event["conn"])-len(curr_cday)-1)}' if name == 'conn' else SEPARATOR * width
+					for name, width in zip(columns, widths)
+				]
+				yield (cells, [len(cell) for cell in cells])
 			prev_cday = curr_cday
 
-		row = []
+		row, row_widths = [], []
 		for name in columns:
-			if event[name] is None:
-				event[name] = ABSENCE
-
 			item = event[name]
+			if item is None:
+				item = ABSENCE
+
+			row_widths.append(_visible_width(item))  # before the color codes get in
+
 			if name == 'conn' and cfg.ISATTY:
 				item = colored(item, 'green')
 			elif name == 'disconn' and cfg.ISATTY:
@@ -677,57 +1326,81 @@ def _represent_events(events_to_show, columns, table_data, title, repres):
 
 			row.append(item)
 
-		table_data.append(row)
+		yield (row, row_widths)
 
-	event_table = _build_single_table(USBEvents.TableClass, table_data, colored(title, 'white', attrs=['bold']))
 
-	# Display as table
-	if cfg.ISATTY and (repres['smart'] and event_table.ok or repres['table']):
-		print_info('Representation: table')
-		print('\n' + event_table.table)
+def _gen_table_lines(event_table, events_to_show, columns, widths, outer_widths):
+	"""Lines of event_table as terminaltables would draw them, produced one row at a time."""
+	def border(style):
+		return _squeeze_dec_graphics(''.join(event_table.horizontal_border(style, outer_widths)))
 
-	# Display as list
-	elif not cfg.ISATTY or (repres['smart'] and not event_table.ok or repres['list']):
-		if not event_table.ok:
-			print_warning('Terminal window is too small to display table properly')
-			print_warning('Representation: list')
-		else:
-			print_info('Representation: list')
+	def line(cells, cell_widths, left, center, right):
+		padded = (
+			' ' * (width - cell_width + event_table.padding_left) + cell + ' ' * event_table.padding_right
+			for cell, cell_width, width in zip(cells, cell_widths, widths)
+		)
+		return _squeeze_dec_graphics(left + center.join(padded) + right)
+
+	yield border('top')
+	header = event_table.table_data[0]
+	yield line(
+		header,
+		[_visible_width(cell) for cell in header],
+		event_table.CHAR_H_OUTER_LEFT_VERTICAL,
+		event_table.CHAR_H_INNER_VERTICAL,
+		event_table.CHAR_H_OUTER_RIGHT_VERTICAL
+	)
+	yield border('heading')
+
+	for cells, cell_widths in _gen_table_rows(events_to_show, columns, widths):
+		yield line(
+			cells,
+			cell_widths,
+			event_table.CHAR_OUTER_LEFT_VERTICAL,
+			event_table.CHAR_INNER_VERTICAL,
+			event_table.CHAR_OUTER_RIGHT_VERTICAL
+		)
 
-		max_len = max(len(str(val)) for event in events_to_show for val in event.values()) + len('Serial Number:  ')  # max length string
-		if not max_len // 2:
-			max_len += 1
+	yield border('bottom')
 
-		if cfg.ISATTY:
-			cprint('\n' + title, 'white', attrs=['bold'])
-		else:
-			print('\n' + title)
 
-		print(SEPARATOR * max_len)
+def _visible_width(string):
+	return len(string) if string.isascii() and '\033' not in string else visible_width(string)
+
+
+def _squeeze_dec_graphics(line):
+	# Same as UnixTable.table does: no need to leave and re-enter the line drawing charset between characters
+	return line.replace('\033(B\033(0', '')
+
+
+def _gen_list_lines(events_to_show, separator, labels=_LIST_LABELS):
+	if cfg.ISATTY:
+		labels = [(name, colored(label, 'magenta', attrs=['bold'])) for name, label in labels]
+
+	for event in events_to_show:
+		for name, label in labels:
+			val = event[name]
+			if val is None:
+				val = ABSENCE
 
-		for event in events_to_show:
 			if cfg.ISATTY:
-				print(colored('Connected:      ', 'magenta', attrs=['bold']) + colored(event['conn'], 'green'))
-				print(colored('Host:           ', 'magenta', attrs=['bold']) + event['host'])
-				print(colored('VID:            ', 'magenta', attrs=['bold']) + event['vid'])
-				print(colored('PID:            ', 'magenta', attrs=['bold']) + event['pid'])
-				print(colored('Product:        ', 'magenta', attrs=['bold']) + str(event['prod']))
-				print(colored('Manufacturer:   ', 'magenta', attrs=['bold']) + str(event['manufact']))
-				print(colored('Serial Number:  ', 'magenta', attrs=['bold']) + str(event['serial']))
-				print(colored('Bus-Port:       ', 'magenta', attrs=['bold']) + event['port'])
-				print(colored('Disconnected:   ', 'magenta', attrs=['bold']) + colored(event['disconn'], 'red'))
-			else:
-				print('Connected:      ' + event['conn'])
-				print('Host:           ' + event['host'])
-				print('VID:            ' + event['vid'])
-				print('PID:            ' + event['pid'])
-				print('Product:        ' + str(event['prod']))
-				print('Manufacturer:   ' + str(event['manufact']))
-				print('Serial Number:  ' + str(event['serial']))
-				print('Bus-Port:       ' + event['port'])
-				print('Disconnected:   ' + event['disconn'])
+				if name == 'conn':
+					val = colored(val, 'green')
+				elif name == 'disconn':
+					val = colored(val, 'red')
+
+			yield label + val
+
+		yield separator
 
-			print(SEPARATOR * max_len)
+
+def _write_lines(lines):
+	"""Write lines to stdout in chunks instead of one print() call per line."""
+	write = sys.stdout.write
+	lines = iter(lines)
+	for chunk in iter(lambda: list(itertools.islice(lines, _WRITE_CHUNK)), []):
+		write('\n'.join(chunk) + '\n')
+	sys.stdout.flush()
 
 
 def _build_single_table(TableClass, table_data, title, align='right', inner_row_border=False):
@@ -743,29 +1416,51 @@ def _build_single_table(TableClass, table_data, title, align='right', inner_row_
 	return single_table
 
 
-def _dump_events(events_to_show, list_name, abs_filename, indent):
-	print_info(f'Generating {list_name} list (JSON)')
+def _columns_to_show(columns, enrich):
+	"""Columns and the table header; with enrich the usb.ids names follow the PID unless asked for explicitly."""
+	columns = list(columns or COLUMN_NAMES.keys())
 
-	out = []
-	for event in events_to_show:
-		tmp_event_dict = OrderedDict()
+	if enrich and not any(name in ENRICHED_COLUMN_NAMES for name in columns):
+		pos = columns.index('pid') + 1 if 'pid' in columns else len(columns)
+		columns[pos:pos] = ENRICHED_COLUMN_NAMES.keys()
+
+	header = [COLUMN_NAMES[name] if name in COLUMN_NAMES else ENRICHED_COLUMN_NAMES[name] for name in columns]
+	return (columns, [header])
+
+
+def _tqdm(*args, **kwargs):
+	from tqdm import tqdm  # progress bars are only shown while events are parsed, keep it off the startup path
+	return tqdm(*args, **kwargs)
 
-		for key in ('conn', 'host', 'vid', 'pid', 'prod', 'manufact', 'serial', 'port', 'disconn'):
-			tmp_event_dict[key] = event[key]
 
-		out.append(tmp_event_dict)
+def _export_fields(enrich):
+	return tuple(COLUMN_NAMES.keys()) + (tuple(ENRICHED_COLUMN_NAMES.keys()) if enrich else ())
+
+
+def _export_events(events_to_show, list_name, fmt, output, indent, enrich=False):
+	"""Write events in the format requested on the command line; return the number of events written."""
+	from usbrip.lib.core.eventdump import export_events
+
+	abs_output = os.path.abspath(output) if output else None
 
 	try:
-		with open(abs_filename, 'w', encoding='utf-8') as out_json:
-			json.dump(out, out_json, indent=indent)
+		count = export_events(events_to_show, fmt, abs_output, indent=indent, fields=_export_fields(enrich))
+	except USBRipError as e:
+		print_critical(str(e), initial_error=e.errors['initial_error'])
+		return 0
 
-	except PermissionError as e:
-		raise USBRipError(
-			f'Permission denied: "{abs_filename}". Retry with sudo',
-			errors={'initial_error': str(e)}
-		)
+	if abs_output:
+		print_info(f'Wrote {count} events of {list_name} ({fmt}): "{abs_output}"')
 
-	os.chmod(abs_filename, stat.S_IRUSR | stat.S_IWUSR)  # 600
+	return count
+
+
+def _dump_events(events_to_show, list_name, abs_filename, indent, *, fmt='json', enrich=False):
+	from usbrip.lib.core.eventdump import export_events
+
+	print_info(f'Generating {list_name} list ({"JSON" if fmt == "json" else fmt})')
+
+	export_events(events_to_show, fmt, abs_filename, indent=indent, fields=_export_fields(enrich))
 
 	print_info(f'New {list_name} list: "{abs_filename}"')
 
@@ -776,13 +1471,17 @@ def _output_choice(list_name, default_filename):
 
 		print('    1. Terminal stdout')
 		print('    2. JSON-file')
+		print('    3. Columnar binary file (compact, fast to open)')
 
 		choice = input('\n[>] Please enter the number of your choice (default 1): ')
 
 		if choice == '1' or choice == '':
 			return (choice, '')
 
-		elif choice == '2':
+		elif choice in ('2', '3'):
+			extension = '.json' if choice == '2' else '.ucd'  # eventdump.EXTENSION
+			default_filename = os.path.splitext(default_filename)[0] + extension
+
 			while True:
 				filename = input(
 					f'[>] Please enter the output file name '
@@ -792,8 +1491,8 @@ def _output_choice(list_name, default_filename):
 				if all(c in printable for c in filename) and len(filename) < 256:
 					if not filename:
 						filename = default_filename
-					elif os.path.splitext(filename)[-1] != '.json':
-						filename = filename + '.json'
+					elif os.path.splitext(filename)[-1] != extension:
+						filename = filename + extension
 
 					abs_filename = os.path.join(os.path.abspath(os.getcwd()), filename)
 
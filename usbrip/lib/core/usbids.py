@@ -31,14 +31,23 @@ __email__  = 'snovvcrash@protonmail[.]ch'
 __site__   = 'https://github.com/snovvcrash/usbrip'
 __brief__  = 'USB IDs handler'
 
+import io
 import re
+import csv
+import json
 import socket
 import os
+import sys
+import shutil
+import marshal
+from array import array
+from collections import Counter
+from itertools import chain
 from pathlib import Path
 
-from urllib.request import urlopen
-
 import usbrip.lib.core.config as cfg
+from usbrip.lib.core.common import USB_IDS_URL
+from usbrip.lib.core.common import ABSENCE
 from usbrip.lib.core.common import os_makedirs
 from usbrip.lib.core.common import print_info
 from usbrip.lib.core.common import print_warning
@@ -59,14 +68,16 @@ class USBIDs:
 	_SERVER_TIMEOUT_ERROR      = -2
 	_SERVER_CONTENT_ERROR      = -3
 
+	DATABASE_URL = USB_IDS_URL
+
 	@staticmethod
 	@time_it_if_debug(cfg.DEBUG, time_it)
-	def search_ids(vid, pid, *, offline=True):
+	def search_ids(vid, pid, *, offline=True, mirror=None):
 		if offline:
 			print_warning('Offline mode')
 
 		try:
-			usb_ids = USBIDs.prepare_database(offline=offline)
+			usb_ids = USBIDs.prepare_database(offline=offline, mirror=mirror)
 		except USBRipError as e:
 			print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
 		else:
@@ -75,31 +86,161 @@ class USBIDs:
 
 	@staticmethod
 	@time_it_if_debug(cfg.DEBUG, time_it)
-	def prepare_database(*, offline=True):
-		filename = f'{os.path.abspath(str(Path.home()))}/.config/usbrip/usb.ids'
+	def search_ids_batch(input_file):
+		"""
+		Resolve (vid, pid) pairs read from a CSV (with a header naming the "vid"/"pid" columns)
+		or NDJSON file ("-" for stdin), writing every record back in the same format with
+		"vendor" and "product" added. The local database is used as is (no update check).
+		"""
+		try:
+			usb_ids = USBIDs.prepare_database(offline=True)
+		except USBRipError as e:
+			print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
+			return 1
+
+		with usb_ids:
+			index = _load_index(usb_ids)
+
+		try:
+			source = sys.stdin if input_file == '-' else open(input_file, 'r', encoding='utf-8', newline='')
+		except OSError as e:
+			print_critical(f'Could not open input file: "{input_file}"', initial_error=str(e))
+			return 1
+
+		try:
+			with source:
+				_search_ids_batch_helper(index, source, sys.stdout)
+			sys.stdout.flush()
+		except USBRipError as e:
+			print_critical(str(e), initial_error=e.errors['initial_error'])
+			return 1
+		except BrokenPipeError:
+			# The reader has gone away (e.g. "| head"), do not let the interpreter complain on exit
+			os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+	@staticmethod
+	@time_it_if_debug(cfg.DEBUG, time_it)
+	def find_ids(text, *, limit=20):
+		"""Vendors and products whose names look like text (partial, case-insensitive, typos allowed)."""
+		try:
+			usb_ids = USBIDs.prepare_database(offline=True)
+		except USBRipError as e:
+			print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
+			return 1
+
+		with usb_ids:
+			index = _load_index(usb_ids)
+			name_index = _load_name_index(usb_ids, index)
+
+		print('Searching for matches... ', end='')
+		matches = _find_names(name_index, text, limit)
+		print('Done\n')
+
+		print('| Possible matches:')
+
+		if not matches:
+			print('|_    no results')
+		else:
+			for i, (vid, pid, name) in enumerate(matches):
+				if pid:
+					line = f'{vid}:{pid}  {index["vendors"].get(vid, ABSENCE)} / {name}'
+				else:
+					line = f'{vid}       {name}'
+
+				if i != len(matches)-1:
+					print(f'|     {line}')
+				else:
+					print(f'|_    {line}')
+
+		print()
+
+	@staticmethod
+	@time_it_if_debug(cfg.DEBUG, time_it)
+	def prepare_database(*, offline=True, mirror=None):
+		filename = _database_filename()
 		file_exists = os.path.isfile(filename)
+		url = mirror or USBIDs.DATABASE_URL
 
 		if file_exists and offline:
 			usb_ids = open(filename, 'r', encoding='utf-8')
 		elif file_exists and not offline:
-			usb_ids = _update_database(filename)
+			usb_ids = _update_database(filename, url)
 		elif not file_exists and not offline:
 			print_warning('No local database found, trying to download')
-			usb_ids = _download_database(filename)
+			usb_ids = _download_database(filename, url)
 		elif not file_exists and offline:
 			raise USBRipError('No local database found')
 
 		return usb_ids
 
 
+# ----------------------------------------------------------
+# ----------------------- Enrichment -----------------------
+# ----------------------------------------------------------
+
+
+def enrich_events(events):
+	"""
+	Add the usb.ids names of the vendor and the product ('vendor', 'product') to events. Names are
+	resolved when an event is accessed, once per distinct (vid, pid), so only the events that get
+	output are looked up. A sequence stays a sequence (len and indexing), any other iterable is mapped.
+	"""
+	try:
+		usb_ids = USBIDs.prepare_database(offline=True)
+	except USBRipError as e:
+		print_warning(f'{e}, vendor and product names are left empty (try "usbrip ids download")')
+		index = {'vendors': {}, 'products': {}}
+	else:
+		with usb_ids:
+			index = _load_index(usb_ids)
+
+	names = {}
+
+	def enrich(event):
+		pair = (event['vid'], event['pid'])
+		if pair not in names:
+			names[pair] = (index['vendors'].get(pair[0]), index['products'].get(pair))
+
+		vendor, product = names[pair]
+		return dict(event, vendor=vendor, product=product)
+
+	if hasattr(events, '__getitem__') and hasattr(events, '__len__'):
+		return EnrichedEvents(events, enrich)
+
+	return map(enrich, events)
+
+
+class EnrichedEvents:
+	"""A sequence of events that are enriched as they are accessed."""
+
+	def __init__(self, events, enrich):
+		self._events = events
+		self._enrich = enrich
+
+	def __len__(self):
+		return len(self._events)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self._enrich(event) for event in self._events[i]]
+		return self._enrich(self._events[i])
+
+	def __iter__(self):
+		return map(self._enrich, self._events)
+
+
 # ----------------------------------------------------------
 # ----------------------- Utilities ------------------------
 # ----------------------------------------------------------
 
 
-def _update_database(filename):
+def _database_filename():
+	return f'{os.path.abspath(str(Path.home()))}/.config/usbrip/usb.ids'
+
+
+def _update_database(filename, url):
 	try:
-		usb_ids = open(filename, 'r+', encoding='utf-8')
+		usb_ids = open(filename, 'r', encoding='utf-8')
 	except PermissionError as e:
 		raise USBRipError(
 			f'Permission denied: "{filename}"',
@@ -112,49 +253,54 @@ def _update_database(filename):
 	print(f'Date:     {curr_date}')
 
 	print_info('Checking local database for update')
-	db, latest_ver, latest_date, errcode, e = _get_latest_version()
 
-	if errcode:
+	try:
+		latest = _fetch_database(filename, url, current=(curr_ver, curr_date))
+	except USBRipError as e:
+		errcode = e.errors['errcode']
+
 		if errcode == USBIDs._INTERNET_CONNECTION_ERROR:
 			print_warning(
 				'No internet connection, using current version',
-				errcode=errcode
+				errcode=errcode,
+				initial_error=e.errors['initial_error']
 			)
 
 		elif errcode == USBIDs._SERVER_TIMEOUT_ERROR:
 			print_warning(
 				'Server timeout, using current version',
 				errcode=errcode,
-				initial_error=e
+				initial_error=e.errors['initial_error']
 			)
 
 		elif errcode == USBIDs._SERVER_CONTENT_ERROR:
 			print_warning(
 				'Server error, using current version',
 				errcode=errcode,
-				initial_error=e
+				initial_error=e.errors['initial_error']
 			)
 
-		return usb_ids
+		else:
+			raise
 
-	if curr_ver != latest_ver and curr_date != latest_date:  # if there's newer database version
-		print('Updating database... ', end='')
+		return usb_ids
 
-		usb_ids.write(db)
-		usb_ids.truncate()
-		usb_ids.seek(0)
+	if latest:  # if there's newer database version
+		print('Updating database... Done\n')
 
-		print('Done\n')
+		# The old file was replaced, not rewritten, so the handle still reads the old contents
+		usb_ids.close()
+		usb_ids = open(filename, 'r', encoding='utf-8')
 
-		print(f'Version:  {latest_ver}')
-		print(f'Date:     {latest_date}')
+		print(f'Version:  {latest[0]}')
+		print(f'Date:     {latest[1]}')
 
 	print_info('Local database is up-to-date')
 
 	return usb_ids
 
 
-def _download_database(filename):
+def _download_database(filename, url):
 	try:
 		dirname = os.path.dirname(filename)
 		os_makedirs(dirname)
@@ -164,125 +310,236 @@ def _download_database(filename):
 		print_info(f'Created directory "{dirname}/"')
 
 	try:
-		usb_ids = open(filename, 'w+', encoding='utf-8')
-	except PermissionError as e:
-		raise USBRipError(
-			f'Permission denied: "{filename}"',
-			errors={'initial_error': str(e)}
-		)
-
-	db, latest_ver, latest_date, errcode, e = _get_latest_version()
-
-	if errcode:
-		usb_ids.close()
-		os.remove(filename)
+		latest_ver, latest_date = _fetch_database(filename, url)
+	except USBRipError as e:
+		errcode = e.errors['errcode']
 
 		if errcode == USBIDs._INTERNET_CONNECTION_ERROR:
 			errmsg = 'No internet connection'
 		elif errcode == USBIDs._SERVER_TIMEOUT_ERROR:
 			errmsg = 'Server timeout'
 		elif errcode == USBIDs._SERVER_CONTENT_ERROR:
-			errmsg = 'Server content error: no version or date found'
-
-		raise USBRipError(errmsg, errors={'errcode': errcode, 'initial_error': e})
+			errmsg = str(e)
+		else:
+			raise
 
-	usb_ids.write(db)
-	usb_ids.seek(0)
+		raise USBRipError(errmsg, errors={'errcode': errcode, 'initial_error': e.errors['initial_error']})
 
 	print_info('Database downloaded')
 
 	print(f'Version:  {latest_ver}')
 	print(f'Date:     {latest_date}')
 
-	return usb_ids
+	return open(filename, 'r', encoding='utf-8')
 
 
 def _get_current_version(usb_ids):
-	db = usb_ids.read()
-	usb_ids.seek(0)
+	curr_ver, curr_date = _read_header(usb_ids)
 
-	try:
-		curr_ver = re.search(r'^# Version:\s*(.*?$)', db, re.MULTILINE).group(1)
-		curr_date = re.search(r'^# Date:\s*(.*?$)', db, re.MULTILINE).group(1)
-	except AttributeError as e:
+	if curr_ver is None or curr_date is None:
 		raise USBRipError(
 			'Invalid database content structure: no version or date found',
-			errors={'initial_error': str(e)}
+			errors={'initial_error': f'Version: {curr_ver}, Date: {curr_date}'}
 		)
 
 	return (curr_ver, curr_date)
 
 
-def _get_latest_version():
-	connected, errcode, e = _check_connection('www.google.com')
-	if not connected:
-		return (None, -1, -1, errcode, e)
+def _fetch_database(filename, url, *, current=None):
+	"""
+	Download the database from url to filename and return its (version, date), or None if it
+	is not newer than the current one. With a current database the request is conditional
+	(ETag/Last-Modified of the previous download are kept in a sidecar file), so an unchanged
+	database costs one round trip; the body is streamed to a temporary file and swapped in.
+	"""
+	# urllib pulls in http.client, ssl and email, too heavy for every "events" run that only enriches
+	from http.client import HTTPException
+	from urllib.error import HTTPError
+	from urllib.request import Request
+	from urllib.request import urlopen
+
+	validators = _read_validators(filename, url) if current else {}
+
+	headers = {}
+	if validators.get('etag'):
+		headers['If-None-Match'] = validators['etag']
+	if validators.get('last_modified'):
+		headers['If-Modified-Since'] = validators['last_modified']
 
-	print_info('Getting latest version and date')
+	print_info(f'Requesting database: "{url}"')
 
 	try:
-		html = urlopen('http://www.linux-usb.org/usb.ids', timeout=10).read()
-		#from requests import get
-		#resp = get('http://www.linux-usb.org/usb.ids', timeout=10)
-	except socket.timeout as e:
-	#except requests.exceptions.Timeout as e:
-		return (None, -1, -1, USBIDs._SERVER_TIMEOUT_ERROR, str(e))
+		response = urlopen(Request(url, headers=headers), timeout=10)
+	except HTTPError as e:
+		if e.code == 304:
+			return None
+		raise USBRipError(
+			f'Server content error: HTTP {e.code}',
+			errors={'errcode': USBIDs._SERVER_CONTENT_ERROR, 'initial_error': str(e)}
+		)
+	except (OSError, HTTPException) as e:
+		raise _connection_error(e)
 
-	db = html.decode('cp1252')
-	#soup = BeautifulSoup(resp.text, 'html.parser')
-	#db = soup.text
+	tmp_filename = filename + '.new'
 
 	try:
-		latest_ver  = re.search(r'^# Version:\s*(.*?$)', db, re.MULTILINE).group(1)
-		latest_date = re.search(r'^# Date:\s*(.*?$)', db, re.MULTILINE).group(1)
-	except AttributeError as e:
-		return (None, -1, -1, USBIDs._SERVER_CONTENT_ERROR, str(e))
+		charset = response.headers.get_content_charset() or 'utf-8'
+		with response, open(tmp_filename, 'w', encoding='utf-8', newline='') as f:
+			shutil.copyfileobj(io.TextIOWrapper(response, encoding=charset, errors='replace', newline=''), f)
+
+		with open(tmp_filename, 'r', encoding='utf-8') as f:
+			latest = _read_header(f)
+	except PermissionError as e:
+		_remove_file(tmp_filename)
+		raise USBRipError(
+			f'Permission denied: "{tmp_filename}"',
+			errors={'initial_error': str(e)}
+		)
+	except (OSError, HTTPException) as e:
+		_remove_file(tmp_filename)
+		raise _connection_error(e)
+
+	if None in latest:
+		_remove_file(tmp_filename)
+		raise USBRipError(
+			'Server content error: no version or date found',
+			errors={'errcode': USBIDs._SERVER_CONTENT_ERROR, 'initial_error': f'Version: {latest[0]}, Date: {latest[1]}'}
+		)
+
+	if current and (latest[0] == current[0] or latest[1] == current[1]):
+		_remove_file(tmp_filename)
+		latest = None
+	else:
+		os.replace(tmp_filename, filename)
+
+	_write_validators(filename, url, response.headers)
+
+	return latest
+
 
-	return (db, latest_ver, latest_date, 0, '')
+def _connection_error(e):
+	if isinstance(e, socket.timeout) or isinstance(getattr(e, 'reason', None), socket.timeout):
+		return USBRipError('Server timeout', errors={'errcode': USBIDs._SERVER_TIMEOUT_ERROR, 'initial_error': str(e)})
+	return USBRipError('No internet connection', errors={'errcode': USBIDs._INTERNET_CONNECTION_ERROR, 'initial_error': str(e)})
 
 
-def _check_connection(hostname):
+def _read_validators(filename, url):
+	"""ETag and Last-Modified of the last download from url."""
 	try:
-		host = socket.gethostbyname(hostname)
-		socket.create_connection((host, 80), 2)
-		return (True, 0, '')
-	except Exception as e:
-		return (False, USBIDs._INTERNET_CONNECTION_ERROR, str(e))
+		with open(filename + '.http', 'r', encoding='utf-8') as f:
+			validators = json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+	return validators if isinstance(validators, dict) and validators.get('url') == url else {}
+
+
+def _write_validators(filename, url, headers):
+	validators = {
+		'url':           url,
+		'etag':          headers.get('ETag'),
+		'last_modified': headers.get('Last-Modified')
+	}
+
+	try:
+		with open(filename + '.http', 'w', encoding='utf-8') as f:
+			json.dump(validators, f)
+	except OSError as e:
+		print_warning(f'Could not save HTTP validators: "{filename}.http"', initial_error=str(e))
+
+
+def _remove_file(filename):
+	if os.path.exists(filename):
+		os.remove(filename)
+
+
+def _search_ids_batch_helper(index, lines, out):
+	first_line = next(lines, '')
+	lines = chain((first_line,), lines)
+
+	names = {}
+
+	def resolve(vid, pid):
+		pair = (vid, pid)
+		if pair not in names:
+			vid, pid = _normalize_id(vid), _normalize_id(pid)
+			names[pair] = (index['vendors'].get(vid), index['products'].get((vid, pid)))
+		return names[pair]
+
+	if first_line.lstrip().startswith('{'):
+		for line_number, line in enumerate(lines, 1):
+			if not line.strip():
+				continue
+
+			try:
+				record = json.loads(line)
+				record['vendor'], record['product'] = resolve(record.get('vid'), record.get('pid'))
+			except (json.decoder.JSONDecodeError, AttributeError) as e:
+				raise USBRipError(f'Invalid NDJSON record on line {line_number}', errors={'initial_error': str(e)})
+
+			out.write(json.dumps(record) + '\n')
+
+		return
+
+	reader = csv.reader(lines)
+	header = next(reader, None)
+	if header is None:
+		return
+
+	columns = [name.strip().lower() for name in header]
+	if 'vid' not in columns and 'pid' not in columns:
+		raise USBRipError('No "vid" or "pid" column in the CSV header', errors={'initial_error': ','.join(header)})
+
+	vid_column = columns.index('vid') if 'vid' in columns else None
+	pid_column = columns.index('pid') if 'pid' in columns else None
+
+	def cell(row, column):
+		return row[column] if column is not None and column < len(row) else None
+
+	writer = csv.writer(out)
+	writer.writerow(header + ['vendor', 'product'])
+
+	for row in reader:
+		vendor, product = resolve(cell(row, vid_column), cell(row, pid_column))
+		writer.writerow(row + [vendor or '', product or ''])
+
+
+def _normalize_id(value):
+	"""'0x781', ' 0781 ' and 781 are all '0781'."""
+	if value is None:
+		return None
+
+	value = str(value).strip().lower()
+	if value.startswith('0x'):
+		value = value[2:]
+
+	return value.zfill(4) if value else None
 
 
 def _search_ids_helper(usb_ids, vid, pid):
 	print('Searching for matches... ', end='')
 
+	index = _load_index(usb_ids)
+
 	if vid and pid:
-		re_vid = re.compile(rf'^{vid}  (.*?$)')
-		re_pid = re.compile(rf'^\t{pid}  (.*?$)')
-
-		for line in iter(usb_ids.readline, ''):
-			vid_match = re_vid.match(line)
-			if vid_match:
-				for subline in iter(usb_ids.readline, ''):
-					if subline[0] == '\t':
-						pid_match = re_pid.match(subline)
-						if pid_match:
-							print('Done\n')
-							print(f'Vendor:   {vid_match.group(1)}')
-							print(f'Product:  {pid_match.group(1)}')
-							break
-					else:
-						print('Done\n')
-						print('No such pair of (vendor, product) found')
-						break
-				print()
-				return
+		if vid in index['vendors']:
+			print('Done\n')
+			if (vid, pid) in index['products']:
+				print(f'Vendor:   {index["vendors"][vid]}')
+				print(f'Product:  {index["products"][(vid, pid)]}')
+			else:
+				print('No such pair of (vendor, product) found')
+			print()
+			return
 
 		print('Done\n')
 		print('No such vendor found')
 
 	else:  # if (vid and not pid) or (pid and not vid):
 		if vid and not pid:
-			matches = re.findall(rf'^{vid}  (.*?$)', usb_ids.read(), re.MULTILINE)
+			matches = [index['vendors'][vid]] if vid in index['vendors'] else []
 		else:  # if pid and not vid
-			matches = re.findall(rf'^\t{pid}  (.*?$)', usb_ids.read(), re.MULTILINE)
+			matches = [index['products'][(vendor, pid)] for vendor in index['vendors_by_pid'].get(pid, [])]
 
 		print('Done\n')
 		print('| Possible products:')
@@ -297,3 +554,167 @@ def _search_ids_helper(usb_ids, vid, pid):
 					print(f'|_    {match}')
 
 	print()
+
+
+# ----------------------------------------------------------
+# ------------------------ IDs Index -----------------------
+# ----------------------------------------------------------
+
+
+_INDEX_FORMAT = 1
+_NAME_INDEX_FORMAT = 1
+_RE_VENDOR = re.compile(r'^([0-9a-f]{4})  (.*?)$')
+_RE_PRODUCT = re.compile(r'^\t([0-9a-f]{4})  (.*?)$')
+
+
+def _load_index(usb_ids):
+	"""
+	Return the database compiled into dicts (vendor -> name, (vendor, product) -> name,
+	product -> vendors), cached next to the database and rebuilt when its version or date changes.
+	"""
+	return _load_cached(usb_ids.name + '.idx', _read_header(usb_ids), _INDEX_FORMAT, lambda: _compile_index(usb_ids))
+
+
+def _load_name_index(usb_ids, index):
+	"""
+	Return the trigram index over vendor and product names (see _build_name_index),
+	cached next to the database along with the compiled one.
+	"""
+	return _load_cached(usb_ids.name + '.tri', index['header'], _NAME_INDEX_FORMAT, lambda: _build_name_index(index))
+
+
+def _load_cached(filename, header, fmt, build):
+	"""Unmarshal a structure derived from the database, build and save it if it is missing or stale."""
+	try:
+		with open(filename, 'rb') as f:
+			cached = marshal.loads(f.read())  # marshal.load() on a file is an order of magnitude slower
+		if cached['format'] == fmt and cached['header'] == header:
+			return cached
+	except (OSError, EOFError, ValueError, TypeError, KeyError):
+		pass
+
+	cached = build()
+	cached['format'] = fmt
+	cached['header'] = header
+
+	try:
+		with open(filename + '.new', 'wb') as f:
+			marshal.dump(cached, f)
+		os.replace(filename + '.new', filename)
+	except OSError as e:
+		print_warning(f'Could not cache compiled database: "{filename}"', initial_error=str(e))
+
+	return cached
+
+
+def _read_header(usb_ids):
+	"""Version and date from the comment block at the top of the database."""
+	version = date = None
+
+	for line in usb_ids:
+		if not line.startswith('#') and line.strip():
+			break
+		if line.startswith('# Version:'):
+			version = line.split(':', 1)[1].strip()
+		elif line.startswith('# Date:'):
+			date = line.split(':', 1)[1].strip()
+
+	usb_ids.seek(0)
+	return (version, date)
+
+
+def _compile_index(usb_ids):
+	vendors, products, vendors_by_pid = {}, {}, {}
+	vid = None
+
+	for line in usb_ids:
+		if not line.strip() or line.startswith('#'):
+			continue
+
+		if line[0] != '\t':
+			# Anything but a vendor (device classes, HID usages, languages, ...) ends the device list
+			vendor_match = _RE_VENDOR.match(line)
+			vid = vendor_match.group(1) if vendor_match else None
+			if vendor_match:
+				vendors.setdefault(vid, vendor_match.group(2))
+
+		elif vid is not None:
+			product_match = _RE_PRODUCT.match(line)
+			if product_match and (vid, product_match.group(1)) not in products:
+				pid = product_match.group(1)
+				products[(vid, pid)] = product_match.group(2)
+				vendors_by_pid.setdefault(pid, []).append(vid)
+
+	usb_ids.seek(0)
+
+	return {
+		'vendors':        vendors,
+		'products':       products,
+		'vendors_by_pid': vendors_by_pid
+	}
+
+
+def _build_name_index(index):
+	"""
+	Every vendor and product as an entry (vid, pid, name), pid is '' for vendors, the lower-cased
+	text it is found by (a product is found by its vendor name too) and an inverted index from the
+	trigrams of those texts to the entries (packed arrays of entry numbers, only the ones a query
+	needs are unpacked).
+	"""
+	vendors = index['vendors']
+
+	entries = [(vid, '', name) for vid, name in vendors.items()]
+	entries += [(vid, pid, name) for (vid, pid), name in index['products'].items()]
+
+	texts = [(f'{vendors.get(vid, "")} {name}' if pid else name).lower() for vid, pid, name in entries]
+
+	postings = {}
+	for number, text in enumerate(texts):
+		for trigram in _trigrams(text):
+			postings.setdefault(trigram, array('I')).append(number)
+
+	return {
+		'entries':  entries,
+		'texts':    texts,
+		'trigrams': {trigram: numbers.tobytes() for trigram, numbers in postings.items()}
+	}
+
+
+def _trigrams(text):
+	text = f' {text.lower()} '
+	return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+def _find_names(name_index, text, limit):
+	"""
+	Entries ranked by how well they match text: the ones containing it come first (from the start of
+	a word before the others, vendors before products), then the ones sharing the most of its trigrams
+	(at least half of them, so that typos still match); shorter names go before longer ones.
+	"""
+	query = ' '.join(text.lower().split())
+	query_trigrams = _trigrams(query)
+	texts = name_index['texts']
+
+	if len(query) < 3:
+		# Too short to have trigrams of its own, look for it in every text
+		candidates = {number: len(query_trigrams) for number, entry_text in enumerate(texts) if query in entry_text}
+	else:
+		candidates = Counter()
+		for trigram in query_trigrams:
+			numbers = array('I')
+			numbers.frombytes(name_index['trigrams'].get(trigram, b''))
+			candidates.update(numbers)
+
+	re_word_start = re.compile(r'\b' + re.escape(query))
+
+	ranked = []
+	for number, shared in candidates.items():
+		entry_text = texts[number]
+		contains = query in entry_text
+		if contains or shared >= len(query_trigrams) / 2:
+			vid, pid, name = name_index['entries'][number]
+			word_start = contains and re_word_start.search(entry_text) is not None
+			ranked.append((not contains, not word_start, contains and bool(pid), -shared, bool(pid), len(name), number))
+
+	ranked.sort()
+	return [name_index['entries'][number] for *_, number in ranked[:limit]]
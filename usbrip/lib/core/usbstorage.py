@@ -26,25 +26,42 @@ __email__  = 'snovvcrash@protonmail[.]ch'
 __site__   = 'https://github.com/snovvcrash/usbrip'
 __brief__  = 'USB Storage handler'
 
-import re
 import json
-import subprocess
 import os
+import shutil
 import stat
-from datetime import datetime
+import struct
+import fcntl
+import heapq
+import itertools
+import tempfile
+from contextlib import contextmanager
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+from datetime import datetime, timedelta
 from getpass import getpass
 from configparser import ConfigParser
 
 import usbrip.lib.core.config as cfg
 from usbrip.lib.core.usbevents import USBEvents
 from usbrip.lib.core.usbevents import _filter_events
-from usbrip.lib.core.usbevents import _dump_events
+from usbrip.lib.core.usbevents import _filter_sorted_events
+from usbrip.lib.core.usbevents import _represent_events
 from usbrip.lib.core.usbevents import _process_auth_list
+from usbrip.lib.core.storagebackend import WRONG_PASSWORD_ERROR
+from usbrip.lib.core.storagebackend import PERMISSION_ERROR
+from usbrip.lib.core.storagebackend import UNKNOWN_ERROR
+from usbrip.lib.core.storagebackend import BACKENDS
+from usbrip.lib.core.storagebackend import SevenZipBackend
+from usbrip.lib.core.storagebackend import get_backend
+from usbrip.lib.core.storagebackend import fsync
 from usbrip.lib.core.common import CONFIG_FILE
+from usbrip.lib.core.common import STORAGE_BASE
+from usbrip.lib.core.common import ABSENCE
+from usbrip.lib.core.common import COLUMN_NAMES
 from usbrip.lib.core.common import USBRipError
-from usbrip.lib.core.common import union_event_sets
 from usbrip.lib.core.common import print_info
-from usbrip.lib.core.common import print_warning
 from usbrip.lib.core.common import print_critical
 from usbrip.lib.core.common import print_secret
 from usbrip.lib.utils.debug import time_it
@@ -57,57 +74,92 @@ from usbrip.lib.utils.debug import time_it_if_debug
 
 
 class USBStorage:
-
-	_STORAGE_BASE = '/var/opt/usbrip/storage'
-
-	_7Z_WRONG_PASSWORD_ERROR = -1
-	_7Z_PERMISSION_ERROR     = -2
-	_7Z_UNKNOWN_ERROR        = -3
+	"""
+	A storage is a directory of encrypted 7-Zip segments (one per update), an encrypted
+	manifest that lists them with their event counts and connection date bounds, and an
+	encrypted index of event fingerprints (with the "lzma" backend the same objects are
+	unencrypted .xz files, see storagebackend):
+
+	    /var/opt/usbrip/storage/history/manifest.7z
+	    /var/opt/usbrip/storage/history/index.7z
+	    /var/opt/usbrip/storage/history/000001.7z
+	    /var/opt/usbrip/storage/history/000002.7z
+	    ...
+
+	Updates only encrypt the events that are not in the storage yet, existing segments are never rewritten.
+	Listing reads just the manifest; opens with dates and updates decrypt only the segments whose
+	date bounds can matter.
+
+	Compaction merges runs of small segments into larger ones and drops whatever is older than
+	the retention window, so neither the number of segments nor the disk use grow without bound.
+
+	Writers (update, create, passwd, compact) take an exclusive lock per storage and commit by atomically
+	replacing the manifest, so readers (list, open) need no lock and always see the last committed
+	version. Segment files are never modified once written.
+	"""
+
+	_STORAGE_BASE = STORAGE_BASE
+	_MANIFEST = 'manifest'
+	_INDEX = 'index'
+
+	_7Z_WRONG_PASSWORD_ERROR = WRONG_PASSWORD_ERROR
+	_7Z_PERMISSION_ERROR     = PERMISSION_ERROR
+	_7Z_UNKNOWN_ERROR        = UNKNOWN_ERROR
 
 	# -------------------- USB Storage List --------------------
 
 	@staticmethod
 	@time_it_if_debug(cfg.DEBUG, time_it)
-	def list_storage(storage_type, password):
-		storage_full_path = os.path.join(USBStorage._STORAGE_BASE, f'{storage_type}.7z')
-		if not os.path.isfile(storage_full_path):
-			print_critical(f'Storage not found: "{storage_full_path}"')
-			return
-
+	def list_storage(storage_type, password, *, backend='7z'):
 		try:
-			out = _7zip_list(storage_full_path, password)
+			backend = get_backend(backend, password)
+			storage_dir, manifest = _open_storage(storage_type, backend)
+			sizes = [backend.stat(os.path.join(storage_dir, segment['name'])).st_size for segment in manifest['segments']]
 		except USBRipError as e:
 			print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
 			return
+		except OSError as e:
+			print_critical('Storage segment is missing', initial_error=str(e))
+			return
 
-		if '--' in out:
-			print(out[out.index('--'):] + '--')
-		else:
-			print_critical('Undefined behaviour while listing storage contents', initial_error=out)
+		segments = manifest['segments']
+		first = min((segment['min'] for segment in segments if segment['events']), default=None)
+		last = max((segment['max'] for segment in segments if segment['events']), default=None)
+
+		print(f'Storage: {storage_dir} ({backend.name})\n')
+		print(f'{"Segment":<12}{"Events":>10}{"Size":>12}  {"First":<19}  {"Last":<19}')
+		print('-' * 76)
+
+		for segment, size in zip(segments, sizes):
+			print(f'{segment["name"]:<12}{segment["events"]:>10}{size:>12}  {segment["min"] or ABSENCE:<19}  {segment["max"] or ABSENCE:<19}')
+
+		print('-' * 76)
+		print(f'{len(segments):<12}{sum(segment["events"] for segment in segments):>10}{sum(sizes):>12}  {first or ABSENCE:<19}  {last or ABSENCE:<19}')
 
 	# -------------------- USB Storage Open --------------------
 
 	@staticmethod
 	@time_it_if_debug(cfg.DEBUG, time_it)
-	def open_storage(storage_type, password, columns, *, sieve=None, repres=None):
-		storage_full_path = os.path.join(USBStorage._STORAGE_BASE, f'{storage_type}.7z')
-		if not os.path.isfile(storage_full_path):
-			print_critical(f'Storage not found: "{storage_full_path}"')
-			return
-
+	def open_storage(storage_type, password, columns, *, sieve=None, repres=None, backend='7z'):
+		# Segments are streamed in connection order and filtered on the fly, only the events to show are kept
 		try:
-			out = _7zip_unpack(storage_full_path, password)
+			events_dumped = _read_storage_events(storage_type, get_backend(backend, password), sieve['dates'] if sieve else [])
+			events_to_show = _filter_sorted_events(events_dumped, sieve)
 		except USBRipError as e:
 			print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
 			return
 
-		if 'Everything is Ok' in out:
-			base_filename = re.search(r'([^\n ]*\.json)', _7zip_list(storage_full_path, password), re.MULTILINE).group(1)
-			json_file = os.path.join(USBStorage._STORAGE_BASE, base_filename)
-			USBEvents.open_dump(json_file, columns, sieve=sieve, repres=repres)
-			_shred(json_file)
+		if not events_to_show:
+			print_info('No USB events found!')
+			return
+
+		if columns:
+			table_data = [[COLUMN_NAMES[name] for name in columns]]
 		else:
-			print_critical('Undefined behaviour while unpacking storage', initial_error=out)
+			columns = [key for key in COLUMN_NAMES.keys()]
+			table_data = [[val for val in COLUMN_NAMES.values()]]
+
+		_represent_events(events_to_show, columns, table_data, 'USB-Event-Dump', repres)
 
 	# ------------------- USB Storage Update -------------------
 
@@ -121,7 +173,8 @@ class USBStorage:
 		attributes=None,
 		compression_level='5',
 		indent=4,
-		sieve=None
+		sieve=None,
+		backend='7z'
 	):
 		if storage_type == 'history':
 			events_to_show = _get_history_events(sieve)
@@ -135,58 +188,54 @@ class USBStorage:
 		if events_to_show is None:
 			return 1
 
-		if events_to_show:
-			min_date, max_date = _get_dates(events_to_show)
-		else:
-			print_info('No events to append')
-			return 1
-
-		storage_full_path = os.path.join(USBStorage._STORAGE_BASE, f'{storage_type}.7z')
-		if not os.path.isfile(storage_full_path):
-			print_critical(f'Storage not found: "{storage_full_path}"')
+		try:
+			backend = get_backend(backend, password, compression_level)
+		except USBRipError as e:
+			print_critical(str(e))
 			return 1
 
-		print_info(f'Updating storage: "{storage_full_path}"')
+		return _update_storage(storage_type, backend, events_to_show, indent)
 
+	@staticmethod
+	@time_it_if_debug(cfg.DEBUG, time_it)
+	def update_all_storages(
+		passwords,
+		*,
+		input_auth=None,
+		attributes=None,
+		compression_level='5',
+		indent=4,
+		sieve=None,
+		backend='7z'
+	):
+		"""Update the history and violations storages from a single pass over the system logs."""
 		try:
-			out = _7zip_unpack(storage_full_path, password)
+			backends = {
+				storage_type: get_backend(backend, password, compression_level)
+				for storage_type, password in passwords.items()
+			}
 		except USBRipError as e:
-			print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
+			print_critical(str(e))
 			return 1
 
-		if 'Everything is Ok' in out:
-			base_filename = re.search(r'([^\n ]*\.json)', _7zip_list(storage_full_path, password), re.MULTILINE).group(1)
-			json_file = os.path.join(USBStorage._STORAGE_BASE, base_filename)
-			_shred(storage_full_path)
-
-			with open(json_file, 'r', encoding='utf-8') as dump:
-				events_dumped = json.load(dump)
-			_shred(json_file)
-
-			merged_events = union_event_sets(events_dumped, events_to_show)
-
-			if len(base_filename) > 20:  # len('%Y%m%dT%H%M%S') -> 20
-				min_date = base_filename[:15]
-
-			new_json_file = os.path.join(USBStorage._STORAGE_BASE, f'{min_date}-{max_date}.json')
-			_dump_events(merged_events, storage_type, new_json_file, indent)
+		ue = USBEvents()
+		if not ue:
+			return 1
 
-			try:
-				out = _7zip_pack(storage_full_path, new_json_file, password, compression_level)
-			except USBRipError as e:
-				_shred(new_json_file)
-				print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
-				return 1
+		try:
+			violation_events = _get_violation_events(sieve, input_auth, attributes, indent, ue=ue)
+		except USBRipError as e:
+			print_critical(str(e), initial_error=e.errors['initial_error'])
+			return 1
 
-			if 'Everything is Ok' in out:
-				print_info('Storage was successfully updated')
-			else:
-				print_critical('Undefined behaviour while creating storage', initial_error=out)
+		history_events = _get_history_events(sieve, ue=ue)
 
-			_shred(new_json_file)
+		errcode = None
+		for storage_type, events_to_show in (('history', history_events), ('violations', violation_events)):
+			if _update_storage(storage_type, backends[storage_type], events_to_show, indent):
+				errcode = 1
 
-		else:
-			print_critical('Undefined behaviour while unpacking storage', initial_error=out)
+		return errcode
 
 	# ------------------- USB Storage Create -------------------
 
@@ -200,7 +249,8 @@ class USBStorage:
 		attributes=None,
 		compression_level='5',
 		indent=4,
-		sieve=None
+		sieve=None,
+		backend='7z'
 	):
 		if storage_type == 'history':
 			events_to_show = _get_history_events(sieve)
@@ -214,44 +264,130 @@ class USBStorage:
 		if events_to_show is None:
 			return 1
 
-		if events_to_show:
-			min_date, max_date = _get_dates(events_to_show)
-			json_file = os.path.join(USBStorage._STORAGE_BASE, f'{min_date}-{max_date}.json')
-		else:
-			json_file = os.path.join(USBStorage._STORAGE_BASE, f'{datetime.now().strftime("%Y%m%dT%H%M%S")}.json')
+		storage_dir = _storage_dir(storage_type)
 
 		try:
-			_dump_events(events_to_show, storage_type, json_file, indent)
+			backend = get_backend(backend, password, compression_level)
+
+			with _storage_lock(storage_type):
+				# The old storage stays in place until the new one is complete
+				new_storage_dir = tempfile.mkdtemp(prefix=f'.{storage_type}.', dir=USBStorage._STORAGE_BASE)
+
+				try:
+					manifest = _new_manifest()
+					_append_segment(new_storage_dir, manifest, events_to_show, backend, indent)
+					_write_manifest(new_storage_dir, manifest, backend)
+
+					fingerprints = array('Q', sorted({_fingerprint(event) for event in events_to_show}))
+					_write_index(new_storage_dir, fingerprints, len(manifest['segments']), backend)
+				except USBRipError:
+					shutil.rmtree(new_storage_dir)
+					raise
+
+				_replace_storage(storage_type, new_storage_dir)
+
 		except USBRipError as e:
-			print_critical(str(e), initial_error=e.errors['initial_error'])
+			print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
+			return 1
+
+		except OSError as e:
+			print_critical(f'Failed to create storage directory: "{storage_dir}"', initial_error=str(e))
 			return 1
 
-		storage_full_path = os.path.join(USBStorage._STORAGE_BASE, f'{storage_type}.7z')
-		if os.path.exists(storage_full_path):
-			_shred(storage_full_path)
+		print_info(f'New {storage_type} storage: "{storage_dir}"')
+		if backend.encrypted:
+			print_secret('Your password is', secret=password)
+
+	# ------------------- USB Storage Compact ------------------
+
+	@staticmethod
+	@time_it_if_debug(cfg.DEBUG, time_it)
+	def compact_storage(
+		storage_type,
+		password,
+		*,
+		compression_level='5',
+		indent=4,
+		segment_size=10000,
+		retention_days=0,
+		backend='7z'
+	):
+		"""
+		Merge runs of adjacent (in time) segments holding less than segment_size events together
+		and drop events older than retention_days (0 = keep everything).
+		"""
+		cutoff = None
+		if retention_days:
+			cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
 
 		try:
-			out = _7zip_pack(storage_full_path, json_file, password, compression_level)
+			backend = get_backend(backend, password, compression_level)
+
+			with _storage_lock(storage_type):
+				storage_dir, manifest = _open_storage(storage_type, backend, locked=True)
+
+				print_info(f'Compacting storage: "{storage_dir}"')
+
+				expired, groups = _plan_compaction(manifest['segments'], segment_size, cutoff)
+
+				keep, rewrite = [], []
+				for group in groups:
+					if len(group) > 1 or _straddles(group[0], cutoff):
+						rewrite.append(group)
+					else:
+						keep.append(group[0])
+
+				if not expired and not rewrite:
+					print_info('Storage is already compact')
+					return
+
+				# Expired events stay in the index, so that updates do not bring them back from the logs
+				fingerprints, _ = _read_index(storage_dir, manifest, backend)
+				dropped = sum(segment['events'] for segment in expired)
+
+				new_manifest = _new_manifest()
+				new_manifest['segments'] = keep
+
+				# Merged segments get new names, the switch happens when the new manifest is committed
+				try:
+					for group in rewrite:
+						events = []
+						for event in _merge_segments(storage_dir, group, backend):
+							if cutoff is None or event['conn'] >= cutoff:
+								events.append(event)
+							else:
+								dropped += 1
+
+						if events:
+							_append_segment(storage_dir, new_manifest, events, backend, indent, taken=manifest)
+				except USBRipError:
+					_remove_segments(storage_dir, new_manifest['segments'][len(keep):], backend)
+					raise
+
+				new_manifest['segments'].sort(key=lambda segment: segment['min'])
+
+				_write_manifest(storage_dir, new_manifest, backend)
+
+				_write_index(storage_dir, fingerprints, len(new_manifest['segments']), backend)
+
+				_remove_segments(storage_dir, expired + [segment for group in rewrite for segment in group], backend)
+
 		except USBRipError as e:
-			_shred(json_file)
 			print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
 			return 1
 
-		if 'Everything is Ok' in out:
-			print_info(f'New {storage_type} storage: "{storage_full_path}"')
-			print_secret('Your password is', secret=password)
-			_shred(json_file)
-		else:
-			print_critical('Undefined behaviour while creating storage', initial_error=out)
+		print_info(
+			f'Storage was successfully compacted: {len(manifest["segments"])} -> {len(new_manifest["segments"])} segments, '
+			f'{dropped} expired events dropped'
+		)
 
 	# ------------------- USB Storage Passwd -------------------
 
 	@staticmethod
 	@time_it_if_debug(cfg.DEBUG, time_it)
-	def change_password(storage_type, *, compression_level='5'):
-		storage_full_path = os.path.join(USBStorage._STORAGE_BASE, f'{storage_type}.7z')
-		if not os.path.isfile(storage_full_path):
-			print_critical(f'Storage not found: "{storage_full_path}"')
+	def change_password(storage_type, *, compression_level='5', backend='7z'):
+		if not BACKENDS[backend].encrypted:
+			print_critical(f'Storages of the "{backend}" backend are not encrypted, there is no password to change')
 			return
 
 		old_password = getpass('Old password: ')
@@ -263,56 +399,110 @@ class USBStorage:
 			return
 
 		try:
-			out = _7zip_unpack(storage_full_path, old_password)
-			if 'Everything is Ok' in out:
-				base_filename = re.search(r'([^\n ]*\.json)', _7zip_list(storage_full_path, old_password), re.MULTILINE).group(1)
-				json_file = os.path.join(USBStorage._STORAGE_BASE, f'{base_filename}')
-				_shred(storage_full_path)
+			with _storage_lock(storage_type):
+				old_backend = get_backend(backend, old_password, compression_level)
+				new_backend = get_backend(backend, new_password, compression_level)
+
+				storage_dir, manifest = _open_storage(storage_type, old_backend, locked=True)
+				fingerprints, _ = _read_index(storage_dir, manifest, old_backend)
+
+				# Segments are re-encrypted under new names, the switch happens when the new manifest is committed
+				new_manifest = _new_manifest()
+
+				try:
+					for segment in manifest['segments']:
+						new_segment = dict(segment, name=_next_segment_name(new_backend, manifest, new_manifest))
+						_repack_segment(
+							os.path.join(storage_dir, segment['name']),
+							os.path.join(storage_dir, new_segment['name']),
+							old_backend,
+							new_backend
+						)
+						new_manifest['segments'].append(new_segment)
+				except USBRipError:
+					_remove_segments(storage_dir, new_manifest['segments'], new_backend)
+					raise
+
+				_write_manifest(storage_dir, new_manifest, new_backend)
+				_write_index(storage_dir, fingerprints, len(new_manifest['segments']), new_backend)
+
+				_remove_segments(storage_dir, manifest['segments'], old_backend)
 
-				out = _7zip_pack(storage_full_path, json_file, new_password, compression_level)
+		except USBRipError as e:
+			print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
+			return
 
-				if 'Everything is Ok' in out:
-					print_info('Password was successfully changed')
+		print_info('Password was successfully changed')
 
-					conf_parser = ConfigParser(allow_no_value=True)
-					conf_parser.optionxform = str
-					conf_parser.read(CONFIG_FILE, encoding='utf-8')
-					conf_parser.set(storage_type, 'password', new_password)
+		conf_parser = ConfigParser(allow_no_value=True)
+		conf_parser.optionxform = str
+		conf_parser.read(CONFIG_FILE, encoding='utf-8')
+		conf_parser.set(storage_type, 'password', new_password)
 
-					with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-						conf_parser.write(f)
+		with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
+			conf_parser.write(f)
 
-					os.chmod(CONFIG_FILE, stat.S_IRUSR | stat.S_IWUSR)  # 600
+		os.chmod(CONFIG_FILE, stat.S_IRUSR | stat.S_IWUSR)  # 600
 
-					print_info('Configuration file updated')
+		print_info('Configuration file updated')
 
-				else:
-					print_critical('Undefined behaviour while creating storage', initial_error=out)
 
-				_shred(json_file)
+# ----------------------------------------------------------
+# ----------------------- Utilities ------------------------
+# ----------------------------------------------------------
 
-			else:
-				print_critical('Undefined behaviour while unpacking storage', initial_error=out)
 
-		except USBRipError as e:
-			print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
-			return
+def _update_storage(storage_type, backend, events_to_show, indent):
+	if not events_to_show:
+		print_info(f'No events to append to {storage_type} storage')
+		return 1
 
+	try:
+		with _storage_lock(storage_type):
+			storage_dir, manifest = _open_storage(storage_type, backend, locked=True)
 
-# ----------------------------------------------------------
-# ----------------------- Utilities ------------------------
-# ----------------------------------------------------------
+			print_info(f'Updating storage: "{storage_dir}"')
+
+			_remove_orphan_segments(storage_dir, manifest, backend)
+			fingerprints, up_to_date = _read_index(storage_dir, manifest, backend)
 
+			new_events, new_fingerprints = [], set()
+			for event in events_to_show:
+				fingerprint = _fingerprint(event)
+				if fingerprint not in new_fingerprints and not _index_contains(fingerprints, fingerprint):
+					new_fingerprints.add(fingerprint)
+					new_events.append(event)
 
-def _get_history_events(sieve):
-	ue = USBEvents()
+			if not new_events:
+				if not up_to_date:
+					_write_index(storage_dir, fingerprints, len(manifest['segments']), backend)
+				print_info('Storage is up to date, no new events to append')
+				return
+
+			# The segment is invisible until the manifest that lists it replaces the old one
+			_append_segment(storage_dir, manifest, new_events, backend, indent)
+			_write_manifest(storage_dir, manifest, backend)
+
+			fingerprints = array('Q', sorted(fingerprints + array('Q', new_fingerprints)))
+			_write_index(storage_dir, fingerprints, len(manifest['segments']), backend)
+
+	except USBRipError as e:
+		print_critical(str(e), errcode=e.errors['errcode'], initial_error=e.errors['initial_error'])
+		return 1
+
+	print_info(f'Storage was successfully updated ({len(new_events)} new events)')
+
+
+def _get_history_events(sieve, *, ue=None):
+	if ue is None:
+		ue = USBEvents()
 	if not ue:
 		return None
 
 	return _filter_events(ue._all_events, sieve)
 
 
-def _get_violation_events(sieve, input_auth, attributes, indent):
+def _get_violation_events(sieve, input_auth, attributes, indent, *, ue=None):
 	try:
 		auth = _process_auth_list(input_auth, indent)
 	except json.decoder.JSONDecodeError as e:
@@ -324,10 +514,12 @@ def _get_violation_events(sieve, input_auth, attributes, indent):
 	if not attributes:
 		attributes = auth.keys()
 
-	ue = USBEvents()
+	if ue is None:
+		ue = USBEvents()
 	if not ue:
 		return None
 
+	violations = []
 	for event in ue._all_events:
 		try:
 			if any(
@@ -335,14 +527,14 @@ def _get_violation_events(sieve, input_auth, attributes, indent):
 				event[key] is not None
 				for key, vals in zip(attributes, auth.values())
 			):
-				ue._violations.append(event)
+				violations.append(event)
 		except KeyError as e:
 			raise USBRipError(
 				'No such attribute in authorized device list',
 				errors={'initial_error': str(e)}
 			)
 
-	return _filter_events(ue._violations, sieve)
+	return _filter_events(violations, sieve)
 
 
 def _get_dates(events_to_show):
@@ -350,106 +542,402 @@ def _get_dates(events_to_show):
 	return (min(dates), max(dates))
 
 
-'''
-def _create_shadow(password, rounds):
-	from bcrypt import hashpw, gensalt
-	hashed = hashpw(password.encode('utf-8'), gensalt(rounds))
-	with open('/var/opt/usbrip/shadow', 'wb') as f:
-		f.write(hashed)
-'''
+# ----------------------------------------------------------
+# ------------------------ Segments ------------------------
+# ----------------------------------------------------------
 
 
-def _shred(filename):
-	cmd = [
-		'shred',
-		'-z',
-		'-u',
-		'-n',
-		'7',
-		filename
-	]
+def _storage_dir(storage_type):
+	return os.path.join(USBStorage._STORAGE_BASE, storage_type)
+
+
+def _open_storage(storage_type, backend, *, locked=False):
+	"""Return the storage directory and its manifest (a legacy single-archive storage is migrated first)."""
+	storage_dir = _storage_dir(storage_type)
+
+	if os.path.isfile(os.path.join(USBStorage._STORAGE_BASE, f'{storage_type}.7z')):
+		if locked:
+			_migrate_legacy_storage(storage_type, backend)
+		else:
+			with _storage_lock(storage_type):
+				_migrate_legacy_storage(storage_type, backend)
+
+	manifest_path = os.path.join(storage_dir, USBStorage._MANIFEST + backend.extension)
+	if not os.path.isfile(manifest_path):
+		for other in BACKENDS.values():
+			if os.path.isfile(os.path.join(storage_dir, USBStorage._MANIFEST + other.extension)):
+				raise USBRipError(
+					f'Storage "{storage_dir}" uses the "{other.name}" backend, not "{backend.name}"',
+					errors={'errcode': USBStorage._7Z_UNKNOWN_ERROR, 'initial_error': ''}
+				)
+
+		raise USBRipError(
+			f'Storage not found: "{storage_dir}"',
+			errors={'errcode': USBStorage._7Z_UNKNOWN_ERROR, 'initial_error': ''}
+		)
 
 	try:
-		out = subprocess.check_output(cmd).decode('utf-8')
-	except subprocess.CalledProcessError as e:
-		print_warning(f'Failed to shred {filename}, using standard rm instead: {str(e)}')
-		os.remove(filename)
+		manifest = json.loads(backend.get(manifest_path).decode('utf-8'))
+	except ValueError as e:
+		raise USBRipError(
+			f'Failed to decode storage manifest: "{manifest_path}"',
+			errors={'errcode': USBStorage._7Z_UNKNOWN_ERROR, 'initial_error': str(e)}
+		)
 
+	return (storage_dir, manifest)
 
-def _7zip_list(archive, password):
-	print_info(f'Listing archive: "{archive}"')
 
-	cmd = [
-		'7z',
-		'l',
-		archive,
-		'-p' + password
-	]
+def _new_manifest():
+	return {'version': 1, 'segments': []}
 
-	out, errcode, errmsg, e = _7zip_subprocess_handler(cmd)
-	if errcode:
-		raise USBRipError(errmsg, errors={'errcode': errcode, 'initial_error': e})
 
-	return out
+def _write_manifest(storage_dir, manifest, backend):
+	data = json.dumps(manifest, indent=4).encode('utf-8')
+	backend.put(os.path.join(storage_dir, USBStorage._MANIFEST + backend.extension), 'manifest.json', data)
 
 
-def _7zip_unpack(archive, password):
-	print_info(f'Unpacking archive: "{archive}"')
+def _select_segments(manifest, dates):
+	"""Segments that may hold events whose connection date starts with one of the dates (all if no dates)."""
+	if not dates:
+		return manifest['segments']
 
-	cmd = [
-		'7z',
-		'e',
-		archive,
-		'-p' + password,
-		'-o' + USBStorage._STORAGE_BASE,
-		'-y'
+	# Same "starts with" range as in the event database: prefix <= conn < prefix + U+10FFFF
+	return [
+		segment for segment in manifest['segments']
+		if segment['events'] and any(
+			segment['max'] >= date and segment['min'] < date + '\U0010ffff'
+			for date in dates
+		)
 	]
 
-	out, errcode, errmsg, e = _7zip_subprocess_handler(cmd)
-	if errcode:
-		raise USBRipError(errmsg, errors={'errcode': errcode, 'initial_error': e})
 
-	return out
+def _read_storage_events(storage_type, backend, dates):
+	"""Stream the events of the last committed version of a storage in connection order; no lock is taken."""
+	for _ in range(3):
+		storage_dir, manifest = _open_storage(storage_type, backend)
+		segments = _select_segments(manifest, dates)
+		started = False
 
+		try:
+			for event in _merge_segments(storage_dir, segments, backend):
+				started = True
+				yield event
+			return
 
-def _7zip_pack(archive, file, password, compression_level):
-	print_info(f'Creating storage (7-Zip): "{archive}"')
+		except USBRipError:
+			# A writer committed meanwhile and retired some of these segments (passwd, create), start over
+			if all(os.path.isfile(os.path.join(storage_dir, segment['name'])) for segment in segments):
+				raise
+			if started:
+				break
 
-	cmd = [
-		'7z',
-		'a',
-		archive,
-		file,
-		'-mhe=on',
-		'-p' + password,
-		'-mx=' + compression_level
-	]
+	raise USBRipError(
+		'Storage keeps changing while being read, try again later',
+		errors={'errcode': USBStorage._7Z_UNKNOWN_ERROR, 'initial_error': ''}
+	)
 
-	out, errcode, errmsg, e = _7zip_subprocess_handler(cmd)
-	if errcode:
-		raise USBRipError(errmsg, errors={'errcode': errcode, 'initial_error': e})
 
-	os.chmod(archive, stat.S_IRUSR | stat.S_IWUSR)  # 600
+def _iter_segments(storage_dir, segments, backend):
+	"""Yield the events of the segments in order, decrypting one segment at a time."""
+	for segment in segments:
+		yield _read_segment(os.path.join(storage_dir, segment['name']), backend)
 
-	return out
 
+def _read_segment(segment_path, backend):
+	"""Unpack a segment straight into memory, the plaintext never touches the disk."""
+	data = backend.get(segment_path)
 
-def _7zip_subprocess_handler(cmd):
 	try:
-		out = subprocess.check_output(cmd).decode('utf-8')
-	except subprocess.CalledProcessError as e:
-		initial_error = e.output.decode('utf-8')
-
-		if 'Wrong password?' in initial_error:
-			errmsg = 'Can not open encrypted archive. Wrong password?'
-			errcode = USBStorage._7Z_WRONG_PASSWORD_ERROR
-		elif 'can not open output file' in initial_error:
-			errmsg = 'Permission denied. Retry with sudo'
-			errcode = USBStorage._7Z_PERMISSION_ERROR
-		else:
-			errmsg = 'Something went wrong while working with 7-Zip archive'
-			errcode = USBStorage._7Z_UNKNOWN_ERROR
+		return json.loads(data.decode('utf-8'))
+	except ValueError as e:
+		raise USBRipError(
+			f'Failed to decode storage segment: "{segment_path}"',
+			errors={'errcode': USBStorage._7Z_UNKNOWN_ERROR, 'initial_error': str(e)}
+		)
+
+
+def _write_segment(segment_path, events, backend, indent):
+	data = json.dumps(events, indent=indent).encode('utf-8')
+	backend.put(segment_path, _segment_member_name(events), data)
+
+
+def _append_segment(storage_dir, manifest, events, backend, indent, *, taken=None):
+	"""Pack events into the next segment of the storage and register it in the manifest."""
+	segment_name = _next_segment_name(backend, manifest, *([taken] if taken else []))
+	_write_segment(os.path.join(storage_dir, segment_name), events, backend, indent)
+	manifest['segments'].append(_segment_entry(segment_name, events))
+
+
+def _repack_segment(segment_path, new_segment_path, old_backend, new_backend):
+	events = _read_segment(segment_path, old_backend)
+	_write_segment(new_segment_path, events, new_backend, 4)
+
+
+def _segment_entry(segment_name, events):
+	return {
+		'name':   segment_name,
+		'events': len(events),
+		'min':    min((event['conn'] for event in events), default=None),
+		'max':    max((event['conn'] for event in events), default=None)
+	}
+
+
+def _segment_member_name(events):
+	if events:
+		min_date, max_date = _get_dates(events)
+		return f'{min_date}-{max_date}.json'
+
+	return f'{datetime.now().strftime("%Y%m%dT%H%M%S")}.json'
+
+
+def _plan_compaction(segments, segment_size, cutoff):
+	"""
+	Split segments into the ones to drop (empty or entirely past retention) and groups of segments
+	adjacent in time to be stored as one; a group of one is kept as is unless it crosses the cutoff.
+	"""
+	expired, groups, group, group_events = [], [], [], 0
+
+	for segment in sorted(segments, key=lambda segment: segment['min'] or ''):
+		if not segment['events'] or (cutoff is not None and segment['max'] < cutoff):
+			expired.append(segment)
+			continue
+
+		if segment['events'] >= segment_size and not _straddles(segment, cutoff):
+			if group:
+				groups.append(group)
+			groups.append([segment])
+			group, group_events = [], 0
+			continue
+
+		if group and group_events + segment['events'] > segment_size:
+			groups.append(group)
+			group, group_events = [], 0
+
+		group.append(segment)
+		group_events += segment['events']
+
+	if group:
+		groups.append(group)
+
+	return (expired, groups)
+
+
+def _straddles(segment, cutoff):
+	return cutoff is not None and segment['min'] < cutoff <= segment['max']
+
+
+def _merge_segments(storage_dir, segments, backend):
+	"""
+	Stream the events of several segments in connection order (a heap merge of the sorted segments).
+	A segment is only unpacked once the merge reaches its first connection (manifest "min"), so
+	segments that do not overlap are never in memory at the same time.
+	"""
+	pending = sorted((segment for segment in segments if segment['events']), key=lambda segment: segment['min'])
+	pending.reverse()  # popped from the end
+
+	heap = []  # (conn, tie-breaker, event, rest of its segment)
+	counter = itertools.count()
+
+	def push(events):
+		for event in events:
+			heapq.heappush(heap, (event['conn'], next(counter), event, events))
+			break
+
+	while heap or pending:
+		# Events of segments not unpacked yet are no earlier than their segment's "min"
+		while pending and (not heap or pending[-1]['min'] <= heap[0][0]):
+			segment = pending.pop()
+			events = _read_segment(os.path.join(storage_dir, segment['name']), backend)
+			events.sort(key=lambda event: event['conn'])
+			push(iter(events))
+
+		_, _, event, events = heapq.heappop(heap)
+		yield event
+		push(events)
+
+
+def _next_segment_name(backend, *manifests):
+	last = max((int(segment['name'].split('.', 1)[0]) for manifest in manifests for segment in manifest['segments']), default=0)
+	return f'{last + 1:06d}{backend.extension}'
+
+
+def _remove_segments(storage_dir, segments, backend):
+	for segment in segments:
+		backend.delete(os.path.join(storage_dir, segment['name']))
+
+
+def _remove_orphan_segments(storage_dir, manifest, backend):
+	"""Drop segments left behind by writers that stopped before committing the manifest."""
+	known = {segment['name'] for segment in manifest['segments']}
+	known.update(name + backend.extension for name in (USBStorage._MANIFEST, USBStorage._INDEX))
+
+	for name in backend.list(storage_dir):
+		if name not in known:
+			print_info(f'Removing uncommitted storage segment: "{name}"')
+			backend.delete(os.path.join(storage_dir, name))
+
+
+def _replace_storage(storage_type, new_storage_dir):
+	"""Put a complete storage directory in place of the current one (and of a legacy archive)."""
+	storage_dir = _storage_dir(storage_type)
+	old_storage_dir = storage_dir + '.old'
+
+	if os.path.isdir(old_storage_dir):  # leftover of an interrupted create
+		shutil.rmtree(old_storage_dir)
+
+	if os.path.isdir(storage_dir):
+		os.rename(storage_dir, old_storage_dir)
+	os.rename(new_storage_dir, storage_dir)
+	fsync(USBStorage._STORAGE_BASE)
+
+	if os.path.isdir(old_storage_dir):
+		shutil.rmtree(old_storage_dir)
+
+	legacy_storage = os.path.join(USBStorage._STORAGE_BASE, f'{storage_type}.7z')
+	if os.path.exists(legacy_storage):
+		os.remove(legacy_storage)
+
+
+def _migrate_legacy_storage(storage_type, backend):
+	"""Turn a single-archive storage (<type>.7z) into the first segment of a segmented one."""
+	legacy_storage = os.path.join(USBStorage._STORAGE_BASE, f'{storage_type}.7z')
+	storage_dir = _storage_dir(storage_type)
+
+	if not os.path.isfile(legacy_storage) or os.path.isdir(storage_dir):
+		return
+
+	print_info(f'Migrating storage to segmented layout: "{legacy_storage}" -> "{storage_dir}/"')
+
+	events = _read_segment(legacy_storage, SevenZipBackend(backend.password))  # also checks the password
 
-		return ('', errcode, errmsg, initial_error)
+	new_storage_dir = tempfile.mkdtemp(prefix=f'.{storage_type}.', dir=USBStorage._STORAGE_BASE)
+	manifest = _new_manifest()
 
-	return (out, 0, '', '')
+	try:
+		_append_segment(new_storage_dir, manifest, events, backend, 4)
+		_write_manifest(new_storage_dir, manifest, backend)
+	except USBRipError:
+		shutil.rmtree(new_storage_dir)
+		raise
+
+	_replace_storage(storage_type, new_storage_dir)
+
+
+# ----------------------------------------------------------
+# ------------------------ Locking -------------------------
+# ----------------------------------------------------------
+
+
+@contextmanager
+def _storage_lock(storage_type):
+	"""Advisory exclusive lock of one storage, held by writers only; different storages do not block each other."""
+	lock_file = os.path.join(USBStorage._STORAGE_BASE, f'.{storage_type}.lock')
+
+	try:
+		fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, stat.S_IRUSR | stat.S_IWUSR)
+	except PermissionError as e:
+		raise USBRipError(
+			'Permission denied. Retry with sudo',
+			errors={'errcode': USBStorage._7Z_PERMISSION_ERROR, 'initial_error': str(e)}
+		)
+	except FileNotFoundError as e:
+		raise USBRipError(
+			f'Storage directory does not exist: "{USBStorage._STORAGE_BASE}"',
+			errors={'errcode': USBStorage._7Z_UNKNOWN_ERROR, 'initial_error': str(e)}
+		)
+	except OSError as e:
+		raise USBRipError(
+			f'Failed to lock storage: "{lock_file}"',
+			errors={'errcode': USBStorage._7Z_UNKNOWN_ERROR, 'initial_error': str(e)}
+		)
+
+	try:
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			print_info(f'Waiting for another usbrip process to release the {storage_type} storage')
+			fcntl.flock(fd, fcntl.LOCK_EX)
+
+		yield
+
+	finally:
+		os.close(fd)  # releases the lock
+
+
+# ----------------------------------------------------------
+# ------------------- Fingerprint index --------------------
+# ----------------------------------------------------------
+
+
+# Magic and the number of segments the index covers, followed by the sorted 64-bit fingerprints
+_INDEX_HEADER = struct.Struct('<8sI')
+_INDEX_MAGIC = b'USBRIPFX'
+
+
+def _fingerprint(event):
+	key = json.dumps([event[key] for key in ('conn', 'host', 'vid', 'pid', 'prod', 'manufact', 'serial', 'port', 'disconn')])
+	return int.from_bytes(blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _index_contains(fingerprints, fingerprint):
+	i = bisect_left(fingerprints, fingerprint)
+	return i < len(fingerprints) and fingerprints[i] == fingerprint
+
+
+def _read_index(storage_dir, manifest, backend):
+	"""
+	Return the sorted fingerprints of all stored events and whether the index on disk was complete.
+	Segments the index does not cover yet (no index, or an update that stopped before writing it) are
+	decrypted and folded in.
+	"""
+	index_path = os.path.join(storage_dir, USBStorage._INDEX + backend.extension)
+	fingerprints = array('Q')
+	covered = 0
+
+	if os.path.isfile(index_path):
+		try:
+			data = backend.get(index_path)
+		except USBRipError as e:
+			# passwd stopped after committing the manifest, the index is still under the old password
+			if e.errors['errcode'] != USBStorage._7Z_WRONG_PASSWORD_ERROR:
+				raise
+			data = _INDEX_HEADER.pack(_INDEX_MAGIC, 0)
+
+		try:
+			magic, covered = _INDEX_HEADER.unpack_from(data)
+		except struct.error:
+			magic = None
+
+		if magic != _INDEX_MAGIC:
+			raise USBRipError(
+				f'Invalid storage index: "{index_path}"',
+				errors={'errcode': USBStorage._7Z_UNKNOWN_ERROR, 'initial_error': ''}
+			)
+
+		fingerprints.frombytes(data[_INDEX_HEADER.size:])
+
+	missing = manifest['segments'][covered:]
+	if not missing:
+		return (fingerprints, True)
+
+	print_info(f'Indexing {len(missing)} storage segment(s)')
+
+	fingerprints = set(fingerprints)
+	for events in _iter_segments(storage_dir, missing, backend):
+		fingerprints.update(_fingerprint(event) for event in events)
+
+	return (array('Q', sorted(fingerprints)), False)
+
+
+def _write_index(storage_dir, fingerprints, covered, backend):
+	data = _INDEX_HEADER.pack(_INDEX_MAGIC, covered) + fingerprints.tobytes()
+	backend.put(os.path.join(storage_dir, USBStorage._INDEX + backend.extension), 'index.bin', data)
+
+
+'''
+def _create_shadow(password, rounds):
+	from bcrypt import hashpw, gensalt
+	hashed = hashpw(password.encode('utf-8'), gensalt(rounds))
+	with open('/var/opt/usbrip/shadow', 'wb') as f:
+		f.write(hashed)
+'''
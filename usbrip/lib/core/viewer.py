@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""LICENSE
+
+Copyright (C) 2020 Sam Freeside
+
+This file is part of usbrip.
+
+usbrip is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+usbrip is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with usbrip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+__author__ = 'Sam Freeside (@snovvcrash)'
+__email__  = 'snovvcrash@protonmail[.]ch'
+__site__   = 'https://github.com/snovvcrash/usbrip'
+__brief__  = 'Interactive event viewer'
+
+import bisect
+import curses
+import locale
+from itertools import islice, takewhile
+
+import usbrip.lib.core.config as cfg
+from usbrip.lib.core.common import BULLET
+from usbrip.lib.core.common import ABSENCE
+from usbrip.lib.core.common import SEPARATOR
+
+
+# ----------------------------------------------------------
+# ---------------------- Event Viewer ----------------------
+# ----------------------------------------------------------
+
+
+class EventViewer:
+	"""
+	Curses viewer over a sequence of events (anything with len() and indexing, e.g. a
+	ColumnarDump). Only the rows on screen are ever looked at and formatted, so the size
+	of the history does not matter; the day separators are drawn on the fly. Searches and
+	date jumps go through the dump's columns (ColumnarDump.find, conn_times) when there
+	are any, so that they do not decode every event either.
+	"""
+
+	_HEADERS = {
+		'conn':     'Connected',
+		'host':     'Host',
+		'vid':      'VID',
+		'pid':      'PID',
+		'prod':     'Product',
+		'manufact': 'Manufacturer',
+		'serial':   'Serial Number',
+		'port':     'Port',
+		'disconn':  'Disconnected',
+		'vendor':   'Vendor',
+		'product':  'Product Name'
+	}
+
+	_HELP = 'q:quit  j/k:scroll  PgUp/PgDn  g/G:top/bottom  /:search  n/N:next/prev  d:jump to date'
+
+	def __init__(self, events, columns, title):
+		self._events = events
+		self._columns = columns
+		self._title = title
+		self._top = 0          # index of the first event on screen
+		self._cursor = 0       # index of the selected event
+		self._bottom = 0       # index of the last event that fit on screen during the last redraw
+		self._query = ''
+		self._message = ''
+		self._dates = None     # sorted (conn, index) pairs, built on the first jump to a date
+		self._columnar = hasattr(events, 'conn_times')
+
+		# Columns get as wide as the widest value seen so far (header, a sample, then whatever scrolls into view)
+		self._widths = {name: len(EventViewer._HEADERS[name]) for name in columns}
+		for name in ('conn', 'disconn'):
+			if name in columns:
+				self._widths[name] = max(self._widths[name], 19)
+
+		for i in range(min(len(events), 1000)):
+			self._measure(events[i])
+
+		unicode = 'UTF-8' in locale.getpreferredencoding() and cfg.ISUTF8
+		self._bullet = BULLET if unicode else '*'
+		self._absence = ABSENCE if unicode else '-'
+		self._separator = SEPARATOR if unicode else '-'
+		self._vbar = '│' if unicode else '|'
+
+	def run(self):
+		locale.setlocale(locale.LC_ALL, '')
+		curses.wrapper(self._main)
+
+	# ------------------------ Drawing -------------------------
+
+	def _main(self, stdscr):
+		curses.curs_set(0)
+		curses.use_default_colors()
+		curses.init_pair(1, curses.COLOR_GREEN, -1)
+		curses.init_pair(2, curses.COLOR_RED, -1)
+		curses.init_pair(3, curses.COLOR_MAGENTA, -1)
+
+		self._scr = stdscr
+
+		while True:
+			self._draw()
+			key = stdscr.getch()
+
+			if key in (ord('q'), 27):
+				break
+			elif key in (curses.KEY_DOWN, ord('j')):
+				self._move(1)
+			elif key in (curses.KEY_UP, ord('k')):
+				self._move(-1)
+			elif key in (curses.KEY_NPAGE, ord(' ')):
+				self._move(max(self._bottom - self._top, 1))
+			elif key in (curses.KEY_PPAGE, ord('b')):
+				self._move(-max(self._bottom - self._top, 1))
+			elif key in (curses.KEY_HOME, ord('g')):
+				self._move(-len(self._events))
+			elif key in (curses.KEY_END, ord('G')):
+				self._move(len(self._events))
+			elif key == ord('/'):
+				self._query = self._prompt('Search: ')
+				self._search(self._cursor, 1)
+			elif key == ord('n'):
+				self._search(self._cursor + 1, 1)
+			elif key == ord('N'):
+				self._search(self._cursor - 1, -1)
+			elif key == ord('d'):
+				self._jump_to_date(self._prompt('Date (e.g. 2020-01-31): '))
+
+	def _draw(self):
+		self._render()
+
+		# Day separators take lines too, so scrolling down may need a few more steps to reach the cursor
+		while self._cursor > self._bottom and self._top < self._cursor:
+			self._top += self._cursor - self._bottom
+			self._render()
+
+		self._message = ''
+		self._scr.refresh()
+
+	def _render(self):
+		scr = self._scr
+		height, width = scr.getmaxyx()
+		scr.erase()
+
+		self._put(0, f' {self._title} ({len(self._events)} events)', curses.A_BOLD)
+		self._put(1, self._format_cells(
+			[EventViewer._HEADERS[name].rjust(self._widths[name]) for name in self._columns]
+		), curses.color_pair(3) | curses.A_BOLD)
+
+		y, i = 2, self._top
+		while y < height - 1 and i < len(self._events):
+			event = self._events[i]
+
+			if 'conn' in self._columns and (i == 0 or event['conn'][:10] != self._events[i-1]['conn'][:10]):
+				day = event['conn'][:10]
+				self._put(y, self._format_cells([
+					f'{day} {self._bullet * (self._widths["conn"] - len(day) - 1)}' if name == 'conn' else self._separator * self._widths[name]
+					for name in self._columns
+				]), curses.A_DIM)
+				y += 1
+				if y >= height - 1:
+					break
+
+			self._measure(event)
+			self._put_event(y, event, selected=(i == self._cursor))
+			self._bottom = i
+			y += 1
+			i += 1
+
+		status = self._message or EventViewer._HELP
+		self._put(height - 1, f' {self._cursor + 1}/{len(self._events)}  {status}'.ljust(width - 1), curses.A_REVERSE)
+
+	def _put_event(self, y, event, *, selected):
+		attr = curses.A_REVERSE if selected else curses.A_NORMAL
+		colors = {'conn': curses.color_pair(1), 'disconn': curses.color_pair(2)}
+
+		x = self._put(y, ' ', attr)
+		for n, name in enumerate(self._columns):
+			if n:
+				x = self._put(y, f' {self._vbar} ', attr, x)
+
+			val = event[name]
+			cell = (self._absence if val is None else val).rjust(self._widths[name])
+			x = self._put(y, cell, attr | colors.get(name, 0), x)
+
+		self._put(y, ' ', attr, x)
+
+	def _put(self, y, text, attr=curses.A_NORMAL, x=0):
+		width = self._scr.getmaxyx()[1]
+		if x < width - 1:
+			try:
+				self._scr.addnstr(y, x, text, width - 1 - x, attr)
+			except curses.error:
+				pass
+		return x + len(text)
+
+	def _format_cells(self, cells):
+		return ' ' + f' {self._vbar} '.join(cells) + ' '
+
+	def _prompt(self, message):
+		height, width = self._scr.getmaxyx()
+		self._scr.move(height - 1, 0)
+		self._scr.clrtoeol()
+		self._scr.addnstr(height - 1, 0, message, width - 1)
+
+		curses.echo()
+		curses.curs_set(1)
+		try:
+			answer = self._scr.getstr(height - 1, len(message), 64).decode('utf-8', 'replace')
+		finally:
+			curses.noecho()
+			curses.curs_set(0)
+
+		return answer.strip()
+
+	# ----------------------- Navigation -----------------------
+
+	def _move(self, delta):
+		self._goto(self._cursor + delta)
+
+	def _goto(self, i):
+		if not len(self._events):
+			return
+
+		self._cursor = min(max(i, 0), len(self._events) - 1)
+
+		page = max(self._bottom - self._top, 1)
+		if self._cursor < self._top:
+			self._top = self._cursor
+		elif self._cursor > self._bottom:
+			self._top = max(self._cursor - page, 0)
+
+	def _search(self, start, step):
+		if not self._query:
+			return
+
+		if self._columnar:
+			i = self._events.find(self._query, start, step)
+		else:
+			i = self._find(self._query.lower(), start, step)
+
+		if i is not None:
+			self._goto(i)
+		else:
+			self._message = f'Not found: {self._query}'
+
+	def _find(self, query, start, step):
+		i = start
+		while 0 <= i < len(self._events):
+			event = self._events[i]
+			if any(val is not None and query in val.lower() for val in event.values()):
+				return i
+			i += step
+
+		return None
+
+	def _jump_to_date(self, date):
+		"""Go to the first event (in view order) connected on date, any prefix of "YYYY-MM-DD hh:mm:ss"."""
+		if not date:
+			return
+
+		# Events are not necessarily in connection order (rotated logs are read newest first,
+		# "????" years sort last), so the dates are sorted once on the side and searched.
+		# A columnar dump is indexed by its integer time column, without decoding any event
+		if self._columnar:
+			if self._dates is None:
+				conn = self._events.conn_times()
+				self._dates = sorted(zip(conn, range(len(conn))))
+
+			bounds = self._events.conn_bounds(date)
+			if bounds is None:
+				matches = ()
+			else:
+				lo = bisect.bisect_left(self._dates, (bounds[0],))
+				matches = takewhile(lambda item: item[0] <= bounds[1], islice(self._dates, lo, None))
+
+		else:
+			if self._dates is None:
+				self._dates = sorted((event['conn'] or '', i) for i, event in enumerate(self._events))
+
+			lo = bisect.bisect_left(self._dates, (date,))
+			matches = takewhile(lambda item: item[0].startswith(date), islice(self._dates, lo, None))
+
+		i = min((i for _, i in matches), default=None)
+
+		if i is not None:
+			self._goto(i)
+			self._top = self._cursor
+		else:
+			self._message = f'No events on {date}'
+
+	def _measure(self, event):
+		for name in self._columns:
+			val = event[name]
+			if val is not None and len(val) > self._widths[name]:
+				self._widths[name] = len(val)
@@ -27,10 +27,13 @@ __site__   = 'https://github.com/snovvcrash/usbrip'
 __brief__  = 'Command line option parser'
 
 import os
-from pathlib import Path
 from argparse import ArgumentParser
 
-from usbrip.lib.core.usbstorage import USBStorage
+from usbrip.lib.core.common import DAEMON_SOCKET
+from usbrip.lib.core.common import EVENT_DATABASE
+from usbrip.lib.core.common import STORAGE_BASE
+from usbrip.lib.core.common import USB_IDS_URL
+from usbrip.lib.core.common import FORMATS
 
 
 def get_arg_parser():
@@ -55,6 +58,12 @@ def get_arg_parser():
 
     build_us_parser(subparsers)
 
+    # ----------------------------------------------------------
+    # ----------------------- USB Daemon -----------------------
+    # ----------------------------------------------------------
+
+    build_ud_parser(subparsers)
+
     # ----------------------------------------------------------
     # ------------------------ USB IDs -------------------------
     # ----------------------------------------------------------
@@ -93,6 +102,7 @@ def build_ue_parser(subparsers):
     build_ueo_parser(ue_subparsers)
     build_ueg_parser(ue_subparsers)
     build_uev_parser(ue_subparsers)
+    build_uew_parser(ue_subparsers)
 
 
 # ------------------- USB Events History -------------------
@@ -108,8 +118,14 @@ def build_ueh_parser(subparsers):
     _parse_quiet_args(ueh_parser)
     _parse_column_args(ueh_parser)
     _parse_sieve_args(ueh_parser)
+    _parse_prefilter_args(ueh_parser)
     _parse_repres_args(ueh_parser)
+    _parse_format_args(ueh_parser)
+    _parse_tui_args(ueh_parser)
+    _parse_enrich_args(ueh_parser)
     _parse_file_args(ueh_parser)
+    _parse_kmsg_args(ueh_parser)
+    _parse_db_args(ueh_parser)
 
 
 # -------------------- USB Events Open ---------------------
@@ -132,6 +148,9 @@ def build_ueo_parser(subparsers):
     _parse_column_args(ueo_parser)
     _parse_sieve_args(ueo_parser)
     _parse_repres_args(ueo_parser)
+    _parse_format_args(ueo_parser)
+    _parse_tui_args(ueo_parser)
+    _parse_enrich_args(ueo_parser)
     _parse_file_args(ueo_parser)
 
 
@@ -155,7 +174,9 @@ def build_ueg_parser(subparsers):
     _parse_debug_args(ueg_parser)
     _parse_quiet_args(ueg_parser)
     _parse_sieve_args(ueg_parser)
+    _parse_prefilter_args(ueg_parser)
     _parse_file_args(ueg_parser)
+    _parse_kmsg_args(ueg_parser)
 
     _parse_attribute_args(
         ueg_parser,
@@ -192,8 +213,13 @@ def build_uev_parser(subparsers):
     _parse_quiet_args(uev_parser)
     _parse_column_args(uev_parser)
     _parse_sieve_args(uev_parser)
+    _parse_prefilter_args(uev_parser)
     _parse_repres_args(uev_parser)
+    _parse_format_args(uev_parser)
+    _parse_enrich_args(uev_parser)
     _parse_file_args(uev_parser)
+    _parse_kmsg_args(uev_parser)
+    _parse_db_args(uev_parser)
 
     _parse_attribute_args(
         uev_parser,
@@ -206,6 +232,54 @@ def build_uev_parser(subparsers):
     )
 
 
+# -------------------- USB Events Watch --------------------
+
+
+def build_uew_parser(subparsers):
+    uew_parser = subparsers.add_parser(
+        'watch',
+        help='follow system log in real time and report USB violation events '
+             'as soon as devices are connected'
+    )
+
+    uew_parser.add_argument(
+        'input',
+        type=str,
+        nargs='?',
+        default='/var/opt/usbrip/trusted/auth.json',
+        help='input path for the list of authorized devices'
+    )
+
+    _parse_debug_args(uew_parser)
+    _parse_quiet_args(uew_parser)
+
+    uew_parser.add_argument(
+        '-s',
+        '--source',
+        type=str,
+        choices=('auto', 'journal', 'syslog', 'kmsg'),
+        default='auto',
+        help='log source to follow (default is "auto": journal, then syslog, then kmsg)'
+    )
+
+    uew_parser.add_argument(
+        '-j',
+        '--json',
+        action='store_true',
+        help='print violation events as JSON records (one per line)'
+    )
+
+    _parse_attribute_args(
+        uew_parser,
+        help_msg='attributes to look through when searching for USB violation events '
+                 '(options: "vid", '
+                 '"pid", '
+                 '"prod", '
+                 '"manufact", '
+                 '"serial")'
+    )
+
+
 # ----------------------------------------------------------
 # ---------------------- USB Storage -----------------------
 # ----------------------------------------------------------
@@ -223,6 +297,7 @@ def build_us_parser(subparsers):
     build_uso_parser(us_subparsers)
     build_usu_parser(us_subparsers)
     build_usc_parser(us_subparsers)
+    build_usm_parser(us_subparsers)
     build_usp_parser(us_subparsers)
 
 
@@ -268,9 +343,13 @@ def build_usu_parser(subparsers):
 
     _parse_debug_args(usu_parser)
     _parse_quiet_args(usu_parser)
-    _parse_storage_type_args(usu_parser)
+    _parse_storage_type_args(
+        usu_parser,
+        help_msg='storage type (options: "history", "violations", "all" = both from a single pass over the logs)'
+    )
     _parse_comperssion_level_args(usu_parser)
     _parse_sieve_args(usu_parser)
+    _parse_prefilter_args(usu_parser)
 
     _parse_attribute_args(
         usu_parser,
@@ -298,7 +377,7 @@ def build_usc_parser(subparsers):
     usc_parser = subparsers.add_parser(
         'create',
         help=f'create initial history/violations storage; '
-             f'storage path is "{USBStorage._STORAGE_BASE}"'
+             f'storage path is "{STORAGE_BASE}"'
     )
 
     _parse_debug_args(usc_parser)
@@ -306,6 +385,7 @@ def build_usc_parser(subparsers):
     _parse_storage_type_args(usc_parser)
     _parse_comperssion_level_args(usc_parser)
     _parse_sieve_args(usc_parser)
+    _parse_prefilter_args(usc_parser)
 
     _parse_attribute_args(
         usc_parser,
@@ -326,6 +406,42 @@ def build_usc_parser(subparsers):
     )
 
 
+# ------------------- USB Storage Compact ------------------
+
+
+def build_usm_parser(subparsers):
+    usm_parser = subparsers.add_parser(
+        'compact',
+        help='merge small storage segments and drop events past the retention window'
+    )
+
+    _parse_debug_args(usm_parser)
+    _parse_quiet_args(usm_parser)
+    _parse_storage_type_args(
+        usm_parser,
+        help_msg='storage type (options: "history", "violations", "all" = both)'
+    )
+    _parse_comperssion_level_args(usm_parser)
+
+    usm_parser.add_argument(
+        '--retention',
+        type=int,
+        default=None,
+        metavar='DAYS',
+        help='drop events older than DAYS days (0 = keep everything, '
+             'default is "retention_days" from the configuration file)'
+    )
+
+    usm_parser.add_argument(
+        '--segment-size',
+        type=int,
+        default=None,
+        metavar='EVENTS',
+        help='merge adjacent segments up to EVENTS events each '
+             '(default is "segment_size" from the configuration file)'
+    )
+
+
 # ------------------- USB Storage Passwd -------------------
 
 
@@ -341,6 +457,48 @@ def build_usp_parser(subparsers):
     _parse_comperssion_level_args(usp_parser)
 
 
+# ----------------------------------------------------------
+# ----------------------- USB Daemon -----------------------
+# ----------------------------------------------------------
+
+
+def build_ud_parser(subparsers):
+    ud_parser = subparsers.add_parser(
+        'serve',
+        help='run as a daemon: ingest system log once, keep USB events in memory '
+             'and answer queries over a Unix socket (other usbrip commands use it '
+             'transparently while it is running)'
+    )
+
+    _parse_debug_args(ud_parser)
+    _parse_quiet_args(ud_parser)
+
+    ud_parser.add_argument(
+        '-s',
+        '--source',
+        type=str,
+        choices=('auto', 'journal', 'syslog', 'kmsg'),
+        default='auto',
+        help='log source to ingest and follow (default is "auto": journal, then syslog, then kmsg)'
+    )
+
+    ud_parser.add_argument(
+        '--socket',
+        type=str,
+        default=DAEMON_SOCKET,
+        help=f'path of the Unix socket to listen on (default is "{DAEMON_SOCKET}")'
+    )
+
+    ud_parser.add_argument(
+        '--max-events',
+        type=int,
+        default=None,
+        metavar='EVENTS',
+        help='keep only about the latest EVENTS USB events in memory, older ones are '
+             'dropped from the answers (default is to keep all of them)'
+    )
+
+
 # ----------------------------------------------------------
 # ------------------------ USB IDs -------------------------
 # ----------------------------------------------------------
@@ -355,6 +513,7 @@ def build_ui_parser(subparsers):
     ui_subparsers = ui_parser.add_subparsers(dest='ui_subparser')
 
     build_uis_parser(ui_subparsers)
+    build_uif_parser(ui_subparsers)
     build_uid_parser(ui_subparsers)
 
 
@@ -365,7 +524,7 @@ def build_uis_parser(subparsers):
     uis_parser = subparsers.add_parser(
         'search',
         help=f'search by VID and/or PID; '
-             f'ids database path is "{os.path.abspath(str(Path.home()))}/.config/usbrip/usb.ids"'
+             f'ids database path is "{os.path.abspath(os.path.expanduser("~"))}/.config/usbrip/usb.ids"'
     )
 
     _parse_debug_args(uis_parser)
@@ -391,6 +550,48 @@ def build_uis_parser(subparsers):
         help='offline mode (no database download/update)'
     )
 
+    _parse_mirror_args(uis_parser)
+
+    uis_parser.add_argument(
+        '-b',
+        '--batch',
+        type=str,
+        default=None,
+        metavar='FILE',
+        help='resolve many pairs at once: read a CSV file (with a header naming the "vid" and "pid" columns) '
+             'or an NDJSON file ("-" for stdin) and write it to stdout in the same format with '
+             '"vendor" and "product" added (implies --offline)'
+    )
+
+
+# ---------------------- USB IDs Find ----------------------
+
+
+def build_uif_parser(subparsers):
+    uif_parser = subparsers.add_parser(
+        'find',
+        help='search by vendor or product name (partial, case-insensitive); '
+             'uses the local database only'
+    )
+
+    _parse_debug_args(uif_parser)
+    _parse_quiet_args(uif_parser)
+
+    uif_parser.add_argument(
+        'text',
+        type=str,
+        nargs='+',
+        help='vendor or product name (or a part of it)'
+    )
+
+    uif_parser.add_argument(
+        '-n',
+        '--number',
+        type=int,
+        default=20,
+        help='number of matches to show (default: 20)'
+    )
+
 
 # -------------------- USB IDs Download --------------------
 
@@ -399,11 +600,12 @@ def build_uid_parser(subparsers):
     uid_parser = subparsers.add_parser(
         'download',
         help=f'download/update database; '
-             f'ids database path is "{os.path.abspath(str(Path.home()))}/.config/usbrip/usb.ids"'
+             f'ids database path is "{os.path.abspath(os.path.expanduser("~"))}/.config/usbrip/usb.ids"'
     )
 
     _parse_debug_args(uid_parser)
     _parse_quiet_args(uid_parser)
+    _parse_mirror_args(uid_parser)
 
 
 # ----------------------------------------------------------
@@ -444,7 +646,8 @@ def _parse_column_args(parser):
              '"manufact", '
              '"serial", '
              '"port", '
-             '"disconn")'
+             '"disconn", '
+             '"vendor" and "product" with --enrich)'
     )
 
 
@@ -548,6 +751,54 @@ def _parse_repres_args(parser):
     )
 
 
+def _parse_format_args(parser):
+    parser.add_argument(
+        '--format',
+        type=str,
+        choices=FORMATS,
+        default=None,
+        help='write events in this format instead of showing them '
+             '(streamed record by record, "columnar" needs --output)'
+    )
+
+    parser.add_argument(
+        '-o',
+        '--output',
+        dest='out_file',
+        type=str,
+        default=None,
+        help='output file for --format (default: stdout); '
+             'the format is guessed from the extension when --format is not given'
+    )
+
+
+def _parse_tui_args(parser):
+    parser.add_argument(
+        '--tui',
+        action='store_true',
+        help='browse events in an interactive viewer (page, search, jump by date)'
+    )
+
+
+def _parse_enrich_args(parser):
+    parser.add_argument(
+        '--enrich',
+        action='store_true',
+        help='add vendor and product names from the local usb.ids database '
+             '("vendor" and "product" columns and fields)'
+    )
+
+
+def _parse_mirror_args(parser):
+    parser.add_argument(
+        '--mirror',
+        type=str,
+        default=None,
+        metavar='URL',
+        help=f'where to download the database from (default: "{USB_IDS_URL}")'
+    )
+
+
 def _parse_attribute_args(parser, *, help_msg):
     parser.add_argument(
         '-a',
@@ -559,11 +810,11 @@ def _parse_attribute_args(parser, *, help_msg):
     )
 
 
-def _parse_storage_type_args(parser):
+def _parse_storage_type_args(parser, *, help_msg='storage type (options: "history", "violations")'):
     parser.add_argument(
         'storage_type',
         type=str,
-        help='storage type (options: "history", "violations")'
+        help=help_msg
     )
 
 
@@ -576,6 +827,15 @@ def _parse_comperssion_level_args(parser):
     )
 
 
+def _parse_prefilter_args(parser):
+    parser.add_argument(
+        '--prefilter',
+        action='store_true',
+        help='pre-select USB log lines with ripgrep or grep when available '
+             '(falls back to the pure Python reader otherwise)'
+    )
+
+
 def _parse_file_args(parser):
     parser.add_argument(
         '-f',
@@ -585,3 +845,44 @@ def _parse_file_args(parser):
         default=[],
         help='obtain log from the outer files'
     )
+
+
+def _parse_kmsg_args(parser):
+    parser.add_argument(
+        '-k',
+        '--kmsg',
+        nargs='?',
+        type=str,
+        const='/dev/kmsg',
+        default=None,
+        help='read kernel ring buffer records directly from /dev/kmsg '
+             '(or from a file in the same format), bypassing journald/rsyslog; '
+             'record times are counted from the boot of this host unless "--boot-time" is given'
+    )
+
+    parser.add_argument(
+        '--boot-time',
+        type=str,
+        default=None,
+        metavar='"YYYY-MM-DD hh:mm:ss"',
+        help='local time the host a "--kmsg" file was captured on booted at, '
+             'for files from another machine or an earlier boot'
+    )
+
+
+def _parse_db_args(parser):
+    parser.add_argument(
+        '--db',
+        nargs='?',
+        type=str,
+        const=EVENT_DATABASE,
+        default=None,
+        help='keep USB events in a local SQLite database (updated from the log on every run) '
+             f'and answer the query from it (default path: {EVENT_DATABASE})'
+    )
+
+    parser.add_argument(
+        '--db-only',
+        action='store_true',
+        help='query the database without reading the log first (requires --db)'
+    )
@@ -54,6 +54,11 @@ def get_config_parser():
 		config_parser.add_section('violations')
 		config_parser.set('violations', 'password', 'R1pp3r!')
 
+		config_parser.add_section('storage')
+		config_parser.set('storage', 'backend', '7z')
+		config_parser.set('storage', 'retention_days', '0')
+		config_parser.set('storage', 'segment_size', '10000')
+
 		print_info(f'New configuration file: "{CONFIG_FILE}"')
 
 		with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
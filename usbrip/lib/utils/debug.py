@@ -27,7 +27,9 @@ __site__   = 'https://github.com/snovvcrash/usbrip'
 __brief__  = 'Debug utils'
 
 import functools
+import threading
 import time
+from collections import OrderedDict
 
 import usbrip.lib.core.config as cfg
 
@@ -54,3 +56,25 @@ class time_it_if_debug:
 			return func
 
 		return self._decorator(func)
+
+
+class StageStats:
+	"""Accumulate busy/wait time of pipeline stages (possibly from several threads)."""
+
+	def __init__(self):
+		self._start = time.perf_counter()
+		self._lock = threading.Lock()
+		self._busy = OrderedDict()
+
+	def add(self, stage, seconds):
+		with self._lock:
+			self._busy[stage] = self._busy.get(stage, 0.0) + seconds
+
+	def report(self, title):
+		wall = time.perf_counter() - self._start
+		print(f'{title}: {wall:.3f} seconds')
+
+		with self._lock:
+			for stage, busy in self._busy.items():
+				utilisation = busy / wall if wall else 0.0
+				print(f'    {stage + ":":<16}{busy:8.3f} seconds ({utilisation:6.1%})')
@@ -28,7 +28,6 @@ __brief__  = 'Program runtime meter'
 
 import atexit
 import time
-import datetime
 
 import usbrip.lib.core.config as cfg
 
@@ -39,6 +38,7 @@ def tick(msg, fmt='%H:%M:%S', taken=None):
 	now = time.strftime(fmt, time.localtime())
 	print('%s %s' % (msg, now))
 	if taken:
+		import datetime  # only needed at shutdown
 		taken = datetime.timedelta(seconds=taken)
 		print('[*] Time taken: %s' % taken)
 